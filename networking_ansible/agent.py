@@ -0,0 +1,51 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+
+from network_runner.models.inventory import Inventory
+from neutron.common import config as common_config
+from neutron_lib import rpc as n_rpc
+from oslo_log import log as logging
+from oslo_service import service
+
+from networking_ansible import config
+from networking_ansible import constants as c
+from networking_ansible.ml2 import rpc
+from networking_ansible.ml2 import runner
+
+LOG = logging.getLogger(__name__)
+CONF = config.CONF
+
+
+def create_endpoint():
+    """Build the rpc endpoint running playbooks on the configured switches"""
+    inventory = Inventory()
+    inventory.deserialize({'all': {'hosts': config.Config().inventory}})
+    runner.set_native_threads(CONF.ml2_ansible.runner_threads)
+    return rpc.AgentRunnerEndpoint(runner.BatchNetworkRunner(
+        inventory, CONF.ml2_ansible.runner_threads_per_switch))
+
+
+def main():
+    common_config.register_common_config_options()
+    common_config.init(sys.argv[1:])
+    common_config.setup_logging()
+    endpoint = create_endpoint()
+    LOG.info('Running playbooks for {} switches'.format(
+        len(endpoint.runner.inventory.hosts)))
+    server = n_rpc.Service(CONF.host, c.AGENT_TOPIC, manager=endpoint)
+    service.launch(CONF, server,
+                   workers=CONF.ml2_ansible.agent_workers).wait()
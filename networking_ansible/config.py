@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+import re
+
 from oslo_config import cfg
 from oslo_config import types
 from oslo_log import log as logging
@@ -24,11 +27,206 @@ LOG = logging.getLogger(__name__)
 anet_opts = [
     cfg.StrOpt('coordination_uri',
                default='etcd://127.0.0.1:2379',
-               help="backend to use for tooz coordination")
+               help="backend to use for tooz coordination"),
+    cfg.IntOpt('max_workers',
+               default=10,
+               min=1,
+               help="maximum number of switches to configure in parallel "
+                    "when a network is created"),
+    cfg.BoolOpt('lazy_vlans',
+                default=False,
+                help="create vlans on a switch only when a port on the "
+                     "vlan is plugged into it and delete them when "
+                     "the last one is unplugged, instead of creating them "
+                     "on all switches when a network is created"),
+    cfg.BoolOpt('async_mode',
+                default=False,
+                help="queue switch operations and run them in the "
+                     "background instead of while the neutron API request "
+                     "is being handled"),
+    cfg.IntOpt('async_workers',
+               default=10,
+               min=1,
+               help="number of switches operations are run on in parallel "
+                    "in async mode"),
+    cfg.IntOpt('journal_sync_interval',
+               default=10,
+               min=1,
+               help="seconds between checks for switch operations that "
+                    "are waiting to be run in async mode"),
+    cfg.IntOpt('journal_processing_timeout',
+               default=600,
+               min=1,
+               help="seconds after which a switch operation started by "
+                    "another neutron-server is assumed to be lost and "
+                    "is run again"),
+    cfg.IntOpt('journal_max_attempts',
+               default=5,
+               min=1,
+               help="number of times a switch operation is attempted "
+                    "before it is left in the failed state"),
+    cfg.IntOpt('journal_retry_backoff',
+               default=10,
+               min=0,
+               help="seconds to wait before retrying a switch operation "
+                    "that failed once, doubled for each further failure "
+                    "and randomly shortened by up to half. 0 retries "
+                    "failed operations at the next check"),
+    cfg.IntOpt('journal_retry_backoff_max',
+               default=600,
+               min=1,
+               help="maximum number of seconds to wait before retrying a "
+                    "failed switch operation"),
+    cfg.BoolOpt('retry_sync_failures',
+                default=False,
+                help="when not in async mode, put switch operations that "
+                     "fail because the switch or the coordination backend "
+                     "can't be reached in the journal to be retried in the "
+                     "background instead of failing the neutron API "
+                     "request"),
+    cfg.IntOpt('batch_size',
+               default=1,
+               min=1,
+               help="maximum number of queued operations for a switch "
+                    "that are merged into a single ansible run in async "
+                    "mode"),
+    cfg.FloatOpt('batch_window',
+                 default=0,
+                 min=0,
+                 help="seconds to wait for more operations for a switch to "
+                      "be queued before running a batch that is smaller "
+                      "than batch_size in async mode"),
+    cfg.FloatOpt('trunk_debounce_window',
+                 default=0,
+                 min=0,
+                 help="seconds to wait for more subport changes to a trunk "
+                      "before applying them to the switch port of its "
+                      "parent port. Changes made while they are being "
+                      "applied are applied together once that is done. 0 "
+                      "applies each change as it is made"),
+    cfg.IntOpt('port_state_ttl',
+               default=0,
+               min=0,
+               help="seconds the configuration applied to a switch port "
+                    "is remembered for, operations that would not change "
+                    "it are skipped. The configuration is remembered by "
+                    "the neutron-server process that owns the switch, so "
+                    "it is only used with switch_sharding in async mode. "
+                    "Changes made out of band are not noticed until it "
+                    "expires. 0 disables the cache"),
+    cfg.IntOpt('trunk_diff_threshold',
+               default=0,
+               min=0,
+               help="maximum number of vlans added to and removed from a "
+                    "trunk port one at a time instead of configuring the "
+                    "whole port again. Only used when the vlans on the "
+                    "port are known from the configuration remembered "
+                    "with port_state_ttl. 0 always configures the whole "
+                    "port"),
+    cfg.IntOpt('max_port_operations',
+               default=1,
+               min=1,
+               help="maximum number of operations on different ports of "
+                    "a switch that can run at the same time. Operations on "
+                    "the same port, and operations on the whole switch "
+                    "such as creating vlans, always run alone"),
+    cfg.FloatOpt('lock_lease',
+                 default=0,
+                 min=0,
+                 help="seconds a switch lock is kept after an operation "
+                      "finishes, so the next operation on the switch from "
+                      "the same process doesn't have to take it again. "
+                      "Operations from other processes wait for the lease "
+                      "to expire. 0 releases locks straight away"),
+    cfg.IntOpt('lock_timeout',
+               default=0,
+               min=0,
+               help="seconds to wait for a switch lock before giving up. "
+                    "Synchronous operations fail, async operations are put "
+                    "back in the journal to be run later. 0 waits as long "
+                    "as it takes"),
+    cfg.BoolOpt('switch_sharding',
+                default=False,
+                help="give each switch an owning neutron-server process "
+                     "from the members of a coordination group in async "
+                     "mode. Only the owner runs the operations for a "
+                     "switch so they don't wait for distributed switch "
+                     "locks, switches move to other members when an "
+                     "owner's heartbeat expires. Every neutron-server "
+                     "sharing the database has to enable it, and the "
+                     "coordination backend has to support groups"),
+    cfg.BoolOpt('use_agent',
+                default=False,
+                help="run ansible in networking-ansible-agent processes "
+                     "instead of the neutron-server API and RPC workers. "
+                     "The playbooks for the switches are sent to the "
+                     "agents over the message bus, the agents read the "
+                     "switch inventory from the same configuration files"),
+    cfg.IntOpt('agent_timeout',
+               default=600,
+               min=1,
+               help="seconds to wait for a networking-ansible-agent to "
+                    "run the playbook for a switch operation"),
+    cfg.IntOpt('agent_workers',
+               default=1,
+               min=1,
+               help="number of worker processes networking-ansible-agent "
+                    "runs playbooks in"),
+    cfg.IntOpt('runner_threads',
+               default=20,
+               min=1,
+               help="number of native threads ansible playbooks are run "
+                    "in when the process runs under eventlet, so running "
+                    "them doesn't block the process's other requests. "
+                    "Shared by all the switches"),
+    cfg.IntOpt('runner_threads_per_switch',
+               default=0,
+               min=0,
+               help="maximum number of ansible playbooks run on the same "
+                    "switch at the same time by a process. 0 doesn't limit "
+                    "them"),
+    cfg.IntOpt('breaker_threshold',
+               default=0,
+               min=0,
+               help="number of consecutive failures to reach a switch "
+                    "after which its operations fail straight away instead "
+                    "of waiting for ansible to time out. Async operations "
+                    "are put back in the journal to be run later. Shared "
+                    "by the neutron-servers through the coordination "
+                    "backend. 0 disables the circuit breaker"),
+    cfg.IntOpt('breaker_reset_timeout',
+               default=60,
+               min=1,
+               help="seconds the operations on an unreachable switch fail "
+                    "straight away for before one is let through to check "
+                    "whether the switch is back"),
 ]
 
 cfg.CONF.register_opts(anet_opts, group='ml2_ansible')
 
+# [domain:]bus:device[.function], the domain and function are optional
+PCI_ADDRESS = re.compile(r'^(?:([0-9a-fA-F]{4}):)?([0-9a-fA-F]{2}):'
+                         r'([0-9a-fA-F]{2})(?:\.[0-7])?$')
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_pci_address(address):
+    """Parse the pci address of an SR-IOV device
+
+    The function is left out, the devices of a card are plugged into the
+    same switch port. Addresses are cached so looking one up again doesn't
+    parse it.
+
+    :param address: An address such as 0000:37:0b.1 or 37:0b
+    :returns: A (domain, bus, device) tuple of ints, or None if the address
+              isn't valid
+    """
+    match = PCI_ADDRESS.match(address or '')
+    if not match:
+        return None
+    domain, bus, device = match.groups()
+    return int(domain or '0', 16), int(bus, 16), int(device, 16)
+
 
 class Config(object):
 
@@ -36,14 +234,23 @@ class Config(object):
         """Get inventory list from config files
 
         builds a Network-Runner inventory object
-        port_map dictionary and
-        and a mac_map dictionary
+        port_map dictionary,
+        a mac_map dictionary and
+        a physnet_map dictionary
         according to ansible inventory file yaml definition
         http://docs.ansible.com/ansible/latest/user_guide/intro_inventory.html
         """
         self.inventory = {}
         self.mac_map = {}
         self.port_mappings = {}
+        # physnet_map indexes the hosts that define physnets by physnet.
+        # Hosts that don't define physnets carry all of them and are
+        # kept in any_physnet_hosts instead.
+        self.physnet_map = {}
+        self.any_physnet_hosts = []
+        # the session and rate limits of the hosts that set them
+        self.session_limits = {}
+        self.rate_limits = {}
 
         for conffile in CONF.config_file:
             # parse each config file
@@ -73,9 +280,12 @@ class Config(object):
                     ports_lst = []
                     # ensure the mapping is a valid format
                     # format the mapping to a tuple of (switch_name, port_name)
-                    ports_split = mapping[1][0].split(',')
+                    ports_split = [port.strip() for value in mapping[1]
+                                   for port in value.split(',')]
                     for port in ports_split:
-                        port_split = mapping[1][0].split('::')
+                        if not port:
+                            continue
+                        port_split = port.split('::')
                         if len(port_split) == 2:
                             # switch_name::port_name splits to
                             # ['switch_name', 'port_name']
@@ -86,7 +296,7 @@ class Config(object):
                                 'formated mapping. It will not be available '
                                 'for look up. Double check that it is using a '
                                 'double colon :: as '
-                                'a separator.'.format(mapping))
+                                'a separator.'.format(port))
 
                     return (host_id, ports_lst)
 
@@ -103,6 +313,21 @@ class Config(object):
                 for b in c.BOOLEANS:
                     if b in dev_cfg:
                         dev_cfg[b] = types.Boolean()(dev_cfg[b])
+                # physnets is only used by the driver, it's
+                # not passed on to ansible with the rest of the inventory
+                physnets = types.List()(dev_cfg.pop(c.PHYSNETS, ''))
+                for physnet in physnets:
+                    self.physnet_map.setdefault(physnet, []).append(dev_id)
+                if not physnets:
+                    self.any_physnet_hosts.append(dev_id)
+                # so are the limits on the sessions opened on the switch
+                sessions = dev_cfg.pop(c.MAX_CONCURRENT_SESSIONS, None)
+                if sessions:
+                    self.session_limits[dev_id] = types.Integer(min=1)(
+                        sessions)
+                rate = dev_cfg.pop(c.OPS_PER_SECOND, None)
+                if rate:
+                    self.rate_limits[dev_id] = types.Float(min=0)(rate)
                 self.inventory[dev_id] = dev_cfg
                 # If mac is defined add it to the mac_map
                 if 'mac' in dev_cfg:
@@ -110,3 +335,49 @@ class Config(object):
 
         LOG.info('Ansible Host List: %s', ', '.join(self.inventory))
         LOG.debug('Ansible Port Mappings: %s', self.port_mappings)
+        LOG.debug('Ansible Physnet Mappings: %s', self.physnet_map)
+
+    @property
+    def port_mappings(self):
+        """The switch ports each compute host is plugged into
+
+        A dict of host id to a list of (switch_name, switch_port) tuples,
+        the host ids of SR-IOV devices have the device's pci address
+        appended, e.g. compute1-37:0b. Setting it indexes the mappings for
+        get_port_mappings.
+        """
+        return self._port_mappings
+
+    @port_mappings.setter
+    def port_mappings(self, port_mappings):
+        self._port_mappings = port_mappings
+        self._host_index = {}
+        self._pci_index = {}
+        for host_id, mappings in port_mappings.items():
+            mappings = tuple(tuple(mapping) for mapping in mappings)
+            self._host_index[host_id] = mappings
+            host, sep, address = host_id.rpartition('-')
+            address = parse_pci_address(address) if sep else None
+            if address:
+                self._pci_index[(host, address)] = mappings
+
+    def get_port_mappings(self, host_id, pci_slot=None):
+        """Return the switch ports a compute host is plugged into
+
+        :param host_id: The host id of the port's binding
+        :param pci_slot: The pci address of the port's SR-IOV device, its
+                         switch ports are returned rather than the host's
+        :returns: A tuple of (switch_name, switch_port) tuples
+        """
+        if pci_slot is None:
+            return self._host_index.get(host_id, ())
+        address = parse_pci_address(pci_slot)
+        return self._pci_index.get((host_id, address), ())
+
+    def get_physnet_hosts(self, physnet):
+        """Return the names of the hosts that carry a physical network
+
+        :param physnet: The physical network name
+        :returns: A list of host names
+        """
+        return self.physnet_map.get(physnet, []) + self.any_physnet_hosts
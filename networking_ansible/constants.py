@@ -29,6 +29,61 @@ SUPPORTED_TYPES = (portbindings.VNIC_BAREMETAL,
                    portbindings.VNIC_NORMAL,
                    portbindings.VNIC_DIRECT)
 
+# operations queued for the switches in async mode
+OP_CREATE_VLAN = 'create_vlan'
+OP_DELETE_VLAN = 'delete_vlan'
+OP_UPDATE_PORT = 'update_port'
+OP_DELETE_PORT = 'delete_port'
+OP_UPDATE_SUBPORTS = 'update_subports'
+
+# states of the operations in the journal
+JOURNAL_PENDING = 'pending'
+JOURNAL_PROCESSING = 'processing'
+JOURNAL_FAILED = 'failed'
+
+# the coordination group switches are sharded across
+SWITCH_GROUP = b'networking-ansible-switches'
+
+# the coordination group circuit breakers are shared through
+BREAKER_GROUP = b'networking-ansible-breakers'
+# seconds between refreshes of the breakers other processes opened
+BREAKER_REFRESH_INTERVAL = 5
+# patterns of the ansible output that mean a switch couldn't be reached,
+# matched ignoring case. Every play recap has an unreachable count, only a
+# non-zero one counts.
+UNREACHABLE_ERRORS = (r'\bunreachable!',
+                      r'\bunreachable=[1-9]',
+                      r'connection timed out',
+                      r'connect timeout',
+                      r'connection refused',
+                      r'no route to host',
+                      r'(?:host|network) is unreachable')
+
+# the message bus topic networking-ansible-agent listens on
+AGENT_TOPIC = 'networking-ansible-agent'
+
+# port attributes and binding:profile keys the switch port configuration
+# depends on, updates that don't change any of them are ignored
+SWITCH_CONFIG_ATTRS = (portbindings.HOST_ID,
+                       portbindings.VIF_TYPE,
+                       'network_id',
+                       'trunk_details')
+SWITCH_CONFIG_PROFILE_KEYS = (LLI, 'pci_slot')
+
+# comma separated list of physical networks a switch carries
+PHYSNETS = 'physnets'
+
+# maximum number of sessions open on a switch at the same time across
+# all the neutron-servers
+MAX_CONCURRENT_SESSIONS = 'max_concurrent_sessions'
+# maximum number of sessions opened on a switch per second across all the
+# neutron-servers
+OPS_PER_SECOND = 'ops_per_second'
+# seconds the first wait for a free session on a switch lasts, each wait
+# after it is twice as long up to the maximum
+THROTTLE_POLL_INTERVAL = 0.2
+THROTTLE_MAX_POLL_INTERVAL = 3.2
+
 # values that will be cast to Bool in the conf process
 BOOLEANS = ['manage_vlans', 'stp_edge']
 # values that will be rolled into a separate dict and passed to network_runner
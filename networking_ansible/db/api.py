@@ -0,0 +1,543 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from neutron.db.models import segment as segment_models
+from neutron.db import models_v2
+from neutron.plugins.ml2 import models as ml2_models
+from neutron.services.trunk import models as trunk_models
+from neutron_lib.db import api as db_api
+from neutron_lib.db import standard_attr
+from oslo_db import exception as db_exc
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from networking_ansible import constants as c
+from networking_ansible.db import models
+
+
+def record(context, op_type, switch_name, object_id, payload):
+    """Add an operation to the journal
+
+    Joins the transaction the context already has open, if any, so the
+    operation is only recorded if the change that needs it is committed.
+
+    :param context: The neutron context to write the row with
+    :param op_type: The type of operation, one of the OP_* constants
+    :param switch_name: The name of the switch in the inventory
+    :param object_id: The id of the network or port being operated on
+    :param payload: A dict of the values the operation needs to run
+    :returns: The new SwitchJournal row
+    """
+    now = timeutils.utcnow()
+    entry = models.SwitchJournal(object_id=object_id,
+                                 switch_name=switch_name,
+                                 op_type=op_type,
+                                 payload=jsonutils.dumps(payload),
+                                 state=c.JOURNAL_PENDING,
+                                 attempts=0,
+                                 created_at=now,
+                                 updated_at=now)
+    with db_api.CONTEXT_WRITER.using(context):
+        context.session.add(entry)
+    return entry
+
+
+def get_pending(context, limit=None):
+    """Get the operations waiting to be run, oldest first
+
+    Operations backing off after a failed attempt are left out until their
+    retry time has passed. An operation is also left out while an earlier
+    one for the same object or switch port is pending or being run, so it
+    can't overtake an operation that is being retried, e.g. a port update
+    re-adding a vlan that its later delete had removed.
+
+    :param context: The neutron context to read with
+    :param limit: The maximum number of rows to return
+    :returns: A list of SwitchJournal rows
+    """
+    journal = models.SwitchJournal
+    now = timeutils.utcnow()
+    pending = []
+    # objects and switch ports with an earlier operation that hasn't
+    # finished
+    waiting = set()
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(journal).filter(
+            journal.state.in_([c.JOURNAL_PENDING,
+                               c.JOURNAL_PROCESSING])).order_by(
+                                   journal.seqnum)
+        for entry in query:
+            keys = {entry.object_id}
+            switch_port = get_payload(entry).get('switch_port')
+            if switch_port:
+                keys.add((entry.switch_name, switch_port))
+            backing_off = entry.retry_at and entry.retry_at > now
+            runnable = entry.state == c.JOURNAL_PENDING and not backing_off
+            if runnable and not keys & waiting:
+                pending.append(entry)
+                if limit and len(pending) == limit:
+                    break
+            waiting |= keys
+    return pending
+
+
+def claim(context, seqnum, host):
+    """Mark an operation as being run by a host
+
+    Only one of the neutron-servers sharing the database can claim an
+    operation, the others see it has already left the pending state.
+
+    :param context: The neutron context to write with
+    :param seqnum: The seqnum of the operation
+    :param host: The host and process that will run the operation, as
+                 host:pid
+    :returns: True if the operation was claimed
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        count = context.session.query(models.SwitchJournal).filter_by(
+            seqnum=seqnum, state=c.JOURNAL_PENDING).update(
+                {'state': c.JOURNAL_PROCESSING,
+                 'host': host,
+                 'updated_at': timeutils.utcnow()},
+                synchronize_session=False)
+    return count == 1
+
+
+def count_processing(context):
+    """Count the operations being run on each switch
+
+    :param context: The neutron context to read with
+    :returns: A dict of switch name to the number of operations
+    """
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(
+            models.SwitchJournal.switch_name,
+            sa.func.count(models.SwitchJournal.seqnum)).filter_by(
+                state=c.JOURNAL_PROCESSING).group_by(
+                    models.SwitchJournal.switch_name)
+        return dict(query.all())
+
+
+def complete(context, seqnum):
+    """Remove an operation that has been run
+
+    :param context: The neutron context to write with
+    :param seqnum: The seqnum of the operation
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        context.session.query(models.SwitchJournal).filter_by(
+            seqnum=seqnum).delete(synchronize_session=False)
+
+
+def fail(context, seqnum, max_attempts, delay=0, error=None,
+         permanent=False):
+    """Record a failed attempt to run an operation
+
+    The operation goes back to pending to be retried until it has been
+    attempted max_attempts times, after that, or straight away if the error
+    is permanent, it is left as failed with the error that stopped it.
+
+    :param context: The neutron context to write with
+    :param seqnum: The seqnum of the operation
+    :param max_attempts: The number of attempts before giving up
+    :param delay: The number of seconds to wait before retrying
+    :param error: A message saying why the attempt failed
+    :param permanent: Don't retry the operation, retrying can't fix it
+    :returns: True if the operation will be retried
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        entry = context.session.query(models.SwitchJournal).filter_by(
+            seqnum=seqnum).one_or_none()
+        if entry is None:
+            return False
+        now = timeutils.utcnow()
+        entry.attempts += 1
+        retry = not permanent and entry.attempts < max_attempts
+        entry.state = c.JOURNAL_PENDING if retry else c.JOURNAL_FAILED
+        entry.retry_at = (now + datetime.timedelta(seconds=delay)
+                          if retry and delay else None)
+        entry.last_error = error
+        entry.host = None
+        entry.updated_at = now
+        return retry
+
+
+def get_failed(context):
+    """Get the operations that were given up on, oldest first
+
+    :param context: The neutron context to read with
+    :returns: A list of SwitchJournal rows, last_error says why each failed
+    """
+    with db_api.CONTEXT_READER.using(context):
+        return context.session.query(models.SwitchJournal).filter_by(
+            state=c.JOURNAL_FAILED).order_by(
+                models.SwitchJournal.seqnum).all()
+
+
+def requeue(context, seqnum):
+    """Put an operation back to pending without counting an attempt
+
+    :param context: The neutron context to write with
+    :param seqnum: The seqnum of the operation
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        context.session.query(models.SwitchJournal).filter_by(
+            seqnum=seqnum).update({'state': c.JOURNAL_PENDING,
+                                   'host': None,
+                                   'updated_at': timeutils.utcnow()},
+                                  synchronize_session=False)
+
+
+def get_processing_owners(context):
+    """Get the hosts that claimed the operations being run
+
+    :param context: The neutron context to read with
+    :returns: A set of the values claim was given as host
+    """
+    journal = models.SwitchJournal
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(journal.host).filter_by(
+            state=c.JOURNAL_PROCESSING).distinct()
+        return {host for host, in query if host}
+
+
+def reset_processing(context, host=None, timeout=None, exclude_hosts=()):
+    """Put operations that were being run back to pending
+
+    :param context: The neutron context to write with
+    :param host: Only reset the operations claimed by this host
+    :param timeout: Only reset the operations claimed more than this many
+                    seconds ago
+    :param exclude_hosts: Don't reset the operations claimed by these hosts
+    :returns: The number of operations reset
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        query = context.session.query(models.SwitchJournal).filter_by(
+            state=c.JOURNAL_PROCESSING)
+        if host:
+            query = query.filter_by(host=host)
+        if exclude_hosts:
+            query = query.filter(
+                ~models.SwitchJournal.host.in_(exclude_hosts))
+        if timeout:
+            cutoff = timeutils.utcnow() - datetime.timedelta(seconds=timeout)
+            query = query.filter(models.SwitchJournal.updated_at < cutoff)
+        return query.update({'state': c.JOURNAL_PENDING,
+                             'host': None,
+                             'updated_at': timeutils.utcnow()},
+                            synchronize_session=False)
+
+
+def get_payload(entry):
+    """Return the payload of a journal row as a dict"""
+    return jsonutils.loads(entry.payload) if entry.payload else {}
+
+
+def get_port_bindings(context, network_id, device_owner,
+                      segmentation_id=None, exclude_port_id=None,
+                      host=None):
+    """Get the bindings of the ports on a network in a single query
+
+    :param context: The neutron context to read with
+    :param network_id: The network the ports are on
+    :param device_owner: Only get the ports with this device owner
+    :param segmentation_id: Only get the ports if the network has a segment
+                            with this segmentation id
+    :param exclude_port_id: Leave this port out
+    :param host: Only get the bindings to this host
+    :returns: A list of (port_id, host, vnic_type, profile) tuples, one for
+              each binding, profile is a dict
+    """
+    port = models_v2.Port
+    binding = ml2_models.PortBinding
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(
+            port.id, binding.host, binding.vnic_type, binding.profile).join(
+                binding, binding.port_id == port.id).filter(
+                    port.network_id == network_id,
+                    port.device_owner == device_owner)
+        if segmentation_id is not None:
+            segment = segment_models.NetworkSegment
+            query = query.join(
+                segment, segment.network_id == port.network_id).filter(
+                    segment.segmentation_id == segmentation_id)
+        if exclude_port_id:
+            query = query.filter(port.id != exclude_port_id)
+        if host:
+            query = query.filter(binding.host == host)
+        return [(port_id, bound_host, vnic_type,
+                 jsonutils.loads(profile) if profile else {})
+                for port_id, bound_host, vnic_type, profile in query]
+
+
+def get_vlan_port_bindings(context, segmentation_id, exclude_port_id=None):
+    """Get the bindings of the ports plugged in with a vlan in one query
+
+    The ports are the ones on the networks with a vlan segment using the
+    segmentation id. A trunk subport is plugged in through its parent port,
+    the parent port is returned in its place.
+
+    :param context: The neutron context to read with
+    :param segmentation_id: The vlan
+    :param exclude_port_id: Leave this port out
+    :returns: A list of (port_id, network_id, device_owner, host,
+              vnic_type, vif_type, profile) tuples, one for each binding,
+              profile is a dict
+    """
+    port = models_v2.Port
+    plugged = orm.aliased(models_v2.Port)
+    binding = ml2_models.PortBinding
+    segment = segment_models.NetworkSegment
+    subport = trunk_models.SubPort
+    trunk = trunk_models.Trunk
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(
+            plugged.id, plugged.network_id, plugged.device_owner,
+            binding.host, binding.vnic_type, binding.vif_type,
+            binding.profile).select_from(port).join(
+                segment, segment.network_id == port.network_id).outerjoin(
+                subport, subport.port_id == port.id).outerjoin(
+                trunk, trunk.id == subport.trunk_id).join(
+                plugged,
+                plugged.id == sa.func.coalesce(trunk.port_id, port.id)).join(
+                binding, binding.port_id == plugged.id).filter(
+                    segment.network_type == 'vlan',
+                    segment.segmentation_id == segmentation_id).distinct()
+        if exclude_port_id:
+            query = query.filter(plugged.id != exclude_port_id)
+        return [(port_id, network_id, device_owner, host, vnic_type,
+                 vif_type, jsonutils.loads(profile) if profile else {})
+                for (port_id, network_id, device_owner, host, vnic_type,
+                     vif_type, profile) in query]
+
+
+def add_vlan_ref(context, switch_name, switch_port, segmentation_id,
+                 port_id):
+    """Record a VM port using a vlan trunked on a switch port
+
+    Recording a reference that already exists, or one for a port that has
+    just been deleted, does nothing.
+
+    :param context: The neutron context to write with
+    :param switch_name: The name of the switch in the inventory
+    :param switch_port: The switch port the vlan is trunked on
+    :param segmentation_id: The vlan
+    :param port_id: The id of the port using the vlan
+    """
+    ref = models.VlanReference
+    try:
+        with db_api.CONTEXT_WRITER.using(context):
+            query = context.session.query(ref).filter_by(
+                switch_name=switch_name, switch_port=switch_port,
+                segmentation_id=segmentation_id, port_id=port_id)
+            if not context.session.query(query.exists()).scalar():
+                context.session.add(ref(switch_name=switch_name,
+                                        switch_port=switch_port,
+                                        segmentation_id=segmentation_id,
+                                        port_id=port_id))
+    except (db_exc.DBDuplicateEntry, db_exc.DBReferenceError):
+        pass
+
+
+def delete_vlan_refs(context, port_id, switch_name=None, switch_port=None):
+    """Remove the references a port holds on vlans
+
+    :param context: The neutron context to write with
+    :param port_id: The id of the port
+    :param switch_name: Only remove the references on this switch
+    :param switch_port: Only remove the references on this switch port
+    :returns: The number of references removed
+    """
+    with db_api.CONTEXT_WRITER.using(context):
+        query = context.session.query(models.VlanReference).filter_by(
+            port_id=port_id)
+        if switch_name:
+            query = query.filter_by(switch_name=switch_name)
+        if switch_port:
+            query = query.filter_by(switch_port=switch_port)
+        return query.delete(synchronize_session=False)
+
+
+def get_vlan_refs(context, switch_name, switch_port, segmentation_id,
+                  exclude_port_id=None):
+    """Get the ports using a vlan trunked on a switch port
+
+    :param context: The neutron context to read with
+    :param switch_name: The name of the switch in the inventory
+    :param switch_port: The switch port the vlan is trunked on
+    :param segmentation_id: The vlan
+    :param exclude_port_id: Leave this port out
+    :returns: A list of port ids
+    """
+    ref = models.VlanReference
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(ref.port_id).filter_by(
+            switch_name=switch_name, switch_port=switch_port,
+            segmentation_id=segmentation_id)
+        if exclude_port_id:
+            query = query.filter(ref.port_id != exclude_port_id)
+        return [port_id for port_id, in query]
+
+
+def add_vlan_ref_backfill(context, switch_name, switch_port,
+                          segmentation_id):
+    """Record that all the ports using a vlan on a switch port are known
+
+    :param context: The neutron context to write with
+    :param switch_name: The name of the switch in the inventory
+    :param switch_port: The switch port the vlan is trunked on
+    :param segmentation_id: The vlan
+    """
+    backfill = models.VlanReferenceBackfill
+    try:
+        with db_api.CONTEXT_WRITER.using(context):
+            query = context.session.query(backfill).filter_by(
+                switch_name=switch_name, switch_port=switch_port,
+                segmentation_id=segmentation_id)
+            if not context.session.query(query.exists()).scalar():
+                context.session.add(backfill(
+                    switch_name=switch_name, switch_port=switch_port,
+                    segmentation_id=segmentation_id))
+    except db_exc.DBDuplicateEntry:
+        pass
+
+
+def has_vlan_ref_backfill(context, switch_name, switch_port,
+                          segmentation_id):
+    """Check whether all the ports using a vlan on a switch port are known
+
+    Until then ports plugged in before references were recorded may be
+    using the vlan without a reference.
+
+    :param context: The neutron context to read with
+    :param switch_name: The name of the switch in the inventory
+    :param switch_port: The switch port the vlan is trunked on
+    :param segmentation_id: The vlan
+    :returns: True if the vlan's references have been backfilled
+    """
+    backfill = models.VlanReferenceBackfill
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(backfill).filter_by(
+            switch_name=switch_name, switch_port=switch_port,
+            segmentation_id=segmentation_id)
+        return context.session.query(query.exists()).scalar()
+
+
+def has_bound_port_with_mac(context, mac_address, physnet):
+    """Check for a bound port using a mac on a physical vlan network
+
+    This is a single query however many ports share the mac, the rows are
+    read until the first one with local link information.
+
+    :param context: The neutron context to read with
+    :param mac_address: The mac address of the ports
+    :param physnet: The physical network the port's vlan segment is on
+    :returns: Whether a port with local link information was found
+    """
+    port = models_v2.Port
+    binding = ml2_models.PortBinding
+    segment = segment_models.NetworkSegment
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(binding.profile).join(
+            port, port.id == binding.port_id).join(
+                segment, segment.network_id == port.network_id).filter(
+                    port.mac_address == mac_address,
+                    segment.physical_network == physnet,
+                    segment.network_type == 'vlan',
+                    binding.profile.like('%{}%'.format(c.LLI)))
+        for profile, in query.yield_per(10):
+            if jsonutils.loads(profile).get(c.LLI):
+                return True
+    return False
+
+
+def get_port_version(context, port_id):
+    """Get the version of what a port's switch configuration depends on
+
+    The version is the revision numbers of the port, its network and its
+    trunk, and the vlans of the trunk's subports, which don't bump the
+    trunk's revision number when they change.
+
+    :param context: The neutron context to read with
+    :param port_id: The id of the port
+    :returns: A (port_revision, network_revision, trunk_revision,
+              subport_vlans) tuple, trunk_revision is None and subport_vlans
+              is empty if the port isn't a trunk parent, or None if the port
+              doesn't exist
+    """
+    port = models_v2.Port
+    network = models_v2.Network
+    trunk = trunk_models.Trunk
+    port_attr = orm.aliased(standard_attr.StandardAttribute)
+    network_attr = orm.aliased(standard_attr.StandardAttribute)
+    trunk_attr = orm.aliased(standard_attr.StandardAttribute)
+    with db_api.CONTEXT_READER.using(context):
+        row = context.session.query(
+            port_attr.revision_number, network_attr.revision_number,
+            trunk_attr.revision_number, trunk.id).select_from(port).join(
+                port_attr, port_attr.id == port.standard_attr_id).join(
+                network, network.id == port.network_id).join(
+                network_attr, network_attr.id == network.standard_attr_id
+            ).outerjoin(
+                trunk, trunk.port_id == port.id).outerjoin(
+                trunk_attr, trunk_attr.id == trunk.standard_attr_id).filter(
+                    port.id == port_id).first()
+        if row is None:
+            return None
+        port_revision, network_revision, trunk_revision, trunk_id = row
+        subport_vlans = ()
+        if trunk_id:
+            subport = trunk_models.SubPort
+            subport_vlans = tuple(sorted(
+                vlan for vlan, in context.session.query(
+                    subport.segmentation_id).filter(
+                        subport.trunk_id == trunk_id)))
+    return port_revision, network_revision, trunk_revision, subport_vlans
+
+
+def get_network_revision(context, network_id):
+    """Get the revision number of a network
+
+    :param context: The neutron context to read with
+    :param network_id: The id of the network
+    :returns: The revision number, or None if the network doesn't exist
+    """
+    network = models_v2.Network
+    attr = standard_attr.StandardAttribute
+    with db_api.CONTEXT_READER.using(context):
+        return context.session.query(attr.revision_number).join(
+            network, network.standard_attr_id == attr.id).filter(
+                network.id == network_id).scalar()
+
+
+def has_vlan_segment(context, physnet, segmentation_id):
+    """Check whether a vlan is used by a network segment
+
+    :param context: The neutron context to read with
+    :param physnet: The physical network of the segment
+    :param segmentation_id: The vlan
+    :returns: Whether a vlan segment with the segmentation id is on physnet
+    """
+    segment = segment_models.NetworkSegment
+    with db_api.CONTEXT_READER.using(context):
+        query = context.session.query(segment.id).filter(
+            segment.physical_network == physnet,
+            segment.network_type == 'vlan',
+            segment.segmentation_id == segmentation_id)
+        return context.session.query(query.exists()).scalar()
@@ -0,0 +1,34 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from neutron.db.migration import cli
+
+"""start networking-ansible contract branch
+
+Revision ID: 3025457ef137
+Revises: start_networking_ansible
+Create Date: 2020-09-01 00:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3025457ef137'
+down_revision = 'start_networking_ansible'
+branch_labels = (cli.CONTRACT_BRANCH,)
+
+
+def upgrade():
+    pass
@@ -0,0 +1,52 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from alembic import op
+from neutron.db.migration import cli
+import sqlalchemy as sa
+
+"""add switch operation journal
+
+Revision ID: 6b42f08b0dac
+Revises: start_networking_ansible
+Create Date: 2020-09-01 00:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b42f08b0dac'
+down_revision = 'start_networking_ansible'
+branch_labels = (cli.EXPAND_BRANCH,)
+
+
+def upgrade():
+    op.create_table(
+        'ml2_ansible_journal',
+        sa.Column('seqnum', sa.BigInteger().with_variant(sa.Integer(),
+                                                         'sqlite'),
+                  primary_key=True, autoincrement=True),
+        sa.Column('object_id', sa.String(length=36), nullable=False),
+        sa.Column('switch_name', sa.String(length=255), nullable=False),
+        sa.Column('op_type', sa.String(length=36), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=True),
+        sa.Column('state', sa.String(length=16), nullable=False,
+                  index=True),
+        sa.Column('attempts', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.Column('host', sa.String(length=255), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
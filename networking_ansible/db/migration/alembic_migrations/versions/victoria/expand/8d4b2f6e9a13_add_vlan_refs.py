@@ -0,0 +1,56 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from alembic import op
+import sqlalchemy as sa
+
+"""add vlan references
+
+Revision ID: 8d4b2f6e9a13
+Revises: c3e8a1f47b20
+Create Date: 2020-10-15 00:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d4b2f6e9a13'
+down_revision = 'c3e8a1f47b20'
+
+
+def upgrade():
+    op.create_table(
+        'ml2_ansible_vlan_refs',
+        sa.Column('switch_name', sa.String(length=255), nullable=False),
+        sa.Column('switch_port', sa.String(length=255), nullable=False),
+        sa.Column('segmentation_id', sa.Integer(), nullable=False,
+                  autoincrement=False),
+        sa.Column('port_id', sa.String(length=36), nullable=False),
+        sa.ForeignKeyConstraint(['port_id'], ['ports.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('switch_name', 'switch_port',
+                                'segmentation_id', 'port_id'),
+    )
+    op.create_index(op.f('ix_ml2_ansible_vlan_refs_port_id'),
+                    'ml2_ansible_vlan_refs', ['port_id'])
+    op.create_table(
+        'ml2_ansible_vlan_ref_backfills',
+        sa.Column('switch_name', sa.String(length=255), nullable=False),
+        sa.Column('switch_port', sa.String(length=255), nullable=False),
+        sa.Column('segmentation_id', sa.Integer(), nullable=False,
+                  autoincrement=False),
+        sa.PrimaryKeyConstraint('switch_name', 'switch_port',
+                                'segmentation_id'),
+    )
@@ -0,0 +1,37 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+from alembic import op
+import sqlalchemy as sa
+
+"""add journal retry columns
+
+Revision ID: c3e8a1f47b20
+Revises: 6b42f08b0dac
+Create Date: 2020-10-01 00:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8a1f47b20'
+down_revision = '6b42f08b0dac'
+
+
+def upgrade():
+    op.add_column('ml2_ansible_journal',
+                  sa.Column('retry_at', sa.DateTime(), nullable=True))
+    op.add_column('ml2_ansible_journal',
+                  sa.Column('last_error', sa.Text(), nullable=True))
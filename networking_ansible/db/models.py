@@ -0,0 +1,82 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron_lib.db import model_base
+import sqlalchemy as sa
+
+
+class SwitchJournal(model_base.BASEV2):
+    """A switch operation waiting to be run
+
+    Rows are written in the same transaction as the neutron change that
+    needs the switch operation, so an operation can't be lost if
+    neutron-server goes away before it has been run. seqnum orders the
+    operations.
+    """
+
+    __tablename__ = 'ml2_ansible_journal'
+
+    seqnum = sa.Column(sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                       primary_key=True, autoincrement=True)
+    object_id = sa.Column(sa.String(36), nullable=False)
+    switch_name = sa.Column(sa.String(255), nullable=False)
+    op_type = sa.Column(sa.String(36), nullable=False)
+    payload = sa.Column(sa.Text, nullable=True)
+    state = sa.Column(sa.String(16), nullable=False, index=True)
+    attempts = sa.Column(sa.Integer, nullable=False, default=0,
+                         server_default='0')
+    host = sa.Column(sa.String(255), nullable=True)
+    created_at = sa.Column(sa.DateTime, nullable=False)
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+    # failed operations aren't retried before this time
+    retry_at = sa.Column(sa.DateTime, nullable=True)
+    # why the last attempt failed, kept on operations that gave up
+    last_error = sa.Column(sa.Text, nullable=True)
+
+
+class VlanReference(model_base.BASEV2):
+    """A VM port using a vlan trunked on a compute node's switch port
+
+    The vlan is only removed from the switch port's trunk once it has no
+    references left. The primary key starts with the switch port and the
+    vlan, so counting the references is a single index lookup. References
+    go away with their port.
+    """
+
+    __tablename__ = 'ml2_ansible_vlan_refs'
+
+    switch_name = sa.Column(sa.String(255), primary_key=True)
+    switch_port = sa.Column(sa.String(255), primary_key=True)
+    segmentation_id = sa.Column(sa.Integer, primary_key=True,
+                                autoincrement=False)
+    port_id = sa.Column(sa.String(36),
+                        sa.ForeignKey('ports.id', ondelete='CASCADE'),
+                        primary_key=True, index=True)
+
+
+class VlanReferenceBackfill(model_base.BASEV2):
+    """A vlan on a switch port whose references have all been recorded
+
+    Ports plugged in before references were recorded don't have any. The
+    bindings are looked through for them once per vlan on a switch port,
+    after that its references are all there is.
+    """
+
+    __tablename__ = 'ml2_ansible_vlan_ref_backfills'
+
+    switch_name = sa.Column(sa.String(255), primary_key=True)
+    switch_port = sa.Column(sa.String(255), primary_key=True)
+    segmentation_id = sa.Column(sa.Integer, primary_key=True,
+                                autoincrement=False)
@@ -30,3 +30,19 @@ class LocalLinkInfoMissingException(exceptions.NeutronException):
 
     def __init__(self, message):
         super(LocalLinkInfoMissingException, self).__init__(stdout=message)
+
+
+class SwitchLockTimeout(NetworkingAnsibleMechException):
+    def __init__(self, switch_name, timeout):
+        super(SwitchLockTimeout, self).__init__(
+            'Timed out after {timeout} seconds waiting for a lock on switch '
+            '{switch_name}'.format(timeout=timeout, switch_name=switch_name))
+        self.switch_name = switch_name
+
+
+class SwitchUnavailable(NetworkingAnsibleMechException):
+    def __init__(self, switch_name):
+        super(SwitchUnavailable, self).__init__(
+            'Switch {} is unreachable, its operations fail until it '
+            'recovers'.format(switch_name))
+        self.switch_name = switch_name
@@ -0,0 +1,193 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+import threading
+import time
+
+from oslo_log import log as logging
+
+from networking_ansible import constants as c
+from networking_ansible import exceptions
+
+LOG = logging.getLogger(__name__)
+
+UNREACHABLE = re.compile('|'.join(c.UNREACHABLE_ERRORS), re.IGNORECASE)
+
+
+def is_unreachable(error):
+    """Whether an error running a playbook means its switch is unreachable"""
+    return UNREACHABLE.search(str(error)) is not None
+
+
+class SwitchBreakers(object):
+    """Circuit breakers that stop operations on unreachable switches
+
+    A switch's breaker opens after threshold consecutive attempts to reach
+    it fail, its operations then fail straight away instead of waiting for
+    ansible to time out. Once the breaker has been open for reset_timeout
+    seconds a single operation is let through to probe the switch, the
+    breaker closes if it reaches the switch and opens again if it doesn't.
+
+    Each process publishes when it last opened and closed each breaker in
+    its capabilities in a coordination group. A breaker is in the state
+    the latest of those changes, from any process, put it in.
+    """
+
+    def __init__(self, coordinator, threshold, reset_timeout,
+                 group_id=c.BREAKER_GROUP,
+                 refresh_interval=c.BREAKER_REFRESH_INTERVAL):
+        """Create the circuit breakers
+
+        :param coordinator: The tooz coordinator to share the breakers with
+        :param threshold: The number of consecutive failures to reach a
+                          switch that open its breaker
+        :param reset_timeout: Seconds a breaker stays open before a probe
+                              is let through
+        :param group_id: The coordination group the breakers are shared in
+        :param refresh_interval: Seconds between reads of the breakers
+                                 other processes changed
+        """
+        self._coordinator = coordinator
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._group_id = group_id
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # switch_name -> consecutive failures to reach it
+        self._failures = {}
+        # switch_name -> (time, is_open) of the latest change this
+        # process made, published to the other processes
+        self._changes = {}
+        # switch_name -> (time, is_open) of the latest change any other
+        # process made
+        self._shared = {}
+        # switch_name -> when the probe running on it started
+        self._probes = {}
+        self._joined = False
+        self._refreshed = None
+
+    def check(self, switch_name):
+        """Check an operation can be run on a switch
+
+        :param switch_name: The name of the switch in the inventory
+        :raises: SwitchUnavailable if the switch's breaker is open
+        """
+        self._refresh()
+        with self._lock:
+            changed, is_open = self._get_state(switch_name)
+            if not is_open:
+                return
+            now = time.time()
+            if now - changed < self._reset_timeout:
+                raise exceptions.SwitchUnavailable(switch_name)
+            # only one probe at a time, one that never reported back is
+            # given up on
+            probe = self._probes.get(switch_name, 0)
+            if now - probe < self._reset_timeout:
+                raise exceptions.SwitchUnavailable(switch_name)
+            self._probes[switch_name] = now
+        LOG.info('Probing switch {} to see if it is reachable '
+                 'again'.format(switch_name))
+
+    def record(self, switch_name, error=None):
+        """Record the result of running an operation on a switch
+
+        :param switch_name: The name of the switch in the inventory
+        :param error: The exception the operation raised, None if it
+                      succeeded
+        """
+        if error is not None and is_unreachable(error):
+            self._record_failure(switch_name)
+        else:
+            # any answer from the switch shows it's reachable
+            self._record_success(switch_name)
+
+    def _record_success(self, switch_name):
+        with self._lock:
+            self._failures.pop(switch_name, None)
+            self._probes.pop(switch_name, None)
+            if not self._get_state(switch_name)[1]:
+                return
+            self._changes[switch_name] = (time.time(), False)
+        LOG.info('Switch {} is reachable again, closed its circuit '
+                 'breaker'.format(switch_name))
+        self._publish()
+
+    def _record_failure(self, switch_name):
+        with self._lock:
+            failures = self._failures.get(switch_name, 0) + 1
+            self._failures[switch_name] = failures
+            probed = self._probes.pop(switch_name, None) is not None
+            # a failed probe opens the breaker for another reset_timeout
+            if not probed:
+                if failures < self._threshold:
+                    return
+                if self._get_state(switch_name)[1]:
+                    return
+            self._changes[switch_name] = (time.time(), True)
+        LOG.warning('Switch {switch_name} is unreachable after {failures} '
+                    'attempts, failing its operations for {timeout} '
+                    'seconds'.format(switch_name=switch_name,
+                                     failures=failures,
+                                     timeout=self._reset_timeout))
+        self._publish()
+
+    def _get_state(self, switch_name):
+        return max(self._changes.get(switch_name, (0, False)),
+                   self._shared.get(switch_name, (0, False)))
+
+    def _publish(self):
+        with self._lock:
+            capabilities = {'breakers': {
+                switch_name: list(change)
+                for switch_name, change in self._changes.items()}}
+        try:
+            if not self._joined:
+                self._coordinator.join_group_create(self._group_id,
+                                                    capabilities)
+                self._joined = True
+            else:
+                self._coordinator.update_capabilities(
+                    self._group_id, capabilities).get()
+        except Exception as e:
+            # the other processes find out the hard way
+            LOG.warning('Failed to share circuit breakers, '
+                        'reason: {}'.format(e))
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._refreshed and now - self._refreshed < self._refresh_interval:
+            return
+        self._refreshed = now
+        shared = {}
+        try:
+            members = self._coordinator.get_members(self._group_id).get()
+            for member in members:
+                capabilities = self._coordinator.get_member_capabilities(
+                    self._group_id, member).get() or {}
+                for switch_name, change in capabilities.get(
+                        'breakers', {}).items():
+                    shared[switch_name] = max(shared.get(switch_name,
+                                                         (0, False)),
+                                              tuple(change))
+        except Exception as e:
+            # no process has opened a breaker yet or the backend is
+            # unavailable, carry on with what this process knows
+            LOG.debug('Failed to read shared circuit breakers, '
+                      'reason: {}'.format(e))
+            return
+        with self._lock:
+            self._shared = shared
@@ -0,0 +1,298 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import os
+import threading
+
+from neutron_lib import context as n_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from networking_ansible.db import api as db_api
+from networking_ansible import exceptions
+from networking_ansible.ml2 import retry
+from networking_ansible.ml2 import work_queue
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+
+class Journal(object):
+    """Run the switch operations recorded in the journal
+
+    A background thread claims the pending operations and hands them to a
+    SwitchWorkQueue, which runs the operations for each switch in the
+    order they were recorded. An operation isn't claimed until the earlier
+    operations for the same object or switch port have finished. The
+    thread runs when it is woken after an operation is recorded or
+    finished and every sync_interval seconds, which picks up operations
+    recorded by other neutron-servers and operations that failed and are
+    waiting to be retried.
+
+    With a SwitchRing only the operations for the switches this process
+    owns are claimed, the other members of the ring run the rest. The ring
+    is checked again once they're claimed, so two members can't both run
+    a switch's operations while its owner changes.
+
+    A failed operation backs off exponentially before it is retried. It is
+    left as failed, with the error that stopped it, once it has used up its
+    attempts or straight away if the error is permanent.
+    """
+
+    def __init__(self, handler, max_workers, sync_interval,
+                 processing_timeout, max_attempts, batch_size=1,
+                 batch_window=0, ring=None, retry_backoff=0,
+                 retry_backoff_max=0):
+        """Create a journal
+
+        :param handler: Called with a list of SwitchOperations for the same
+                        switch to run them, returns a list with the
+                        exception each operation raised or None
+        :param max_workers: The number of switches to run operations on
+                            in parallel
+        :param sync_interval: Seconds between checks for pending operations
+        :param processing_timeout: Seconds after which an operation claimed
+                                   by another host is run again
+        :param max_attempts: The number of times an operation is attempted
+                             before it is left as failed
+        :param batch_size: The maximum number of operations run together
+        :param batch_window: Seconds to wait for more operations before
+                             running a batch that isn't full
+        :param ring: The SwitchRing deciding which switches this process
+                     runs operations for, None runs them for all switches
+        :param retry_backoff: Seconds to wait before retrying an operation
+                              that failed once, doubled for each further
+                              failure
+        :param retry_backoff_max: The maximum number of seconds to wait
+                                  before retrying an operation
+        """
+        self._handler = handler
+        self._sync_interval = sync_interval
+        self._processing_timeout = processing_timeout
+        self._max_attempts = max_attempts
+        self._ring = ring
+        self._retry_backoff = retry_backoff
+        self._retry_backoff_max = retry_backoff_max
+        # switch_name -> the number of operations this process claimed
+        # and hasn't finished
+        self._claimed = collections.Counter()
+        self._claimed_lock = threading.Lock()
+        self._work_queue = work_queue.SwitchWorkQueue(self._run_entries,
+                                                      max_workers,
+                                                      batch_size,
+                                                      batch_window)
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    @staticmethod
+    def _owner():
+        # the api and rpc workers of a neutron-server share its host name,
+        # each claims operations for itself. It's read when it's needed
+        # since the journal is created before the workers are forked.
+        return '{}:{}'.format(CONF.host, os.getpid())
+
+    @staticmethod
+    def _get_local_pid(owner):
+        # the pid of the process on this host that claimed operations, None
+        # if another host claimed them. Operations claimed elsewhere time
+        # out instead.
+        host, _, pid = owner.rpartition(':')
+        if host != CONF.host or not pid.isdigit():
+            return None
+        return int(pid)
+
+    @staticmethod
+    def _is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _get_running_owners(self, db):
+        # the processes on this host that are running the operations they
+        # claimed, however long those wait behind a slow switch
+        owners = set()
+        for owner in db_api.get_processing_owners(db):
+            pid = self._get_local_pid(owner)
+            if pid and self._is_running(pid):
+                owners.add(owner)
+        return owners
+
+    def start(self):
+        """Resume the operations left over by this host and start syncing"""
+        # anything a process on this host was running when it went away
+        # was never completed, run it again. The other workers on the host
+        # are still running theirs.
+        db = n_context.get_admin_context()
+        count = 0
+        for owner in db_api.get_processing_owners(db):
+            pid = self._get_local_pid(owner)
+            if pid and not self._is_running(pid):
+                count += db_api.reset_processing(db, host=owner)
+        if count:
+            LOG.info('Resuming {} interrupted switch operations'.format(
+                count))
+        if self._ring:
+            self._ring.start()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='ml2-ansible-journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """Check for pending operations now"""
+        self._wake.set()
+
+    def stop(self):
+        """Stop syncing and wait for the claimed operations to finish"""
+        self._stopped = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self._work_queue.shutdown()
+        if self._ring:
+            self._ring.stop()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._sync_interval)
+            self._wake.clear()
+            if self._stopped:
+                return
+            try:
+                self.sync()
+            except Exception as e:
+                LOG.error('Failed to sync the switch operation journal, '
+                          'reason: {}'.format(e))
+
+    def sync(self):
+        """Claim the pending operations and queue them to run"""
+        db = n_context.get_admin_context()
+
+        # operations claimed by a host that has gone away
+        count = db_api.reset_processing(
+            db, timeout=self._processing_timeout,
+            exclude_hosts=self._get_running_owners(db))
+        if count:
+            LOG.warning('Resuming {} switch operations that timed '
+                        'out'.format(count))
+
+        busy = set()
+        if self._ring:
+            self._ring.refresh()
+            busy = self._get_busy_switches(db)
+
+        claimed = []
+        for entry in db_api.get_pending(db):
+            if self._ring and not self._is_runnable(entry, busy):
+                continue
+            # another server got to it first
+            if not db_api.claim(db, entry.seqnum, self._owner()):
+                continue
+            claimed.append(entry)
+
+        if self._ring and claimed:
+            claimed = self._release_moved(db, claimed)
+
+        for entry in claimed:
+            with self._claimed_lock:
+                self._claimed[entry.switch_name] += 1
+            self._work_queue.enqueue(
+                work_queue.SwitchOperation(entry.op_type,
+                                           entry.switch_name,
+                                           db_api.get_payload(entry),
+                                           seqnum=entry.seqnum,
+                                           attempts=entry.attempts))
+
+    def _release_moved(self, db, claimed):
+        # a member that joined while the operations were being claimed
+        # may own their switch now, and it doesn't wait for operations
+        # claimed after it checked which switches are busy. Those are put
+        # back for it to run.
+        self._ring.refresh()
+        owned = []
+        for entry in claimed:
+            if self._ring.owns(entry.switch_name):
+                owned.append(entry)
+                continue
+            db_api.requeue(db, entry.seqnum)
+            LOG.info('Switch {} moved to another member of the ring, '
+                     'leaving operation {} to it'.format(entry.switch_name,
+                                                         entry.seqnum))
+        return owned
+
+    def _is_runnable(self, entry, busy):
+        # the switch belongs to this process and isn't busy elsewhere
+        if entry.switch_name in busy:
+            return False
+        return self._ring.owns(entry.switch_name)
+
+    def _get_busy_switches(self, db):
+        # a switch that just moved here may still be running operations
+        # on its previous owner, the operations after them wait for them
+        # to finish so they run in order
+        processing = db_api.count_processing(db)
+        with self._claimed_lock:
+            return {switch_name for switch_name, count in processing.items()
+                    if count > self._claimed[switch_name]}
+
+    def _run_entries(self, ops):
+        db = n_context.get_admin_context()
+        try:
+            errors = self._handler(ops)
+        except Exception as e:
+            errors = [e] * len(ops)
+
+        finished = False
+        for op, error in zip(ops, errors):
+            if not error:
+                db_api.complete(db, op.seqnum)
+                finished = True
+            elif isinstance(error, (exceptions.SwitchLockTimeout,
+                                    exceptions.SwitchUnavailable)):
+                # the switch is busy or down, it's not the operation's
+                # fault
+                db_api.requeue(db, op.seqnum)
+                LOG.info('{} deferred, reason: {}'.format(op, error))
+            elif retry.is_permanent(error):
+                db_api.fail(db, op.seqnum, self._max_attempts,
+                            error=retry.describe(error), permanent=True)
+                LOG.error('{} failed, giving up, reason: {}'.format(
+                    op, error))
+                finished = True
+            else:
+                self._fail(db, op, error)
+        with self._claimed_lock:
+            self._claimed[ops[0].switch_name] -= len(ops)
+        # operations for the same ports may have been waiting for these
+        if finished:
+            self._wake.set()
+
+    def _fail(self, db, op, error):
+        delay = retry.backoff(op.attempts + 1, self._retry_backoff,
+                              self._retry_backoff_max)
+        if db_api.fail(db, op.seqnum, self._max_attempts, delay=delay,
+                       error=retry.describe(error)):
+            LOG.warning('{} failed and will be retried in {:.0f} seconds, '
+                        'reason: {}'.format(op, delay, error))
+        else:
+            LOG.error('{} failed {} times, giving up, '
+                      'reason: {}'.format(op, self._max_attempts, error))
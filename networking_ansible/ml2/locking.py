@@ -0,0 +1,166 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class HybridLock(object):
+    """A distributed lock taken by one local thread at a time
+
+    Threads in this process wait for each other on a local lock before the
+    distributed lock is taken, so only one of them at a time makes round
+    trips to the coordination backend. With a lease, the distributed lock
+    is kept for a while after it's released so the next local holder can
+    use it without taking it again. Without a coordinator only the local
+    lock is taken, for switches that a single process owns.
+    """
+
+    def __init__(self, coordinator, name, lease=0):
+        """Create a lock
+
+        :param coordinator: The tooz coordinator to take the lock with, None
+                            for a lock local to this process
+        :param name: The name of the lock, bytes
+        :param lease: Seconds the distributed lock is kept after release
+        """
+        self._coordinator = coordinator
+        self._name = name
+        self._lease = lease
+        self._local = threading.Lock()
+        # guards the distributed lock and the lease timer, which releases
+        # the distributed lock from its own thread
+        self._guard = threading.Lock()
+        self._lock = None
+        self._timer = None
+        # bumped whenever the lock changes hands, a lease timer only
+        # releases the lock it was started for
+        self._generation = 0
+
+    def acquire(self, blocking=True, timeout=None):
+        """Take the lock
+
+        :param blocking: Wait for the lock if it's held
+        :param timeout: Seconds to wait for the lock, None waits as long as
+                        it takes
+        :returns: Whether the lock was taken
+        """
+        if not blocking:
+            timeout = 0
+        deadline = None
+        if timeout is None:
+            taken = self._local.acquire()
+        else:
+            deadline = time.monotonic() + timeout
+            taken = self._local.acquire(timeout=timeout)
+        if not taken:
+            return False
+        if self._coordinator is None:
+            return True
+        try:
+            with self._guard:
+                self._generation += 1
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if self._lock is None:
+                    # tooz takes a timeout in place of blocking
+                    wait = True
+                    if deadline is not None:
+                        wait = max(deadline - time.monotonic(), 0) or False
+                    lock = self._coordinator.get_lock(self._name)
+                    if not lock.acquire(blocking=wait):
+                        self._local.release()
+                        return False
+                    self._lock = lock
+        except Exception:
+            self._local.release()
+            raise
+        return True
+
+    def release(self):
+        """Release the lock, the distributed lock is kept for the lease"""
+        if self._coordinator is None:
+            self._local.release()
+            return
+        try:
+            with self._guard:
+                self._generation += 1
+                if self._lease:
+                    self._timer = threading.Timer(self._lease, self._expire,
+                                                  args=(self._generation,))
+                    self._timer.daemon = True
+                    self._timer.start()
+                else:
+                    self._release_distributed()
+        finally:
+            self._local.release()
+
+    def _expire(self, generation):
+        with self._guard:
+            # the lock was taken again since the lease started
+            if generation != self._generation:
+                return
+            self._timer = None
+            self._release_distributed()
+
+    def _release_distributed(self):
+        lock, self._lock = self._lock, None
+        try:
+            lock.release()
+        except Exception as e:
+            # the backend releases it when our membership expires
+            LOG.warning('Failed to release lock {name}: {err}'.format(
+                name=self._name, err=e))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class LockManager(object):
+    """Hand out the HybridLock for a name, shared by this process"""
+
+    def __init__(self, coordinator, lease=0):
+        """Create a lock manager
+
+        :param coordinator: The tooz coordinator to take locks with, None
+                            for locks local to this process
+        :param lease: Seconds distributed locks are kept after release
+        """
+        self._coordinator = coordinator
+        self._lease = lease
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def get_lock(self, name):
+        """Get the lock for a name
+
+        :param name: The name of the lock, bytes
+        :returns: The HybridLock
+        """
+        with self._lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = HybridLock(self._coordinator, name, self._lease)
+                self._locks[name] = lock
+            return lock
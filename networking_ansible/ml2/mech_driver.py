@@ -14,27 +14,45 @@
 #    under the License.
 
 
+import collections
+import contextlib
 import os
+import threading
+import time
+import zlib
 
+import futurist
 from neutron.db import provisioning_blocks
 from neutron.objects.network import Network
-from neutron.objects.network import NetworkSegment
 from neutron.objects.ports import Port
 from neutron.objects.trunk import Trunk
 from neutron.plugins.ml2.common import exceptions as ml2_exc
 from neutron_lib.api.definitions import portbindings
 from neutron_lib.api.definitions import provider_net
+from neutron_lib.callbacks import events
+from neutron_lib.callbacks import registry
 from neutron_lib.callbacks import resources
+from neutron_lib import context as n_context
 from neutron_lib.plugins.ml2 import api as ml2api
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from networking_ansible import config
 from networking_ansible import constants as c
+from networking_ansible.db import api as db_api
 from networking_ansible import exceptions
+from networking_ansible.ml2 import breaker
+from networking_ansible.ml2 import journal
+from networking_ansible.ml2 import locking
+from networking_ansible.ml2 import port_state
+from networking_ansible.ml2 import retry
+from networking_ansible.ml2 import rpc
+from networking_ansible.ml2 import runner
+from networking_ansible.ml2 import sharding
+from networking_ansible.ml2 import throttle
 from networking_ansible.ml2 import trunk_driver
+from networking_ansible.ml2 import vlan_set
 
-from network_runner import api as net_runr_api
 from network_runner.models.inventory import Inventory
 
 from tooz import coordination
@@ -43,6 +61,24 @@ LOG = logging.getLogger(__name__)
 CONF = config.CONF
 
 
+class PortSnapshot(collections.namedtuple('PortSnapshot',
+                                          'port network trunk')):
+    """A port and the objects its switch configuration depends on"""
+
+    @property
+    def version(self):
+        """The version to compare with db_api.get_port_version"""
+        trunk_revision = None
+        subport_vlans = ()
+        if self.trunk:
+            trunk_revision = self.trunk.revision_number
+            subport_vlans = tuple(sorted(sp.segmentation_id
+                                         for sp in self.trunk.sub_ports))
+        return (self.port.revision_number,
+                self.network.revision_number if self.network else None,
+                trunk_revision, subport_vlans)
+
+
 class AnsibleMechanismDriver(ml2api.MechanismDriver):
     """ML2 Mechanism Driver for Ansible Networking
 
@@ -55,11 +91,13 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         # Get ML2 config
         self.ml2config = config.Config()
 
-        # Build a network runner inventory object
-        # and instatiate network runner
+        # Build a network runner inventory object, the network runner
+        # is instantiated once coordination has started
         _inv = Inventory()
         _inv.deserialize({'all': {'hosts': self.ml2config.inventory}})
-        self.net_runr = net_runr_api.NetworkRunner(_inv)
+
+        # the switch locks held by each thread
+        self._local = threading.local()
 
         # build the custom params and extra params dict.
         # this holds kwargs per host to pass to network runner
@@ -83,9 +121,96 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         self.coordinator.start(start_heart=True)
         LOG.debug("Ansible ML2 coordination started via uri %s",
                   cfg.CONF.ml2_ansible.coordination_uri)
+        # a switch owned by this process is only operated on from here,
+        # its locks don't have to be distributed
+        sharded = (CONF.ml2_ansible.switch_sharding
+                   if CONF.ml2_ansible.async_mode else False)
+        # the state last applied to each switch port. It's only known
+        # when this process is the only one configuring the switch, and
+        # is forgotten whenever switches move between processes.
+        port_state_ttl = CONF.ml2_ansible.port_state_ttl
+        if port_state_ttl and not sharded:
+            LOG.warning('port_state_ttl is ignored without switch_sharding '
+                        'in async mode, other processes configure the same '
+                        'switch ports')
+            port_state_ttl = 0
+        self.port_states = port_state.PortStateCache(port_state_ttl)
+        self.locks = locking.LockManager(
+            None if sharded else self.coordinator,
+            CONF.ml2_ansible.lock_lease)
+        # switch_name -> the number of times taking one of its locks
+        # timed out
+        self.lock_timeouts = collections.Counter()
+
+        breakers = None
+        if CONF.ml2_ansible.breaker_threshold:
+            breakers = breaker.SwitchBreakers(
+                self.coordinator,
+                CONF.ml2_ansible.breaker_threshold,
+                CONF.ml2_ansible.breaker_reset_timeout)
+        # the session limits are shared like the switch locks, the locks
+        # aren't leased so the sessions are given back straight away
+        switch_throttle = None
+        if self.ml2config.session_limits or self.ml2config.rate_limits:
+            switch_throttle = throttle.SwitchThrottle(
+                locking.LockManager(None if sharded else self.coordinator),
+                self.ml2config.session_limits,
+                self.ml2config.rate_limits)
+        # the playbooks are run by networking-ansible-agent with use_agent
+        if CONF.ml2_ansible.use_agent:
+            self.net_runr = runner.RemoteNetworkRunner(
+                _inv, rpc.AgentRunnerApi(), breakers, switch_throttle)
+        else:
+            runner.set_native_threads(CONF.ml2_ansible.runner_threads)
+            self.net_runr = runner.BatchNetworkRunner(
+                _inv, CONF.ml2_ansible.runner_threads_per_switch, breakers,
+                switch_throttle)
 
         self.trunk_driver = trunk_driver.NetAnsibleTrunkDriver.create(self)
 
+        # switch operations are journaled and run in the background in
+        # async mode, and retried in the background after transient
+        # failures with retry_sync_failures. The journal thread is started
+        # once the api and rpc workers have been forked.
+        self.journal = None
+        if CONF.ml2_ansible.async_mode or \
+                CONF.ml2_ansible.retry_sync_failures:
+            self.journal = journal.Journal(
+                self._run_operations,
+                CONF.ml2_ansible.async_workers,
+                CONF.ml2_ansible.journal_sync_interval,
+                CONF.ml2_ansible.journal_processing_timeout,
+                CONF.ml2_ansible.journal_max_attempts,
+                CONF.ml2_ansible.batch_size,
+                CONF.ml2_ansible.batch_window,
+                sharding.SwitchRing(
+                    CONF.ml2_ansible.coordination_uri,
+                    on_change=self.port_states.clear) if sharded else None,
+                retry_backoff=CONF.ml2_ansible.journal_retry_backoff,
+                retry_backoff_max=(
+                    CONF.ml2_ansible.journal_retry_backoff_max))
+            registry.subscribe(self._start_journal,
+                               resources.PROCESS,
+                               events.AFTER_INIT)
+
+    def _start_journal(self, resource, event, trigger, payload=None):
+        self.journal.start()
+
+    def create_network_precommit(self, context):
+        """Allocate resources for a new network.
+
+        :param context: NetworkContext instance describing the new
+        network.
+
+        Create a new network, allocating resources as necessary in the
+        database. Called inside transaction context on session. Call
+        cannot block.  Raising an exception will result in a rollback
+        of the current transaction.
+        """
+        # journal the switch operations with the network in async mode
+        if CONF.ml2_ansible.async_mode:
+            self._create_network(context)
+
     def create_network_postcommit(self, context):
         """Create a network.
 
@@ -97,68 +222,142 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         drastically affect performance. Raising an exception will
         cause the deletion of the resource.
         """
+        if CONF.ml2_ansible.async_mode:
+            self.journal.wake()
+            return
 
-        # assuming all hosts
-        # TODO(radez): can we filter by physnets?
-        # TODO(michchap): we should be able to do each switch in parallel
-        # if it becomes a performance issue. switch topology might also
-        # open up options for filtering.
-        for host_name in self.ml2config.inventory:
-            host = self.ml2config.inventory[host_name]
-            if host.get('manage_vlans', True):
-
-                network = context.current
-                network_id = network['id']
-                provider_type = network[provider_net.NETWORK_TYPE]
-                segmentation_id = network[provider_net.SEGMENTATION_ID]
-
-                lock = self.coordinator.get_lock(host_name)
-                with lock:
-                    if provider_type == 'vlan' and segmentation_id:
-
-                        # re-request network info in case it's stale
-                        net = Network.get_object(context._plugin_context,
-                                                 id=network_id)
-                        LOG.debug('network create object: {}'.format(net))
-
-                        # network was since deleted by user and we can discard
-                        # this request
-                        if not net:
-                            return
-
-                        # check the vlan for this request is still associated
-                        # with this network. We don't currently allow updating
-                        # the segment on a network - it's disallowed at the
-                        # neutron level for provider networks - but that could
-                        # change in the future
-                        s_ids = [s.segmentation_id for s in net.segments]
-                        if segmentation_id not in s_ids:
-                            return
-
-                        # Create VLAN on the switch
-                        try:
-                            self.net_runr.create_vlan(
-                                host_name,
-                                segmentation_id,
-                                **self.kwargs[host_name])
-                            LOG.info('Network {net_id}, segmentation '
-                                     '{seg} has been added on '
-                                     'ansible host {host}'.format(
-                                         net_id=network['id'],
-                                         seg=segmentation_id,
-                                         host=host_name))
-
-                        except Exception as e:
-                            # TODO(radez) I don't think there is a message
-                            #             returned from ansible runner's
-                            #             exceptions
-                            LOG.error('Failed to create network {net_id} '
-                                      'on ansible host: {host}, '
-                                      'reason: {err}'.format(
-                                          net_id=network_id,
-                                          host=host_name,
-                                          err=e))
-                            raise exceptions.NetworkingAnsibleMechException(e)
+        self._create_network(context)
+
+    def _create_network(self, context):
+        # vlans are created when ports are plugged in lazy mode
+        if CONF.ml2_ansible.lazy_vlans:
+            return
+
+        network = context.current
+        network_id = network['id']
+        provider_type = network[provider_net.NETWORK_TYPE]
+        segmentation_id = network[provider_net.SEGMENTATION_ID]
+        physnet = network[provider_net.PHYSICAL_NETWORK]
+
+        if provider_type != 'vlan' or not segmentation_id:
+            return
+
+        # only the switches that carry this network's physnet need the vlan
+        hosts = [host_name for host_name in
+                 self.ml2config.get_physnet_hosts(physnet)
+                 if self.ml2config.inventory[host_name].get('manage_vlans',
+                                                            True)]
+        if not hosts:
+            return
+
+        if CONF.ml2_ansible.async_mode:
+            for host_name in hosts:
+                self._record(context._plugin_context, c.OP_CREATE_VLAN,
+                             host_name, network_id,
+                             network_id=network_id,
+                             segmentation_id=segmentation_id)
+            return
+
+        # each switch is independent of the others so the vlan is created
+        # on all of them in parallel, bounded by max_workers
+        max_workers = min(len(hosts), CONF.ml2_ansible.max_workers)
+        with futurist.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(host_name,
+                        executor.submit(self._create_vlan_on_host,
+                                        host_name,
+                                        network_id,
+                                        segmentation_id))
+                       for host_name in hosts]
+
+        errors = []
+        for host_name, future in futures:
+            error = future.exception()
+            if not error:
+                continue
+            if self._should_retry(error, c.OP_CREATE_VLAN, host_name):
+                self._record(context._plugin_context, c.OP_CREATE_VLAN,
+                             host_name, network_id,
+                             network_id=network_id,
+                             segmentation_id=segmentation_id)
+                self.journal.wake()
+            else:
+                errors.append('{host}: {err}'.format(host=host_name,
+                                                     err=error))
+        if errors:
+            raise exceptions.NetworkingAnsibleMechException(
+                'Failed to create network {net_id} on ansible hosts: '
+                '{errs}'.format(net_id=network_id, errs='; '.join(errors)))
+
+    def _create_vlan_on_host(self, host_name, network_id, segmentation_id):
+        # this runs in an executor thread so it can't share the request's
+        # db session, use a context of its own instead
+        db = n_context.get_admin_context()
+
+        # re-request network info in case it's stale, it's read before
+        # locking the switch and only checked for changes once locked
+        net = Network.get_object(db, id=network_id)
+        LOG.debug('network create object: {}'.format(net))
+        if not self._has_segment(net, segmentation_id):
+            return
+
+        with self._switch_lock(host_name):
+            if db_api.get_network_revision(
+                    db, network_id) != net.revision_number:
+                net = Network.get_object(db, id=network_id)
+                if not self._has_segment(net, segmentation_id):
+                    return
+
+            # Create VLAN on the switch
+            try:
+                self.net_runr.create_vlan(host_name,
+                                          segmentation_id,
+                                          **self.kwargs[host_name])
+                LOG.info('Network {net_id}, segmentation '
+                         '{seg} has been added on '
+                         'ansible host {host}'.format(net_id=network_id,
+                                                      seg=segmentation_id,
+                                                      host=host_name))
+
+            except Exception as e:
+                # TODO(radez) I don't think there is a message
+                #             returned from ansible runner's
+                #             exceptions
+                LOG.error('Failed to create network {net_id} '
+                          'on ansible host: {host}, '
+                          'reason: {err}'.format(net_id=network_id,
+                                                 host=host_name,
+                                                 err=e))
+                raise
+
+    @staticmethod
+    def _has_segment(net, segmentation_id):
+        # network was since deleted by user and we can discard
+        # this request
+        if not net:
+            return False
+
+        # check the vlan for this request is still associated
+        # with this network. We don't currently allow updating
+        # the segment on a network - it's disallowed at the
+        # neutron level for provider networks - but that could
+        # change in the future
+        return segmentation_id in [s.segmentation_id for s in net.segments]
+
+    def delete_network_precommit(self, context):
+        """Delete resources for a network.
+
+        :param context: NetworkContext instance describing the current
+        state of the network, prior to the call to delete it.
+
+        Delete network resources previously allocated by this
+        mechanism driver for a network. Called inside transaction
+        context on session. Runtime errors are not expected, but
+        raising an exception will result in rollback of the
+        transaction.
+        """
+        # journal the switch operations with the network in async mode
+        if CONF.ml2_ansible.async_mode:
+            self._delete_network(context)
 
     def delete_network_postcommit(self, context):
         """Delete a network.
@@ -172,59 +371,112 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         expected, and will not prevent the resource from being
         deleted.
         """
+        if CONF.ml2_ansible.async_mode:
+            self.journal.wake()
+            return
 
-        # assuming all hosts
-        # TODO(radez): can we filter by physnets?
-        for host_name in self.ml2config.inventory:
+        self._delete_network(context)
+
+    def _delete_network(self, context):
+        # vlans are deleted when ports are unplugged in lazy mode
+        if CONF.ml2_ansible.lazy_vlans:
+            return
+
+        network = context.current
+        network_id = network['id']
+        provider_type = network[provider_net.NETWORK_TYPE]
+        segmentation_id = network[provider_net.SEGMENTATION_ID]
+        physnet = network[provider_net.PHYSICAL_NETWORK]
+
+        if provider_type != 'vlan' or not segmentation_id:
+            return
+
+        # only the switches that carry this network's physnet have the vlan
+        for host_name in self.ml2config.get_physnet_hosts(physnet):
             host = self.ml2config.inventory[host_name]
+            if not host.get('manage_vlans', True):
+                continue
+
+            if CONF.ml2_ansible.async_mode:
+                self._record(context._plugin_context, c.OP_DELETE_VLAN,
+                             host_name, network_id,
+                             network_id=network_id,
+                             segmentation_id=segmentation_id,
+                             physnet=physnet)
+                continue
+
+            try:
+                self._delete_vlan_on_host(context._plugin_context,
+                                          host_name,
+                                          network_id,
+                                          segmentation_id,
+                                          physnet)
+            except Exception as e:
+                if not self._should_retry(e, c.OP_DELETE_VLAN, host_name):
+                    raise
+                self._record(context._plugin_context, c.OP_DELETE_VLAN,
+                             host_name, network_id,
+                             network_id=network_id,
+                             segmentation_id=segmentation_id,
+                             physnet=physnet)
+                self.journal.wake()
+
+    def _delete_vlan_on_host(self, db, host_name, network_id,
+                             segmentation_id, physnet):
+        # Find out if this segment is active.
+        # We need to find out if this segment is being used
+        # by another network before deleting it from the switch
+        # since reordering could mean that a vlan is recycled
+        # by the time this request is satisfied. Getting
+        # the current network is not enough. It's checked before
+        # locking the switch and again once locked.
+        if self._is_vlan_recreated(db, segmentation_id, physnet):
+            return
+
+        with self._switch_lock(host_name):
+            if self._is_vlan_recreated(db, segmentation_id, physnet):
+                return
+
+            # Delete VLAN on the switch
+            try:
+                self.net_runr.delete_vlan(host_name,
+                                          segmentation_id,
+                                          **self.kwargs[host_name])
+                LOG.info('Network {net_id} has been deleted on '
+                         'ansible host {host}'.format(net_id=network_id,
+                                                      host=host_name))
+
+            except Exception as e:
+                LOG.error('Failed to delete network {net} '
+                          'on ansible host: {host}, '
+                          'reason: {err}'.format(net=network_id,
+                                                 host=host_name,
+                                                 err=e))
+                raise exceptions.NetworkingAnsibleMechException(e)
+
+    @staticmethod
+    def _is_vlan_recreated(db, segmentation_id, physnet):
+        if db_api.has_vlan_segment(db, physnet, segmentation_id):
+            LOG.debug('Not deleting segment {} from {}'
+                      'because it was recreated'.format(
+                          segmentation_id, physnet))
+            return True
+        return False
 
-            network = context.current
-            provider_type = network[provider_net.NETWORK_TYPE]
-            segmentation_id = network[provider_net.SEGMENTATION_ID]
-            physnet = network[provider_net.PHYSICAL_NETWORK]
-
-            if provider_type == 'vlan' and segmentation_id:
-                if host.get('manage_vlans', True):
-                    lock = self.coordinator.get_lock(host_name)
-                    with lock:
-                        # Find out if this segment is active.
-                        # We need to find out if this segment is being used
-                        # by another network before deleting it from the switch
-                        # since reordering could mean that a vlan is recycled
-                        # by the time this request is satisfied. Getting
-                        # the current network is not enough
-                        db = context._plugin_context
-
-                        segments = NetworkSegment.get_objects(
-                            db, segmentation_id=segmentation_id)
-
-                        for segment in segments:
-                            if segment.segmentation_id == segmentation_id and \
-                               segment.physical_network == physnet and \
-                               segment.network_type == 'vlan':
-                                LOG.debug('Not deleting segment {} from {}'
-                                          'because it was recreated'.format(
-                                              segmentation_id, physnet))
-                                return
-
-                        # Delete VLAN on the switch
-                        try:
-                            self.net_runr.delete_vlan(
-                                host_name,
-                                segmentation_id,
-                                **self.kwargs[host_name])
-                            LOG.info('Network {net_id} has been deleted on '
-                                     'ansible host {host}'.format(
-                                         net_id=network['id'],
-                                         host=host_name))
-
-                        except Exception as e:
-                            LOG.error('Failed to delete network {net} '
-                                      'on ansible host: {host}, '
-                                      'reason: {err}'.format(net=network['id'],
-                                                             host=host_name,
-                                                             err=e))
-                            raise exceptions.NetworkingAnsibleMechException(e)
+    def update_port_precommit(self, context):
+        """Update resources of a port.
+
+        :param context: PortContext instance describing the new
+        state of the port, as well as the original state prior
+        to the update_port call.
+
+        Called inside transaction context on session to complete a
+        port update as defined by this mechanism driver. Raising an
+        exception will result in rollback of the transaction.
+        """
+        # journal the switch operations with the port in async mode
+        if CONF.ml2_ansible.async_mode:
+            self._update_port(context)
 
     def update_port_postcommit(self, context):
         """Update a port.
@@ -241,11 +493,29 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         state. It is up to the mechanism driver to ignore state or
         state changes that it does not know or care about.
         """
+        if CONF.ml2_ansible.async_mode:
+            self.journal.wake()
+            return
+
+        self._update_port(context)
+
+    def _update_port(self, context):
         # Handle VM ports
         if self._is_port_normal(context.current):
+            # most updates, e.g. status or description changes, don't
+            # touch anything the switch port configuration depends on
+            if not self._is_switch_config_changed(context):
+                LOG.debug('Port {} update does not affect the switch '
+                          'configuration, ignoring'.format(
+                              context.current['id']))
+                return
+
             port = context.current
             network = context.network.current
             mappings, segmentation_id = self.get_switch_meta(port, network)
+            # the vlans are referenced again once the switch ports the
+            # port is now plugged into are configured, if any
+            db_api.delete_vlan_refs(context._plugin_context, port['id'])
 
             for switch_name, switch_port in mappings:
                 LOG.debug('Ensuring Updated port {switch_port} on network '
@@ -256,14 +526,34 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                               switch_name=switch_name,
                               segmentation_id=segmentation_id))
 
-                self.ensure_port(port, context._plugin_context,
-                                 switch_name, switch_port,
-                                 network[provider_net.PHYSICAL_NETWORK],
-                                 context,
-                                 segmentation_id)
+                if CONF.ml2_ansible.async_mode:
+                    self._record_port(context._plugin_context,
+                                      c.OP_UPDATE_PORT, port, network,
+                                      switch_name, switch_port,
+                                      segmentation_id)
+                    continue
+
+                self._ensure_port_or_retry(c.OP_UPDATE_PORT, port, network,
+                                           context, switch_name,
+                                           switch_port, segmentation_id)
         # Baremetal Operations
         elif self._is_port_bound(context.current):
             port = context.current
+            # In async mode bind_port only sets the binding, the switch
+            # port is configured once the binding has been committed and
+            # provisioning is completed when that's done
+            if CONF.ml2_ansible.async_mode:
+                if self._is_switch_config_changed(context):
+                    network = context.network.current
+                    mappings, segmentation_id = self.get_switch_meta(
+                        port, network)
+                    for switch_name, switch_port in mappings:
+                        self._record_port(context._plugin_context,
+                                          c.OP_UPDATE_PORT, port, network,
+                                          switch_name, switch_port,
+                                          segmentation_id, provision=True)
+                return
+
             provisioning_blocks.provisioning_complete(
                 context._plugin_context, port['id'], resources.PORT,
                 c.NETWORKING_ENTITY)
@@ -282,11 +572,30 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                               switch_name=switch_name,
                               segmentation_id=segmentation_id))
 
-                self.ensure_port(port, context._plugin_context,
-                                 switch_name, switch_port,
-                                 network[provider_net.PHYSICAL_NETWORK],
-                                 context,
-                                 segmentation_id)
+                if CONF.ml2_ansible.async_mode:
+                    self._record_port(context._plugin_context,
+                                      c.OP_UPDATE_PORT, port, network,
+                                      switch_name, switch_port,
+                                      segmentation_id)
+                    continue
+
+                self._ensure_port_or_retry(c.OP_UPDATE_PORT, port, network,
+                                           context, switch_name,
+                                           switch_port, segmentation_id)
+
+    def delete_port_precommit(self, context):
+        """Delete resources of a port.
+
+        :param context: PortContext instance describing the current
+        state of the port, prior to the call to delete it.
+
+        Called inside transaction context on session. Runtime errors
+        are not expected, but raising an exception will result in
+        rollback of the transaction.
+        """
+        # journal the switch operations with the port in async mode
+        if CONF.ml2_ansible.async_mode:
+            self._delete_port(context)
 
     def delete_port_postcommit(self, context):
         """Delete a port.
@@ -300,6 +609,13 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         expected, and will not prevent the resource from being
         deleted.
         """
+        if CONF.ml2_ansible.async_mode:
+            self.journal.wake()
+            return
+
+        self._delete_port(context)
+
+    def _delete_port(self, context):
         port = context.current
         network = context.network.current
 
@@ -314,11 +630,17 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                               switch_name=switch_name,
                               segmentation_id=segmentation_id))
 
-                self.ensure_port(port, context._plugin_context,
-                                 switch_name, switch_port,
-                                 network[provider_net.PHYSICAL_NETWORK],
-                                 context,
-                                 segmentation_id, delete=True)
+                if CONF.ml2_ansible.async_mode:
+                    self._record_port(context._plugin_context,
+                                      c.OP_DELETE_PORT, port, network,
+                                      switch_name, switch_port,
+                                      segmentation_id)
+                    continue
+
+                self._ensure_port_or_retry(c.OP_DELETE_PORT, port, network,
+                                           context, switch_name,
+                                           switch_port, segmentation_id,
+                                           delete=True)
 
     def bind_port(self, context):
         """Attempt to bind a port.
@@ -378,6 +700,21 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
 
         mappings, segmentation_id = self.get_switch_meta(port, network)
 
+        if CONF.ml2_ansible.async_mode:
+            # The switch can't be configured before the binding is
+            # committed, update_port_precommit journals that. Baremetal
+            # ports are bound now and provisioning is blocked until the
+            # switch port has been configured.
+            if mappings and self._is_port_baremetal(port):
+                provisioning_blocks.add_provisioning_component(
+                    context._plugin_context, port['id'], resources.PORT,
+                    c.NETWORKING_ENTITY)
+                segments = context.segments_to_bind
+                context.set_binding(segments[0][ml2api.ID],
+                                    portbindings.VIF_TYPE_OTHER,
+                                    {})
+            return
+
         for switch_name, switch_port in mappings:
 
             LOG.debug('Plugging in port {switch_port} on '
@@ -434,15 +771,19 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         # TODO What do we do if there is not a mapping available?
         #      should we fail in some way?
         host_id = port[portbindings.HOST_ID]
-        # if type direct get the pci address and append to host_id
+        # if type direct look up the switch ports of its pci device
+        pci_slot = None
         if AnsibleMechanismDriver._is_port_direct(port):
-            host_id = self._build_sriov_host_id(port, host_id)
-        mappings = self.ml2config.port_mappings.get(host_id, [])
+            profile = port.get(portbindings.PROFILE, {}) or {}
+            pci_slot = profile.get('pci_slot') or ''
+        mappings = self.ml2config.get_port_mappings(host_id, pci_slot)
         segmentation_id = network.get(provider_net.SEGMENTATION_ID, '')
         return mappings, segmentation_id
 
-    def ensure_subports(self, port_id, db):
+    def ensure_subports(self, port_id, db, removed_vlans=()):
         # set the correct state on port in the case where it has subports.
+        # removed_vlans are the vlans of the subports removed from the
+        # trunk, in lazy mode they're deleted once nothing uses them
 
         port = Port.get_object(db, id=port_id)
 
@@ -457,21 +798,333 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         mappings, segmentation_id = self.get_switch_meta(port)
 
         for switch_name, switch_port in mappings:
-            # lock switch
-            lock = self.coordinator.get_lock(switch_name)
-            with lock:
-                # get updated port from db
-                updated_port = Port.get_object(db, id=port_id)
-                if updated_port:
-                    self._set_port_state(updated_port, db,
-                                         switch_name, switch_port)
-                    return
-                else:
-                    # port delete operation will take care of deletion
-                    LOG.debug('Discarding attempt to ensure subports on a port'
-                              ' {} that was deleted after lock '
-                              'acquisition'.format(port_id))
-                    return
+            if CONF.ml2_ansible.async_mode:
+                self._record(db, c.OP_UPDATE_SUBPORTS, switch_name, port_id,
+                             port_id=port_id,
+                             switch_port=switch_port,
+                             removed_vlans=sorted(removed_vlans))
+                continue
+
+            try:
+                self._ensure_subports_on_switch(port_id, db,
+                                                switch_name, switch_port,
+                                                removed_vlans)
+            except Exception as e:
+                if not self._should_retry(e, c.OP_UPDATE_SUBPORTS,
+                                          switch_name):
+                    raise
+                self._record(db, c.OP_UPDATE_SUBPORTS, switch_name, port_id,
+                             port_id=port_id,
+                             switch_port=switch_port,
+                             removed_vlans=sorted(removed_vlans))
+                self.journal.wake()
+
+        if CONF.ml2_ansible.async_mode:
+            self.journal.wake()
+
+    def _ensure_subports_on_switch(self, port_id, db,
+                                   switch_name, switch_port,
+                                   removed_vlans=()):
+        snapshot = self._read_port(db, port_id)
+        # lock the switch port
+        with self._port_lock(switch_name, switch_port):
+            # get updated port from db
+            snapshot = self._refresh_port(db, port_id, snapshot)
+            if snapshot:
+                self._set_port_state(snapshot.port, db,
+                                     switch_name, switch_port,
+                                     snapshot=snapshot)
+                # a vlan may have been added back, or still be the vlan of
+                # another subport or of the parent port's network
+                vlans = {snapshot.network.segments[0].segmentation_id}
+                if snapshot.trunk:
+                    vlans.update(sp.segmentation_id
+                                 for sp in snapshot.trunk.sub_ports)
+                self._delete_lazy_vlans(
+                    db, switch_name, port_id,
+                    [vlan for vlan in removed_vlans if vlan not in vlans])
+            else:
+                # port delete operation will take care of deletion
+                LOG.debug('Discarding attempt to ensure subports on a port'
+                          ' {} that was deleted after lock '
+                          'acquisition'.format(port_id))
+
+    def _ensure_port_or_retry(self, op_type, port, network, context,
+                              switch_name, switch_port, segmentation_id,
+                              **kwargs):
+        try:
+            self.ensure_port(port, context._plugin_context,
+                             switch_name, switch_port,
+                             network[provider_net.PHYSICAL_NETWORK],
+                             context,
+                             segmentation_id, **kwargs)
+        except Exception as e:
+            if not self._should_retry(e, op_type, switch_name):
+                raise
+            self._record_port(context._plugin_context, op_type, port,
+                              network, switch_name, switch_port,
+                              segmentation_id)
+            self.journal.wake()
+
+    def _should_retry(self, error, op_type, switch_name):
+        """Whether to retry a failed synchronous operation in the background
+
+        With retry_sync_failures an operation that failed with a transient
+        error is journaled instead of failing the neutron API request.
+
+        :param error: The exception the operation raised
+        :param op_type: The type of operation, one of the OP_* constants
+        :param switch_name: The name of the switch in the inventory
+        :returns: True if the caller should journal the operation
+        """
+        if not CONF.ml2_ansible.retry_sync_failures:
+            return False
+        if not retry.is_transient(error):
+            return False
+        LOG.warning('{op} on {switch_name} failed, retrying it in the '
+                    'background, reason: {err}'.format(
+                        op=op_type, switch_name=switch_name,
+                        err=retry.describe(error)))
+        return True
+
+    def _record(self, db, op_type, switch_name, object_id, **payload):
+        LOG.debug('Journaling {op} on {switch_name}: {payload}'.format(
+            op=op_type, switch_name=switch_name, payload=payload))
+        db_api.record(db, op_type, switch_name, object_id, payload)
+
+    def _record_port(self, db, op_type, port, network, switch_name,
+                     switch_port, segmentation_id, provision=False):
+        self._record(db, op_type, switch_name, port['id'],
+                     port=port,
+                     switch_port=switch_port,
+                     physnet=network[provider_net.PHYSICAL_NETWORK],
+                     segmentation_id=segmentation_id,
+                     provision=provision)
+
+    def _run_operations(self, ops):
+        """Run a batch of journaled operations on a switch
+
+        The switch is locked once for the whole batch and the roles the
+        operations need are merged into a single ansible run.
+
+        :param ops: The SwitchOperations to run, all for the same switch
+        :returns: A list with the exception each operation raised or None
+        """
+        # the request that journaled the operations is long gone
+        db = n_context.get_admin_context()
+        switch_name = ops[0].switch_name
+        errors = [None] * len(ops)
+
+        # a batch can mix vlan and port operations, lock the whole switch
+        with self._switch_lock(switch_name):
+            with self.net_runr.batch() as batch:
+                for i, op in enumerate(ops):
+                    batch.owner = i
+                    try:
+                        self._run_operation(db, op)
+                    except Exception as e:
+                        # don't run half of a failed operation
+                        batch.discard(i)
+                        errors[i] = e
+            batch_errors = batch.run()
+            for i, error in batch_errors.items():
+                errors[i] = error
+            # the ports of a failed batch are in an unknown state
+            if batch_errors:
+                self.port_states.invalidate(switch_name)
+
+        for op, error in zip(ops, errors):
+            if error:
+                LOG.error('Failed to run {op}, reason: {err}'.format(
+                    op=op, err=error))
+            elif op.payload.get('provision'):
+                provisioning_blocks.provisioning_complete(
+                    db, op.payload['port']['id'], resources.PORT,
+                    c.NETWORKING_ENTITY)
+        return errors
+
+    def _run_operation(self, db, op):
+        payload = op.payload
+
+        if op.op_type == c.OP_CREATE_VLAN:
+            self._create_vlan_on_host(op.switch_name,
+                                      payload['network_id'],
+                                      payload['segmentation_id'])
+
+        elif op.op_type == c.OP_DELETE_VLAN:
+            self._delete_vlan_on_host(db, op.switch_name,
+                                      payload['network_id'],
+                                      payload['segmentation_id'],
+                                      payload['physnet'])
+
+        elif op.op_type in (c.OP_UPDATE_PORT, c.OP_DELETE_PORT):
+            self.ensure_port(payload['port'], db, op.switch_name,
+                             payload['switch_port'],
+                             payload['physnet'],
+                             None,
+                             payload['segmentation_id'],
+                             delete=op.op_type == c.OP_DELETE_PORT)
+
+        elif op.op_type == c.OP_UPDATE_SUBPORTS:
+            self._ensure_subports_on_switch(payload['port_id'], db,
+                                            op.switch_name,
+                                            payload['switch_port'],
+                                            payload.get('removed_vlans', ()))
+
+        else:
+            LOG.error('Discarding unknown switch operation {}'.format(
+                op.op_type))
+
+    @contextlib.contextmanager
+    def _switch_lock(self, switch_name):
+        """Lock a whole switch unless this thread already holds its lock
+
+        All of the switch's slots are taken so no port operations can run
+        on it. A thread holding a port lock on the switch must not ask for
+        it, the slot it holds would never be released.
+        """
+        held = self._local.__dict__.setdefault('switch_locks', set())
+        if switch_name in held:
+            yield
+            return
+
+        requested = time.monotonic()
+        deadline = self._lock_deadline(requested)
+        with contextlib.ExitStack() as stack:
+            # slots are always taken in the same order so switch locks
+            # can't deadlock each other
+            for name in self._slot_lock_names(switch_name):
+                self._acquire(stack, self.locks.get_lock(name),
+                              switch_name, deadline)
+            acquired = time.monotonic()
+            held.add(switch_name)
+            try:
+                yield
+            finally:
+                held.discard(switch_name)
+                self._log_lock_time(switch_name, requested, acquired)
+
+    @contextlib.contextmanager
+    def _port_lock(self, switch_name, switch_port):
+        """Lock a switch port unless this thread already holds its lock
+
+        One of the switch's slots is taken along with the port's lock, so
+        operations on different ports of the switch run in parallel, up to
+        max_port_operations of them. Lazy vlans are created and deleted by
+        port operations so in lazy mode the whole switch is locked.
+        """
+        local = self._local.__dict__
+        held = local.setdefault('switch_locks', set())
+        held_ports = local.setdefault('port_locks', set())
+        key = (switch_name, switch_port)
+        if switch_name in held or key in held_ports:
+            yield
+            return
+        if CONF.ml2_ansible.lazy_vlans:
+            with self._switch_lock(switch_name):
+                yield
+            return
+
+        name = '{}-port-{}'.format(switch_name, switch_port)
+        requested = time.monotonic()
+        deadline = self._lock_deadline(requested)
+        with contextlib.ExitStack() as stack:
+            self._acquire_slot(stack, switch_name, switch_port, deadline)
+            self._acquire(stack, self.locks.get_lock(name.encode()),
+                          switch_name, deadline)
+            acquired = time.monotonic()
+            held_ports.add(key)
+            try:
+                yield
+            finally:
+                held_ports.discard(key)
+                self._log_lock_time(name, requested, acquired)
+
+    def _acquire_slot(self, stack, switch_name, switch_port, deadline):
+        locks = [self.locks.get_lock(name)
+                 for name in self._slot_lock_names(switch_name)]
+        for lock in locks:
+            if lock.acquire(blocking=False):
+                stack.callback(lock.release)
+                return
+        # all the slots are busy, wait for one of them
+        lock = locks[zlib.crc32(switch_port.encode()) % len(locks)]
+        self._acquire(stack, lock, switch_name, deadline)
+
+    @staticmethod
+    def _lock_deadline(requested):
+        if not CONF.ml2_ansible.lock_timeout:
+            return None
+        return requested + CONF.ml2_ansible.lock_timeout
+
+    def _acquire(self, stack, lock, switch_name, deadline):
+        """Take a lock of a switch, it's released when the stack unwinds
+
+        :raises: SwitchLockTimeout if the lock isn't taken by the deadline
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        if not lock.acquire(timeout=timeout):
+            self.lock_timeouts[switch_name] += 1
+            LOG.warning('Timed out waiting for a lock on switch '
+                        '{switch_name}, {count} timeouts on it so '
+                        'far'.format(switch_name=switch_name,
+                                     count=self.lock_timeouts[switch_name]))
+            raise exceptions.SwitchLockTimeout(
+                switch_name, CONF.ml2_ansible.lock_timeout)
+        stack.callback(lock.release)
+
+    @staticmethod
+    def _slot_lock_names(switch_name):
+        # the first slot is named after the switch so with a single slot
+        # the switch is locked the same way servers running older versions
+        # lock it. tooz lock names are bytes
+        names = [switch_name] + [
+            '{}-slot-{}'.format(switch_name, i)
+            for i in range(1, CONF.ml2_ansible.max_port_operations)]
+        return [name.encode() for name in names]
+
+    @staticmethod
+    def _log_lock_time(name, requested, acquired):
+        LOG.debug('Lock {name} waited {wait:.3f}s, held {hold:.3f}s'.format(
+            name=name,
+            wait=acquired - requested,
+            hold=time.monotonic() - acquired))
+
+    def _read_port(self, db, port_id):
+        """Read a port and the objects its switch configuration depends on
+
+        :param db: The neutron context to read with
+        :param port_id: The id of the port
+        :returns: A PortSnapshot, or None if the port doesn't exist
+        """
+        port = Port.get_object(db, id=port_id)
+        if not port:
+            return None
+        return PortSnapshot(port,
+                            Network.get_object(db, id=port.network_id),
+                            Trunk.get_object(db, port_id=port_id))
+
+    def _refresh_port(self, db, port_id, snapshot):
+        """Re-read a port if it changed since a snapshot of it was read
+
+        Snapshots are read before locking the switch, checking their version
+        once it's locked is a lot cheaper than reading them again.
+
+        :param db: The neutron context to read with
+        :param port_id: The id of the port
+        :param snapshot: The PortSnapshot read earlier or None
+        :returns: A current PortSnapshot, or None if the port doesn't exist
+        """
+        version = db_api.get_port_version(db, port_id)
+        if version is None:
+            return None
+        if snapshot and snapshot.version == version:
+            return snapshot
+        LOG.debug('Port {} changed since it was read, reading it '
+                  'again'.format(port_id))
+        return self._read_port(db, port_id)
 
     def ensure_port(self, port, db, switch_name,
                     switch_port, physnet, port_context,
@@ -496,11 +1149,28 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                                                '{}'.format(switch_name,
                                                            port['id']))
 
-        # get dlock for the switch we're working with
-        lock = self.coordinator.get_lock(switch_name)
-        with lock:
-            # port = get the port from the db
-            updated_port = Port.get_object(db, id=port['id'])
+        # Deleting a VM port usually leaves other ports using the vlan on
+        # the compute node's trunk. Find that out before locking the
+        # switch, only the deletes that may remove the vlan need the lock.
+        # It's checked again once the lock is held.
+        if delete and self._is_port_normal(port):
+            active_ports = self._get_active_ports(db, port, switch_name,
+                                                  switch_port,
+                                                  segmentation_id)
+            if active_ports:
+                self._log_active_ports(port, segmentation_id, active_ports)
+                return
+
+        # read the port before locking the switch, once it's locked the
+        # port only needs to be read again if it changed
+        vm_delete = delete and self._is_port_normal(port)
+        snapshot = None if vm_delete else self._read_port(db, port['id'])
+
+        # get dlock for the switch port we're working with
+        with self._port_lock(switch_name, switch_port):
+            if not vm_delete:
+                snapshot = self._refresh_port(db, port['id'], snapshot)
+            updated_port = snapshot.port if snapshot else None
 
             if self._is_port_normal(port):
                 # OVS handles the port binding for the VM. There's no awareness
@@ -511,66 +1181,36 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                 # whether to do an update or delete. Since ensure port handles
                 # both the delete flag needs to be passed for VM ports.
                 if delete:
-                    # Get active ports on this port's network
+                    db_api.delete_vlan_refs(db, port['id'], switch_name,
+                                            switch_port)
                     # We should not delete the vlan from the compute node's
                     # trunk if there are other ports still using the vlan
-                    active_ports = Port.get_objects(
-                        db,
-                        network_id=port['network_id'],
-                        device_owner=c.COMPUTE_NOVA)
-
+                    active_ports = self._get_active_ports(db, port,
+                                                          switch_name,
+                                                          switch_port,
+                                                          segmentation_id)
                     LOG.debug('Active Ports: {}'.format(active_ports))
 
-                    # Get_objects can't filter by binding:host_id so we use a
-                    # python filter function to finish filtering the ports by
-                    # compute host_id
-                    def active_port_filter(db_port):
-                        for binding in db_port.bindings:
-                            host_id = port[portbindings.HOST_ID]
-                            if AnsibleMechanismDriver._is_port_direct(port):
-                                host_id = self._build_sriov_host_id(
-                                    port, host_id)
-                                db_network = Network.get_object(
-                                    db, id=db_port['network_id'])
-                                mappings, db_segid = self.get_switch_meta(
-                                    db_port, db_network)
-                                # first mapping, should be only one for DIRECT
-                                # port from (switch_name, switch_port) tuple
-                                db_switchport = mappings[0][1]
-                                if db_switchport == switch_port \
-                                    and db_segid == segmentation_id \
-                                    and db_port['id'] != port['id']:
-                                    return True
-                            else:
-                                if binding['host'] == host_id \
-                                    and db_port['id'] != port['id']:
-                                    return True
-                        # Default to false
-                        return False
-
-                    active_ports = list(filter(active_port_filter,
-                                               active_ports))
-                    LOG.debug('Filtered Active Ports: {}'.format(active_ports))
-
                     # If there are other VM's active ports on this port's
                     # network we will skip removing the vlan from the
                     # compute node's trunk port
                     if not active_ports:
-                        self.net_runr.delete_trunk_vlan(
-                            switch_name,
-                            switch_port,
-                            segmentation_id,
-                            **self.kwargs[switch_name])
+                        self._delete_trunk_vlan(switch_name,
+                                                switch_port,
+                                                segmentation_id)
+                        self._delete_lazy_vlans(db, switch_name,
+                                                port['id'],
+                                                [segmentation_id])
                     else:
-                        LOG.info('Skip removing Segmentation ID {} from '
-                                 'compute host {}. There are {} other '
-                                 'active ports using the VLAN.'.format(
-                                     segmentation_id,
-                                     port[portbindings.HOST_ID],
-                                     len(active_ports)))
+                        self._log_active_ports(port, segmentation_id,
+                                               active_ports)
 
                 else:
-                    self._set_port_state(port, db, switch_name, switch_port)
+                    self._set_port_state(port, db, switch_name, switch_port,
+                                         snapshot=snapshot)
+                    if segmentation_id:
+                        db_api.add_vlan_ref(db, switch_name, switch_port,
+                                            segmentation_id, port['id'])
 
                 return
 
@@ -578,7 +1218,8 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
             elif self._get_port_lli(updated_port):
 
                 if self._set_port_state(updated_port, db,
-                                        switch_name, switch_port):
+                                        switch_name, switch_port,
+                                        snapshot=snapshot):
                     if port_context and port_context.segments_to_bind:
                         segments = port_context.segments_to_bind
                         port_context.set_binding(segments[0][ml2api.ID],
@@ -599,8 +1240,87 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                     return
                 else:
                     self._delete_switch_port(switch_name, switch_port)
+                    # an unbound trunk parent still has its subports, their
+                    # vlans were trunked on the switch port too
+                    vlans = [segmentation_id]
+                    if snapshot and snapshot.trunk:
+                        vlans += [sp.segmentation_id
+                                  for sp in snapshot.trunk.sub_ports]
+                    self._delete_lazy_vlans(db, switch_name, port['id'],
+                                            vlans)
+
+    def _get_active_ports(self, db, port, switch_name, switch_port,
+                          segmentation_id):
+        """Get the other VM ports using a vlan on a compute node's trunk
+
+        The vlan references recorded when the ports were plugged in answer
+        this with a single lookup. The first time a vlan on a switch port
+        is looked up the bindings of the network's ports are looked
+        through as well, that finds the ports plugged in before references
+        were recorded. They're recorded then, along with the vlan having
+        been backfilled, so it's never looked through again.
+
+        :param db: The neutron context to read with
+        :param port: The VM port being deleted
+        :param switch_name: The switch the VM port is plugged into
+        :param switch_port: The switch port the VM port is plugged into
+        :param segmentation_id: The vlan of the port's network
+        :returns: The ids of the other ports
+        """
+        active_ports = db_api.get_vlan_refs(db, switch_name, switch_port,
+                                            segmentation_id,
+                                            exclude_port_id=port['id'])
+        if active_ports or db_api.has_vlan_ref_backfill(db, switch_name,
+                                                        switch_port,
+                                                        segmentation_id):
+            return active_ports
+
+        active_ports = self._find_active_ports(db, port, switch_port,
+                                               segmentation_id)
+        for port_id in active_ports:
+            db_api.add_vlan_ref(db, switch_name, switch_port,
+                                segmentation_id, port_id)
+        db_api.add_vlan_ref_backfill(db, switch_name, switch_port,
+                                     segmentation_id)
+        return active_ports
+
+    def _find_active_ports(self, db, port, switch_port, segmentation_id):
+        direct = self._is_port_direct(port)
+        # the other ports on an OVS port's compute node share its switch
+        # port, the database only has to return those
+        bindings = db_api.get_port_bindings(
+            db, port['network_id'], c.COMPUTE_NOVA,
+            segmentation_id=segmentation_id,
+            exclude_port_id=port['id'],
+            host=None if direct else port[portbindings.HOST_ID])
+        if not direct:
+            return [port_id for port_id, _, _, _ in bindings]
+
+        active_ports = []
+        for port_id, host, vnic_type, profile in bindings:
+            # SR-IOV ports on the same compute node can be plugged into
+            # different switch ports, go by the pci address
+            pci_slot = None
+            if vnic_type == portbindings.VNIC_DIRECT:
+                pci_slot = profile.get('pci_slot')
+                if not pci_slot:
+                    continue
+            mappings = self.ml2config.get_port_mappings(host, pci_slot)
+            if any(sp == switch_port for _, sp in mappings):
+                active_ports.append(port_id)
+        return active_ports
 
-    def _set_port_state(self, port, db, switch_name, switch_port):
+    @staticmethod
+    def _log_active_ports(port, segmentation_id, active_ports):
+        LOG.info('Skip removing Segmentation ID {} from '
+                 'compute host {}. There are {} other '
+                 'active ports using the VLAN.'.format(
+                     segmentation_id,
+                     port[portbindings.HOST_ID],
+                     len(active_ports)))
+
+    def _set_port_state(self, port, db, switch_name, switch_port,
+                        snapshot=None):
         if not port:
             # error
             raise ml2_exc.MechanismDriverError('Null port passed to '
@@ -620,38 +1340,76 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                                                'inventory'.format(
                                                    switch_name))
 
-        network = Network.get_object(db, id=port['network_id'])
+        if snapshot:
+            network = snapshot.network
+        else:
+            network = Network.get_object(db, id=port['network_id'])
         if not network:
             raise ml2_exc.MechanismDriverError('NetAnsible: couldnt find '
                                                'network for port '
-                                               '{}'.format(port.id))
+                                               '{}'.format(port['id']))
 
-        trunk = Trunk.get_object(db, port_id=port['id'])
+        if snapshot:
+            trunk = snapshot.trunk
+        else:
+            trunk = Trunk.get_object(db, port_id=port['id'])
 
         segmentation_id = network.segments[0].segmentation_id
         # Assign port to network
         try:
+            if CONF.ml2_ansible.lazy_vlans:
+                vlans = [segmentation_id]
+                if trunk:
+                    vlans += [sp.segmentation_id for sp in trunk.sub_ports]
+                self._create_lazy_vlans(switch_name, port['id'], vlans)
+
             if trunk:
                 sub_ports = trunk.sub_ports
-                trunked_vlans = [sp.segmentation_id for sp in sub_ports]
-                self.net_runr.conf_trunk_port(switch_name,
-                                              switch_port,
-                                              segmentation_id,
-                                              trunked_vlans,
-                                              **self.kwargs[switch_name])
+                trunked_vlans = vlan_set.VlanSet(
+                    sp.segmentation_id for sp in sub_ports)
+                state = port_state.PortState.trunk(segmentation_id,
+                                                   trunked_vlans)
+                diff = self._get_trunk_diff(
+                    self.port_states.get(switch_name, switch_port), state)
+                if self.port_states.is_applied(switch_name, switch_port,
+                                               state):
+                    self._log_port_state_skipped(switch_name, switch_port)
+                elif diff:
+                    self._update_trunk_vlans(switch_name, switch_port,
+                                             *diff)
+                    self.port_states.set(switch_name, switch_port, state)
+                else:
+                    self.net_runr.conf_trunk_port(switch_name,
+                                                  switch_port,
+                                                  segmentation_id,
+                                                  list(trunked_vlans),
+                                                  **self.kwargs[switch_name])
+                    self.port_states.set(switch_name, switch_port, state)
 
             elif self._is_port_normal(port):
-                self.net_runr.add_trunk_vlan(switch_name,
-                                             switch_port,
-                                             segmentation_id,
-                                             **self.kwargs[switch_name])
+                if self.port_states.has_trunk_vlan(switch_name, switch_port,
+                                                   segmentation_id):
+                    self._log_port_state_skipped(switch_name, switch_port)
+                else:
+                    self.net_runr.add_trunk_vlan(switch_name,
+                                                 switch_port,
+                                                 segmentation_id,
+                                                 **self.kwargs[switch_name])
+                    self.port_states.add_trunk_vlan(switch_name, switch_port,
+                                                    segmentation_id)
 
             else:
-                self.net_runr.conf_access_port(
-                    switch_name,
-                    switch_port,
-                    segmentation_id,
-                    **self.kwargs[switch_name])
+                state = port_state.PortState.access(segmentation_id)
+                if self.port_states.is_applied(switch_name, switch_port,
+                                               state):
+                    self._log_port_state_skipped(switch_name, switch_port)
+                else:
+                    self.net_runr.conf_access_port(
+                        switch_name,
+                        switch_port,
+                        segmentation_id,
+                        **self.kwargs[switch_name])
+                    self.port_states.set(switch_name, switch_port, state)
 
             LOG.info('Port {neutron_port} has been plugged into '
                      'switch port {sp} on device {switch_name}'.format(
@@ -667,18 +1425,78 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                           sp=switch_port,
                           sw=switch_name,
                           exc=e))
+            self.port_states.invalidate(switch_name, switch_port)
             raise exceptions.NetworkingAnsibleMechException(e)
 
+    @staticmethod
+    def _get_trunk_diff(applied, state):
+        """Get the vlans to add to and remove from a trunk port
+
+        :param applied: The PortState last applied to the port, or None
+        :param state: The trunk PortState the port needs
+        :returns: An (added, removed) tuple of VlanSets, or None if the
+                  whole port has to be configured
+        """
+        threshold = CONF.ml2_ansible.trunk_diff_threshold
+        # only a trunk whose every vlan is known can be patched
+        if not threshold or not applied or not applied.complete:
+            return None
+        if applied.mode != port_state.TRUNK or applied.vlan != state.vlan:
+            return None
+        added = state.trunked_vlans - applied.trunked_vlans
+        removed = applied.trunked_vlans - state.trunked_vlans
+        if len(added) + len(removed) > threshold:
+            return None
+        return added, removed
+
+    def _update_trunk_vlans(self, switch_name, switch_port, added, removed):
+        LOG.debug('Adding vlans {added} to and removing vlans {removed} from '
+                  'trunk port {switch_port} on {switch_name}'.format(
+                      added=added or 'none', removed=removed or 'none',
+                      switch_port=switch_port, switch_name=switch_name))
+        # a single ansible run however many vlans change
+        with self.net_runr.merged():
+            for vlan in added:
+                self.net_runr.add_trunk_vlan(switch_name, switch_port, vlan,
+                                             **self.kwargs[switch_name])
+            for vlan in removed:
+                self.net_runr.delete_trunk_vlan(switch_name, switch_port,
+                                                vlan,
+                                                **self.kwargs[switch_name])
+
+    def _delete_trunk_vlan(self, switch_name, switch_port, segmentation_id):
+        if self.port_states.lacks_trunk_vlan(switch_name, switch_port,
+                                             segmentation_id):
+            self._log_port_state_skipped(switch_name, switch_port)
+            return
+
+        try:
+            self.net_runr.delete_trunk_vlan(switch_name,
+                                            switch_port,
+                                            segmentation_id,
+                                            **self.kwargs[switch_name])
+        except Exception:
+            self.port_states.invalidate(switch_name, switch_port)
+            raise
+        self.port_states.delete_trunk_vlan(switch_name, switch_port,
+                                           segmentation_id)
+
     def _delete_switch_port(self, switch_name, switch_port):
         # we want to delete the physical port on the switch
         # provided since it's no longer in use
         LOG.debug('Unplugging port {switch_port} '
                   'on {switch_name}'.format(switch_port=switch_port,
                                             switch_name=switch_name))
+        state = port_state.PortState.deleted()
+        if self.port_states.is_applied(switch_name, switch_port, state):
+            self._log_port_state_skipped(switch_name, switch_port)
+            return
+
         try:
             self.net_runr.delete_port(switch_name,
                                       switch_port,
                                       **self.kwargs[switch_name])
+            self.port_states.set(switch_name, switch_port, state)
             LOG.info('Unplugged port {switch_port} '
                      'on {switch_name}'.format(switch_port=switch_port,
                                                switch_name=switch_name))
@@ -689,8 +1507,89 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                           switch_port=switch_port,
                           switch_name=switch_name,
                           exc=e))
+            self.port_states.invalidate(switch_name, switch_port)
             raise exceptions.NetworkingAnsibleMechException(e)
 
+    @staticmethod
+    def _log_port_state_skipped(switch_name, switch_port):
+        LOG.debug('Port {switch_port} on {switch_name} is already in the '
+                  'requested state, skipping'.format(switch_port=switch_port,
+                                                     switch_name=switch_name))
+
+    def _create_lazy_vlans(self, switch_name, port_id, vlans):
+        # In lazy mode the vlans a port needs are created on the switch
+        # whenever a port that uses them is plugged into it. Creating a
+        # vlan is idempotent and the other ports on it may not be
+        # configured yet, e.g. when several ports are bound at once, so
+        # it's never skipped because of them.
+        if not self.ml2config.inventory[switch_name].get('manage_vlans',
+                                                         True):
+            return
+
+        for vlan in vlans:
+            self.net_runr.create_vlan(switch_name,
+                                      vlan,
+                                      **self.kwargs[switch_name])
+            LOG.info('Segmentation {seg} has been added on ansible host '
+                     '{host} for port {port_id}'.format(seg=vlan,
+                                                        host=switch_name,
+                                                        port_id=port_id))
+
+    def _delete_lazy_vlans(self, db, switch_name, port_id, vlans):
+        # In lazy mode the vlans are deleted from the switch when the
+        # last port that uses them is unplugged from it
+        if not CONF.ml2_ansible.lazy_vlans:
+            return
+        if not self.ml2config.inventory[switch_name].get('manage_vlans',
+                                                         True):
+            return
+
+        for vlan in vlans:
+            if not vlan or self._is_vlan_in_use(db, switch_name, vlan,
+                                                port_id):
+                continue
+            try:
+                self.net_runr.delete_vlan(switch_name,
+                                          vlan,
+                                          **self.kwargs[switch_name])
+                LOG.info('Segmentation {seg} has been deleted on ansible '
+                         'host {host}'.format(seg=vlan, host=switch_name))
+            except Exception as e:
+                LOG.error('Failed to delete segmentation {seg} '
+                          'on ansible host: {host}, '
+                          'reason: {err}'.format(seg=vlan,
+                                                 host=switch_name,
+                                                 err=e))
+                raise exceptions.NetworkingAnsibleMechException(e)
+
+    def _is_vlan_in_use(self, db, switch_name, segmentation_id, port_id):
+        # Find the ports on the networks that use this vlan and check
+        # whether any port other than port_id is plugged into the switch.
+        # A port counts as plugged in as soon as it has the information
+        # needed to map it to a switch port, not just once it's bound,
+        # since it's plugged in before its binding is committed. Trunk
+        # subports come back as the parent port they're plugged in through.
+        bindings = db_api.get_vlan_port_bindings(db, segmentation_id,
+                                                 exclude_port_id=port_id)
+        for (bound_id, network_id, device_owner, host, vnic_type, vif_type,
+             profile) in bindings:
+            bound_port = {'id': bound_id,
+                          'network_id': network_id,
+                          c.DEVICE_OWNER: device_owner,
+                          portbindings.HOST_ID: host,
+                          portbindings.VNIC_TYPE: vnic_type,
+                          portbindings.VIF_TYPE: vif_type,
+                          portbindings.PROFILE: profile}
+            if not self._is_port_supported(bound_port):
+                continue
+            if self._is_port_baremetal(bound_port) and \
+                    not self._get_port_lli(bound_port):
+                continue
+            mappings, _ = self.get_switch_meta(bound_port)
+            if any(name == switch_name for name, _ in mappings):
+                return True
+        return False
+
     def _is_deleted_port_in_use(self, physnet, mac, db):
         # Go through all ports with this mac addr and find which
         # network segment they are on, which will contain physnet
@@ -708,26 +1607,7 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         # it on the physical switch, but that's an implementation
         # detail we shouldn't rely on.
 
-        # get port by mac
-        mports = Port.get_objects(db, mac_address=mac)
-
-        if len(mports) > 1:
-            # This isn't technically a problem, but it may indicate something
-            # fishy is going on
-            LOG.warn('multiple ports matching ironic '
-                     'port mac: {mac}'.format(mac=mac))
-
-        for port in mports:
-            if port.bindings:
-                lli = self._get_port_lli(port)
-                if lli:
-                    net = Network.get_object(db, id=port.network_id)
-                    if net:
-                        for seg in net.segments:
-                            if seg.physical_network == physnet and \
-                               seg.network_type == 'vlan':
-                                return True
-        return False
+        return db_api.has_bound_port_with_mac(db, mac, physnet)
 
     @staticmethod
     def _is_port_supported(port):
@@ -764,6 +1644,7 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         device_owner = port[c.DEVICE_OWNER]
         return device_owner == c.COMPUTE_NOVA
 
+    @staticmethod
     def _is_port_direct(port):
         """Return whether a port is type direct
 
@@ -797,6 +1678,30 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
         # Default: not bound
         return False
 
+    @staticmethod
+    def _is_switch_config_changed(context):
+        """Return whether a port update affects the switch configuration
+
+        :param context: The PortContext of the update
+        :returns: Whether any of the port's attributes the switch port
+                  configuration depends on changed
+        """
+        original = context.original
+        current = context.current
+        if not original:
+            return True
+
+        for attr in c.SWITCH_CONFIG_ATTRS:
+            if original.get(attr, None) != current.get(attr, None):
+                return True
+
+        original_profile = original.get(portbindings.PROFILE, None) or {}
+        current_profile = current.get(portbindings.PROFILE, None) or {}
+        for key in c.SWITCH_CONFIG_PROFILE_KEYS:
+            if original_profile.get(key) != current_profile.get(key):
+                return True
+        return False
+
     @staticmethod
     def _get_port_lli(port):
         """Return the local link info for a port
@@ -814,11 +1719,3 @@ class AnsibleMechanismDriver(ml2api.MechanismDriver):
                 return None
             local_link_info = port[portbindings.PROFILE].get(c.LLI)
         return local_link_info
-
-    @staticmethod
-    def _build_sriov_host_id(port, host_id):
-        profile = port.get(portbindings.PROFILE, {})
-        addr = profile.get('pci_slot')
-        addr = addr.split('.')[0]
-        addr = addr.replace('0000:', '')
-        return '{}-{}'.format(host_id, addr)
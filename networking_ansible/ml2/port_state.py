@@ -0,0 +1,140 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+from networking_ansible.ml2 import vlan_set
+
+ACCESS = 'access'
+TRUNK = 'trunk'
+DELETED = 'deleted'
+
+
+class PortState(collections.namedtuple(
+        'PortState', ['mode', 'vlan', 'trunked_vlans', 'complete'])):
+    """The configuration of a switch port
+
+    :param mode: ACCESS, TRUNK or DELETED
+    :param vlan: The access or native vlan
+    :param trunked_vlans: A VlanSet of the vlans trunked on the port
+    :param complete: False if only part of the port's configuration is
+                     known, e.g. vlans added to a trunk that was already
+                     configured
+    """
+
+    @classmethod
+    def access(cls, vlan):
+        return cls(ACCESS, vlan, vlan_set.VlanSet(), True)
+
+    @classmethod
+    def trunk(cls, vlan, trunked_vlans):
+        return cls(TRUNK, vlan, vlan_set.VlanSet(trunked_vlans), True)
+
+    @classmethod
+    def deleted(cls):
+        return cls(DELETED, None, vlan_set.VlanSet(), True)
+
+
+class PortStateCache(object):
+    """The state last applied to each switch port
+
+    Used to skip ansible runs that wouldn't change anything. Entries
+    expire after ttl seconds so changes made on the switch out of band
+    are eventually corrected, a ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (switch_name, switch_port) -> (PortState, time it was applied)
+        self._states = {}
+
+    def get(self, switch_name, switch_port):
+        """Return the state last applied to a switch port
+
+        :returns: A PortState or None if it isn't known
+        """
+        if not self.ttl:
+            return None
+        with self._lock:
+            entry = self._states.get((switch_name, switch_port))
+            if entry is None:
+                return None
+            state, applied = entry
+            if time.monotonic() - applied > self.ttl:
+                del self._states[(switch_name, switch_port)]
+                return None
+            return state
+
+    def set(self, switch_name, switch_port, state):
+        """Record the state applied to a switch port"""
+        if not self.ttl:
+            return
+        with self._lock:
+            self._states[(switch_name, switch_port)] = (state,
+                                                        time.monotonic())
+
+    def invalidate(self, switch_name, switch_port=None):
+        """Forget the state of a switch port, or of all of a switch's ports
+
+        Called when applying a state fails and the port is left in an
+        unknown state.
+        """
+        with self._lock:
+            if switch_port is not None:
+                self._states.pop((switch_name, switch_port), None)
+                return
+            for key in [key for key in self._states
+                        if key[0] == switch_name]:
+                del self._states[key]
+
+    def clear(self):
+        """Forget the state of every port"""
+        with self._lock:
+            self._states.clear()
+
+    def is_applied(self, switch_name, switch_port, state):
+        """Check whether a port's whole configuration is already state"""
+        return self.get(switch_name, switch_port) == state
+
+    def has_trunk_vlan(self, switch_name, switch_port, vlan):
+        """Check whether a vlan is known to be trunked on a port"""
+        state = self.get(switch_name, switch_port)
+        return bool(state) and state.mode == TRUNK and \
+            vlan in state.trunked_vlans
+
+    def lacks_trunk_vlan(self, switch_name, switch_port, vlan):
+        """Check whether a vlan is known not to be trunked on a port"""
+        state = self.get(switch_name, switch_port)
+        return bool(state) and state.complete and \
+            vlan not in state.trunked_vlans
+
+    def add_trunk_vlan(self, switch_name, switch_port, vlan):
+        """Record a vlan being added to a trunk port"""
+        state = self.get(switch_name, switch_port)
+        if not state or state.mode != TRUNK:
+            state = PortState(TRUNK, None, vlan_set.VlanSet(), False)
+        self.set(switch_name, switch_port,
+                 state._replace(trunked_vlans=state.trunked_vlans | {vlan}))
+
+    def delete_trunk_vlan(self, switch_name, switch_port, vlan):
+        """Record a vlan being removed from a trunk port"""
+        state = self.get(switch_name, switch_port)
+        if state:
+            self.set(switch_name, switch_port,
+                     state._replace(
+                         trunked_vlans=state.trunked_vlans - {vlan}))
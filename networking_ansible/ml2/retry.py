@@ -0,0 +1,93 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import random
+
+from network_runner import exceptions as net_runr_exc
+import oslo_messaging
+from tooz import coordination
+
+from networking_ansible import exceptions
+from networking_ansible.ml2 import breaker
+
+# errors from something between neutron and the switch that is expected
+# to come back, the operation can succeed if it is tried again later
+TRANSIENT_ERRORS = (exceptions.SwitchLockTimeout,
+                    exceptions.SwitchUnavailable,
+                    oslo_messaging.MessagingTimeout,
+                    coordination.ToozError)
+# errors from the switch or neutron turning the operation down, trying
+# the same operation again fails the same way
+PERMANENT_ERRORS = (net_runr_exc.NetworkRunnerException,
+                    exceptions.LocalLinkInfoMissingException)
+
+
+def _causes(error):
+    # the error and the errors it was raised while handling, the mech
+    # driver wraps the errors it gets from the runner
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def _classify(error):
+    for cause in _causes(error):
+        # an unreachable switch shows up as a failed playbook
+        if isinstance(cause, TRANSIENT_ERRORS) or breaker.is_unreachable(
+                cause):
+            return True
+        if isinstance(cause, PERMANENT_ERRORS):
+            return False
+        # a playbook that failed on an agent
+        remote_type = getattr(cause, 'exc_type', None)
+        if remote_type in [e.__name__ for e in PERMANENT_ERRORS]:
+            return False
+    return None
+
+
+def is_transient(error):
+    """Whether an error is known to go away if the operation is retried"""
+    return _classify(error) is True
+
+
+def is_permanent(error):
+    """Whether an error is known to come back if the operation is retried"""
+    return _classify(error) is False
+
+
+def describe(error):
+    """Get the message of an error to keep with an operation that failed"""
+    # MechanismDriverErrors keep their message out of str()
+    return str(error) or getattr(error, 'message', None) or repr(error)
+
+
+def backoff(attempts, base, cap):
+    """Get how long to wait before retrying an operation
+
+    The wait doubles with each failed attempt up to cap, and a random
+    half of it is jittered away so operations that failed together aren't
+    all retried together.
+
+    :param attempts: The number of times the operation has failed
+    :param base: Seconds to wait after the first failure
+    :param cap: The maximum number of seconds to wait
+    :returns: The number of seconds to wait
+    """
+    if attempts < 1 or not base:
+        return 0
+    delay = min(cap, base * 2 ** min(attempts - 1, 32))
+    return random.uniform(delay / 2, delay)
@@ -0,0 +1,69 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from network_runner.models.playbook import Playbook
+from neutron_lib import context as n_context
+from neutron_lib import rpc as n_rpc
+from oslo_config import cfg
+from oslo_log import log as logging
+import oslo_messaging
+
+from networking_ansible import constants as c
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+
+class AgentRunnerApi(object):
+    """Client side of the networking-ansible-agent rpc API
+
+    API version history:
+        1.0 - Initial version.
+    """
+
+    def __init__(self, topic=c.AGENT_TOPIC):
+        target = oslo_messaging.Target(topic=topic, version='1.0')
+        self.client = n_rpc.get_client(target)
+
+    def run_playbook(self, playbook):
+        """Run a playbook on one of the agents and wait for it to finish
+
+        :param playbook: The network_runner Playbook to run
+        :raises: oslo_messaging.RemoteError if the playbook fails
+        """
+        cctxt = self.client.prepare(
+            timeout=CONF.ml2_ansible.agent_timeout)
+        cctxt.call(n_context.get_admin_context(), 'run_playbook',
+                   playbook=playbook.serialize())
+
+
+class AgentRunnerEndpoint(object):
+    """Agent side of the networking-ansible-agent rpc API"""
+
+    target = oslo_messaging.Target(version='1.0')
+
+    def __init__(self, runner):
+        """Create the endpoint
+
+        :param runner: The NetworkRunner holding the switch inventory
+        """
+        self.runner = runner
+
+    def run_playbook(self, context, playbook):
+        pb = Playbook()
+        pb.deserialize(playbook)
+        LOG.debug('Running playbook {}'.format(playbook))
+        # the ansible result can't be sent back, failures raise
+        self.runner.run(pb)
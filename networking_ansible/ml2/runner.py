@@ -0,0 +1,252 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import threading
+
+from eventlet import patcher
+from eventlet import tpool
+from network_runner import api as net_runr_api
+from network_runner.models.playbook import Playbook
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def set_native_threads(count):
+    """Set the size of the native thread pool playbooks are run in
+
+    Only takes effect before the first playbook is run.
+    """
+    tpool.set_num_threads(count)
+
+
+class RunnerBatch(object):
+    """Roles recorded to run together in a single playbook
+
+    Each recorded role belongs to the owner that was set when it was
+    recorded, so the result of running the batch can be mapped back to
+    the operations that asked for the roles.
+    """
+
+    def __init__(self, runner):
+        self._runner = runner
+        self.owner = None
+        self.tasks = []
+
+    def add(self, tasks_from, hosts, variables):
+        self.tasks.append((self.owner, tasks_from, hosts, variables))
+
+    def discard(self, owner):
+        """Forget the roles recorded for an owner"""
+        self.tasks = [task for task in self.tasks if task[0] != owner]
+
+    def owners(self):
+        owners = []
+        for owner, _, _, _ in self.tasks:
+            if owner not in owners:
+                owners.append(owner)
+        return owners
+
+    def run(self):
+        """Run the recorded roles
+
+        The roles are run in the order they were recorded in a single
+        playbook. If the playbook fails the roles of each owner are run
+        again in their own playbook so the failure can be attributed to
+        the owners it belongs to.
+
+        :returns: A dict of owner to the exception its roles raised
+        """
+        owners = self.owners()
+        if not owners:
+            return {}
+
+        try:
+            self._runner.run(self._playbook(self.tasks))
+            return {}
+        except Exception as e:
+            if len(owners) == 1:
+                return {owners[0]: e}
+            LOG.warning('Batch of {} operations failed, running them one '
+                        'at a time, reason: {}'.format(len(owners), e))
+
+        errors = {}
+        for owner in owners:
+            tasks = [task for task in self.tasks if task[0] == owner]
+            try:
+                self._runner.run(self._playbook(tasks))
+            except Exception as e:
+                errors[owner] = e
+        return errors
+
+    @staticmethod
+    def _playbook(tasks):
+        pb = Playbook()
+        play = None
+        for _, tasks_from, hosts, variables in tasks:
+            # consecutive roles for the same hosts share a play
+            if play is None or play.hosts != hosts:
+                play = pb.new(hosts=hosts, gather_facts=False)
+            task = play.tasks.new(action=net_runr_api.IMPORT_ROLE)
+            task.args = {'name': net_runr_api.NETWORK_RUNNER,
+                         'tasks_from': tasks_from}
+            if variables:
+                task.vars = variables
+        return pb
+
+
+class BatchNetworkRunner(net_runr_api.NetworkRunner):
+    """NetworkRunner that can merge its plays into one ansible run
+
+    Inside batch() the plays a thread asks for are recorded instead of
+    being run, they are run together when RunnerBatch.run is called.
+    Other threads are not affected.
+
+    Running a playbook blocks on ansible-runner, its subprocesses and the
+    ssh connections to the switches. Under eventlet that would stall every
+    greenthread of the process, so playbooks are run in eventlet's pool of
+    native threads instead.
+    """
+
+    def __init__(self, inventory=None, threads_per_switch=0, breakers=None,
+                 throttle=None):
+        """Create a runner
+
+        :param inventory: The network_runner Inventory of the switches
+        :param threads_per_switch: The maximum number of playbooks run on
+                                   a switch at the same time, 0 doesn't
+                                   limit them
+        :param breakers: The SwitchBreakers that stop playbooks from being
+                         run on unreachable switches, None runs them all
+        :param throttle: The SwitchThrottle limiting the sessions opened on
+                         the switches, None doesn't limit them
+        """
+        super(BatchNetworkRunner, self).__init__(inventory)
+        self._local = threading.local()
+        self._threads_per_switch = threads_per_switch
+        self._breakers = breakers
+        self._throttle = throttle
+        self._switch_slots = {}
+        self._switch_slots_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Record the plays run by this thread
+
+        :returns: The RunnerBatch the plays are recorded in
+        """
+        batch = RunnerBatch(self)
+        self._local.batch = batch
+        try:
+            yield batch
+        finally:
+            self._local.batch = None
+
+    @contextlib.contextmanager
+    def merged(self):
+        """Run the plays this thread asks for together in one playbook
+
+        Inside batch() the plays join the batch. Otherwise they are
+        recorded and run when the block exits.
+
+        :raises: The error the playbook failed with
+        """
+        if getattr(self._local, 'batch', None) is not None:
+            yield
+            return
+        with self.batch() as batch:
+            yield
+        errors = batch.run()
+        if errors:
+            raise errors[None]
+
+    def play(self, tasks_from, hosts=None, variables=None):
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            return super(BatchNetworkRunner, self).play(tasks_from,
+                                                        hosts=hosts,
+                                                        variables=variables)
+        batch.add(tasks_from, hosts or net_runr_api.ALL, variables)
+
+    def run(self, playbook):
+        # sorted so runs on several switches can't deadlock
+        hosts = sorted({play.hosts for play in playbook})
+        if self._breakers:
+            # fail fast instead of waiting for ansible to time out
+            for host in hosts:
+                self._breakers.check(host)
+        with contextlib.ExitStack() as stack:
+            for host in hosts:
+                slot = self._get_switch_slot(host)
+                if slot:
+                    stack.enter_context(slot)
+                if self._throttle:
+                    stack.enter_context(self._throttle.session(host))
+            try:
+                result = self._execute(playbook)
+            except Exception as e:
+                self._record_result(hosts, e)
+                raise
+        self._record_result(hosts)
+        return result
+
+    def _execute(self, playbook):
+        if patcher.is_monkey_patched('thread'):
+            return tpool.execute(
+                super(BatchNetworkRunner, self).run, playbook)
+        # threads are native already
+        return super(BatchNetworkRunner, self).run(playbook)
+
+    def _record_result(self, hosts, error=None):
+        if self._breakers:
+            for host in hosts:
+                self._breakers.record(host, error)
+
+    def _get_switch_slot(self, host):
+        if not self._threads_per_switch:
+            return None
+        with self._switch_slots_lock:
+            slot = self._switch_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self._threads_per_switch)
+                self._switch_slots[host] = slot
+            return slot
+
+
+class RemoteNetworkRunner(BatchNetworkRunner):
+    """BatchNetworkRunner that runs its playbooks in an agent
+
+    The inventory is still used to check which switches exist, the
+    playbooks are sent to a networking-ansible-agent to be run.
+    """
+
+    def __init__(self, inventory, api, breakers=None, throttle=None):
+        """Create a runner
+
+        :param inventory: The network_runner Inventory of the switches
+        :param api: The AgentRunnerApi to send playbooks with
+        :param breakers: The SwitchBreakers that stop playbooks from being
+                         sent for unreachable switches, None sends them all
+        :param throttle: The SwitchThrottle limiting the sessions opened on
+                         the switches, None doesn't limit them
+        """
+        super(RemoteNetworkRunner, self).__init__(inventory,
+                                                  breakers=breakers,
+                                                  throttle=throttle)
+        self._api = api
+
+    def _execute(self, playbook):
+        self._api.run_playbook(playbook)
@@ -0,0 +1,105 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from tooz import coordination
+
+from networking_ansible import constants as c
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+
+class SwitchRing(object):
+    """Give each switch an owner from the members of a coordination group
+
+    The members of the group are placed on a consistent hash ring and each
+    switch belongs to the member its name hashes to. When a member joins or
+    its heartbeat expires only the switches that hash next to it move.
+
+    Each process joins the group with a coordinator of its own, created
+    when it starts, so the api and rpc workers forked from a
+    neutron-server are separate members.
+    """
+
+    def __init__(self, coordination_uri, group_id=c.SWITCH_GROUP,
+                 on_change=None, member_id=None):
+        """Create a switch ring
+
+        :param coordination_uri: The tooz backend to join the group on
+        :param group_id: The coordination group the switches are shared
+                         across
+        :param on_change: Called when the members change, switches may have
+                          moved to or from this process
+        :param member_id: The id this process joins the group with, by
+                          default its host name and pid
+        """
+        self._coordination_uri = coordination_uri
+        self._group_id = group_id
+        self._on_change = on_change
+        self._member_id = member_id
+        self._coordinator = None
+        self._partitioner = None
+        self._members = frozenset()
+
+    def start(self):
+        """Join the group, this process starts owning switches"""
+        # read when the ring starts, after the workers are forked
+        member_id = self._member_id or '{}-{}'.format(
+            CONF.host, os.getpid()).encode()
+        self._coordinator = coordination.get_coordinator(
+            self._coordination_uri, member_id)
+        self._coordinator.start(start_heart=True)
+        self._partitioner = self._coordinator.join_partitioned_group(
+            self._group_id)
+        self._members = self._get_members()
+        LOG.info('Joined switch group {group} with {count} members'.format(
+            group=self._group_id, count=len(self._members)))
+
+    def stop(self):
+        """Leave the group, its switches move to the other members"""
+        if self._partitioner:
+            self._coordinator.leave_partitioned_group(self._partitioner)
+            self._partitioner = None
+        if self._coordinator:
+            self._coordinator.stop()
+            self._coordinator = None
+
+    def refresh(self):
+        """Pick up the members that joined or left the group"""
+        self._coordinator.run_watchers()
+        members = self._get_members()
+        if members != self._members:
+            LOG.info('Switch group {group} changed from {old} to {new} '
+                     'members, rebalancing switches'.format(
+                         group=self._group_id, old=len(self._members),
+                         new=len(members)))
+            self._members = members
+            if self._on_change:
+                self._on_change()
+
+    def owns(self, switch_name):
+        """Whether this process owns a switch
+
+        :param switch_name: The name of the switch in the inventory
+        :returns: True if this process runs the switch's operations
+        """
+        return self._partitioner.belongs_to_self(switch_name)
+
+    def _get_members(self):
+        return frozenset(self._partitioner.ring.nodes)
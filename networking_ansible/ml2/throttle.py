@@ -0,0 +1,115 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import random
+import threading
+import time
+
+from oslo_log import log as logging
+
+from networking_ansible import constants as c
+
+LOG = logging.getLogger(__name__)
+
+
+class SwitchThrottle(object):
+    """Limit the sessions opened on each switch across processes
+
+    Some switches can't cope with more than a few CLI sessions at a time.
+    A switch with a session limit has that many session locks, a session
+    is only opened while one of them is held. A switch with a rate limit
+    has a rate lock that is held for 1 / ops_per_second seconds each time
+    a session is opened, so sessions are opened no faster than that
+    whichever process opens them. Callers wait for their turn, they never
+    fail because a switch is busy.
+    """
+
+    def __init__(self, locks, session_limits, rate_limits,
+                 poll_interval=c.THROTTLE_POLL_INTERVAL,
+                 max_poll_interval=c.THROTTLE_MAX_POLL_INTERVAL):
+        """Create a throttle
+
+        :param locks: The LockManager the session and rate locks are taken
+                      from, its locks are distributed to share the limits
+                      across processes
+        :param session_limits: A dict of switch name to the maximum number
+                               of sessions open on it at the same time
+        :param rate_limits: A dict of switch name to the maximum number of
+                            sessions opened on it per second
+        :param poll_interval: Seconds the first wait for a free session
+                              lasts, doubled for each further wait
+        :param max_poll_interval: The maximum number of seconds a wait for
+                                  a free session lasts
+        """
+        self._locks = locks
+        self._session_limits = session_limits
+        self._rate_limits = rate_limits
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+
+    @contextlib.contextmanager
+    def session(self, switch_name):
+        """Wait until a session can be opened on a switch and hold it
+
+        :param switch_name: The name of the switch in the inventory
+        """
+        with contextlib.ExitStack() as stack:
+            limit = self._session_limits.get(switch_name)
+            if limit:
+                stack.callback(self._take_session(switch_name, limit).release)
+            rate = self._rate_limits.get(switch_name)
+            if rate:
+                self._take_token(switch_name, rate)
+            yield
+
+    def _take_session(self, switch_name, limit):
+        locks = [self._locks.get_lock(
+            '{}-session-{}'.format(switch_name, i).encode())
+            for i in range(limit)]
+        requested = time.monotonic()
+        interval = self._poll_interval
+        while True:
+            # start at a random slot so waiters don't all go for the
+            # same one
+            start = random.randrange(limit)
+            locks = locks[start:] + locks[:start]
+            for lock in locks:
+                if lock.acquire(blocking=False):
+                    self._log_wait(switch_name, requested)
+                    return lock
+            # wait on a single slot instead of checking every slot again,
+            # for longer each time and with jitter so the waiters spread
+            # out rather than checking the slots together
+            if locks[0].acquire(timeout=random.uniform(interval / 2,
+                                                       interval)):
+                self._log_wait(switch_name, requested)
+                return locks[0]
+            interval = min(interval * 2, self._max_poll_interval)
+
+    def _log_wait(self, switch_name, requested):
+        wait = time.monotonic() - requested
+        if wait >= self._poll_interval:
+            LOG.debug('Waited {wait:.3f}s for a session on switch '
+                      '{switch}'.format(wait=wait, switch=switch_name))
+
+    def _take_token(self, switch_name, rate):
+        lock = self._locks.get_lock('{}-rate'.format(switch_name).encode())
+        lock.acquire()
+        # the lock is the token, the next session can be opened once it is
+        # given back
+        timer = threading.Timer(1.0 / rate, lock.release)
+        timer.daemon = True
+        timer.start()
@@ -14,11 +14,13 @@
 #    under the License.
 
 
+import collections
+import threading
+
 from neutron_lib.api.definitions import portbindings
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
 from neutron_lib.callbacks import resources
-from neutron_lib.db import api as db_api
 from neutron_lib.services.trunk import constants as trunk_consts
 from oslo_config import cfg
 from oslo_log import log
@@ -42,27 +44,100 @@ SUPPORTED_SEGMENTATION_TYPES = (
 )
 
 
+# the states of a trunk whose subport changes are debounced
+TRUNK_PENDING = 'pending'
+TRUNK_RUNNING = 'running'
+TRUNK_DIRTY = 'dirty'
+
+
 class NetAnsibleTrunkHandler(object):
-    def __init__(self, plugin_driver):
+    """Apply a trunk's subports to its parent port's switch port
+
+    With a debounce window the subports are applied that many seconds
+    after the first change instead of once for every change. The changes
+    made while they are being applied are collapsed into a single
+    follow-up, which reads the trunk's subports from the database so it
+    applies the final set. The vlans of the subports removed in the
+    meantime are kept, they're deleted from the switch in lazy mode.
+    """
+
+    def __init__(self, plugin_driver, debounce_window=0):
         self.plugin_driver = plugin_driver
+        self._debounce_window = debounce_window
+        self._lock = threading.Lock()
+        # parent port id -> TRUNK_* state, trunks without changes waiting
+        # to be applied aren't in it
+        self._trunks = {}
+        # parent port id -> the number of changes since it was applied
+        self._changes = collections.Counter()
+        # parent port id -> the vlans of the subports removed since
+        self._removed_vlans = collections.defaultdict(set)
 
     def subports_added(self, resource, event, trunk_plugin, payload):
         LOG.debug("NetAnsible: subports added %s to trunk %s",
                   payload.subports, payload.current_trunk)
-
-        context = n_context.get_admin_context()
-        with db_api.CONTEXT_READER.using(context):
-            self.plugin_driver.ensure_subports(payload.current_trunk.port_id,
-                                               context)
+        self._subports_changed(payload.current_trunk.port_id, ())
 
     def subports_deleted(self, resource, event, trunk_plugin, payload):
         LOG.debug("NetAnsible: subports deleted %s from trunk %s",
                   payload.subports, payload.original_trunk)
-
+        self._subports_changed(payload.original_trunk.port_id,
+                               [sp.segmentation_id
+                                for sp in payload.subports])
+
+    def _subports_changed(self, port_id, removed_vlans):
+        if not self._debounce_window:
+            self._ensure_subports(port_id, removed_vlans)
+            return
+
+        with self._lock:
+            self._changes[port_id] += 1
+            self._removed_vlans[port_id].update(removed_vlans)
+            state = self._trunks.get(port_id)
+            if state == TRUNK_RUNNING:
+                # apply again once the running apply is done
+                self._trunks[port_id] = TRUNK_DIRTY
+            if state:
+                return
+            self._trunks[port_id] = TRUNK_PENDING
+        self._schedule(port_id)
+
+    def _schedule(self, port_id):
+        timer = threading.Timer(self._debounce_window, self._apply,
+                                args=(port_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _apply(self, port_id):
+        with self._lock:
+            self._trunks[port_id] = TRUNK_RUNNING
+            changes = self._changes.pop(port_id, 0)
+            removed_vlans = self._removed_vlans.pop(port_id, set())
+        LOG.debug('Applying {changes} subport changes to trunk parent '
+                  'port {port_id}'.format(changes=changes, port_id=port_id))
+        try:
+            self._ensure_subports(port_id, removed_vlans)
+        except Exception as e:
+            LOG.error('Failed to apply the subports of trunk parent port '
+                      '{port_id}, reason: {err}'.format(port_id=port_id,
+                                                        err=e))
+        finally:
+            with self._lock:
+                follow_up = self._trunks[port_id] == TRUNK_DIRTY
+                if follow_up:
+                    self._trunks[port_id] = TRUNK_PENDING
+                else:
+                    del self._trunks[port_id]
+            if follow_up:
+                self._schedule(port_id)
+
+    def _ensure_subports(self, port_id, removed_vlans):
+        # no transaction is held around it, ensure_subports reads the port
+        # again once the switch port is locked and journals operations in
+        # async mode, which needs a writer
         context = n_context.get_admin_context()
-        with db_api.CONTEXT_READER.using(context):
-            self.plugin_driver.ensure_subports(payload.original_trunk.port_id,
-                                               context)
+        self.plugin_driver.ensure_subports(port_id, context,
+                                           removed_vlans=removed_vlans)
 
 
 class NetAnsibleTrunkDriver(trunk_base.DriverBase):
@@ -77,7 +152,8 @@ class NetAnsibleTrunkDriver(trunk_base.DriverBase):
     def register(self, resource, event, trigger, payload=None):
         super(NetAnsibleTrunkDriver, self).register(
             resource, event, trigger, payload=payload)
-        self._handler = NetAnsibleTrunkHandler(self.plugin_driver)
+        self._handler = NetAnsibleTrunkHandler(
+            self.plugin_driver, cfg.CONF.ml2_ansible.trunk_debounce_window)
 
         registry.subscribe(self._handler.subports_added,
                            resources.SUBPORTS,
@@ -0,0 +1,161 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+MIN_VLAN = 0
+MAX_VLAN = 4095
+
+
+class VlanSet(object):
+    """An immutable set of vlan ids kept as a 4096 bit bitmap
+
+    Union, difference and comparison of two sets are single integer
+    operations however many vlans they hold, and the set is rendered as
+    canonical ranges, e.g. 100-140,200,300-310. Iterating yields the vlans
+    in ascending order.
+    """
+
+    __slots__ = ('_bits',)
+
+    def __init__(self, vlans=()):
+        """Create a vlan set
+
+        :param vlans: An iterable of vlan ids or another VlanSet
+        :raises: ValueError if a vlan id is out of range
+        """
+        if isinstance(vlans, VlanSet):
+            bits = vlans._bits
+        else:
+            bits = 0
+            for vlan in vlans:
+                bits |= 1 << self._check(vlan)
+        object.__setattr__(self, '_bits', bits)
+
+    @staticmethod
+    def _check(vlan):
+        vlan = int(vlan)
+        if not MIN_VLAN <= vlan <= MAX_VLAN:
+            raise ValueError('vlan {} is not between {} and {}'.format(
+                vlan, MIN_VLAN, MAX_VLAN))
+        return vlan
+
+    @classmethod
+    def _from_bits(cls, bits):
+        vlan_set = cls.__new__(cls)
+        object.__setattr__(vlan_set, '_bits', bits)
+        return vlan_set
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Parse a range string such as 100-140,200,300-310
+
+        :raises: ValueError if the string isn't a valid list of ranges
+        """
+        bits = 0
+        for item in ranges.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            first, sep, last = item.partition('-')
+            first = cls._check(first)
+            last = cls._check(last) if sep else first
+            if last < first:
+                raise ValueError('vlan range {} is reversed'.format(item))
+            bits |= ((1 << (last - first + 1)) - 1) << first
+        return cls._from_bits(bits)
+
+    def ranges(self):
+        """Return the (first, last) vlan ranges of the set in order"""
+        result = []
+        bits = self._bits
+        while bits:
+            first = (bits & -bits).bit_length() - 1
+            # the run of set bits starting at first
+            run = bits >> first
+            length = (~run & (run + 1)).bit_length() - 1
+            result.append((first, first + length - 1))
+            bits &= ~(((1 << length) - 1) << first)
+        return result
+
+    def _coerce(self, other):
+        if isinstance(other, VlanSet):
+            return other
+        return VlanSet(other)
+
+    def __or__(self, other):
+        return self._from_bits(self._bits | self._coerce(other)._bits)
+
+    def __and__(self, other):
+        return self._from_bits(self._bits & self._coerce(other)._bits)
+
+    def __sub__(self, other):
+        return self._from_bits(self._bits & ~self._coerce(other)._bits)
+
+    def __xor__(self, other):
+        return self._from_bits(self._bits ^ self._coerce(other)._bits)
+
+    __ror__ = __or__
+    __rand__ = __and__
+    __rxor__ = __xor__
+
+    def __rsub__(self, other):
+        return self._coerce(other) - self
+
+    def __eq__(self, other):
+        if not isinstance(other, VlanSet):
+            return NotImplemented
+        return self._bits == other._bits
+
+    def __ne__(self, other):
+        if not isinstance(other, VlanSet):
+            return NotImplemented
+        return self._bits != other._bits
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def __contains__(self, vlan):
+        try:
+            return bool(self._bits >> int(vlan) & 1)
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        bits = self._bits
+        while bits:
+            lowest = bits & -bits
+            yield lowest.bit_length() - 1
+            bits ^= lowest
+
+    def __len__(self):
+        return bin(self._bits).count('1')
+
+    def __bool__(self):
+        return bool(self._bits)
+
+    __nonzero__ = __bool__
+
+    def __setattr__(self, name, value):
+        raise AttributeError('VlanSet is immutable')
+
+    def __reduce__(self):
+        return (VlanSet.from_ranges, (str(self),))
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else
+                        '{}-{}'.format(first, last)
+                        for first, last in self.ranges())
+
+    def __repr__(self):
+        return 'VlanSet({!r})'.format(str(self))
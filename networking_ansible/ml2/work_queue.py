@@ -0,0 +1,133 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+import futurist
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class SwitchOperation(object):
+    """An operation queued to run against a switch
+
+    :param op_type: The type of operation, one of the OP_* constants
+    :param switch_name: The name of the switch in the inventory
+    :param payload: A dict of the values the operation needs to run
+    :param seqnum: The seqnum of the operation in the journal
+    :param attempts: The number of times the operation has already failed
+    """
+
+    def __init__(self, op_type, switch_name, payload, seqnum=None,
+                 attempts=0):
+        self.op_type = op_type
+        self.switch_name = switch_name
+        self.payload = payload
+        self.seqnum = seqnum
+        self.attempts = attempts
+
+    def __repr__(self):
+        return 'SwitchOperation({}, {}, {})'.format(self.op_type,
+                                                    self.switch_name,
+                                                    self.payload)
+
+
+class SwitchWorkQueue(object):
+    """Run switch operations in the background
+
+    Operations for a switch are run in batches in the order they were
+    queued, one batch at a time. Operations for different switches are run
+    in parallel by a pool of workers.
+    """
+
+    def __init__(self, handler, max_workers, batch_size=1, batch_window=0):
+        """Create a work queue
+
+        :param handler: Called with a list of SwitchOperations for the same
+                        switch to run them
+        :param max_workers: The number of switches to run operations on
+                            in parallel
+        :param batch_size: The maximum number of operations passed to the
+                           handler at once
+        :param batch_window: Seconds to wait for more operations to be
+                             queued before running a batch that isn't full
+        """
+        self._handler = handler
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+        self._executor = futurist.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        # switch_name -> deque of operations, a switch has an entry here
+        # while a worker is draining its operations
+        self._queues = {}
+
+    def enqueue(self, op):
+        """Queue an operation to run against its switch
+
+        :param op: The SwitchOperation to queue
+        """
+        with self._lock:
+            queue = self._queues.get(op.switch_name)
+            if queue is not None:
+                # a worker is already draining this switch
+                queue.append(op)
+                return
+            self._queues[op.switch_name] = collections.deque([op])
+        self._executor.submit(self._drain, op.switch_name)
+
+    def _drain(self, switch_name):
+        while True:
+            if self._batch_window:
+                with self._lock:
+                    short = len(self._queues[switch_name]) < self._batch_size
+                # give the operations that arrive close together a chance
+                # to share a batch
+                if short:
+                    time.sleep(self._batch_window)
+
+            with self._lock:
+                queue = self._queues[switch_name]
+                if not queue:
+                    del self._queues[switch_name]
+                    return
+                ops = [queue.popleft()
+                       for _ in range(min(len(queue), self._batch_size))]
+
+            try:
+                self._handler(ops)
+            except Exception as e:
+                LOG.error('Failed to run {ops}, reason: {err}'.format(ops=ops,
+                                                                      err=e))
+
+    def pending(self, switch_name=None):
+        """Return the number of operations waiting to run
+
+        :param switch_name: Only count the operations for this switch
+        :returns: The number of operations
+        """
+        with self._lock:
+            if switch_name:
+                return len(self._queues.get(switch_name, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def shutdown(self, wait=True):
+        """Stop accepting operations
+
+        :param wait: Wait for the queued operations to finish running
+        """
+        self._executor.shutdown(wait=wait)
@@ -50,11 +50,22 @@ def patch_neutron_quotas():
         mock.patch(func).start()
 
 
-class MockConfig(object):
+class MockConfig(config.Config):
     def __init__(self, host=None, mac=None):
         self.inventory = {host: {'mac': mac}} if host and mac else {}
         self.mac_map = {}
         self.port_mappings = {}
+        self.physnet_map = {}
+        self.any_physnet_hosts = list(self.inventory)
+        self.session_limits = {}
+        self.rate_limits = {}
+
+    def add_host(self, host, physnets=None, **kwargs):
+        self.inventory[host] = kwargs
+        for physnet in physnets or []:
+            self.physnet_map.setdefault(physnet, []).append(host)
+        if not physnets:
+            self.any_physnet_hosts.append(host)
 
     def add_extra_params(self):
         for i in self.inventory:
@@ -94,6 +105,12 @@ class BaseTestCase(base.BaseTestCase):
                  project='networking_ansible',
                  version='%%(prog)s%s' % version_info.release_string())
 
+    def config(self, group=None, **kwargs):
+        """Override config options for the duration of a test."""
+        for k, v in kwargs.items():
+            cfg.CONF.set_override(k, v, group=group)
+            self.addCleanup(cfg.CONF.clear_override, k, group=group)
+
 
 class NetworkingAnsibleTestCase(BaseTestCase):
     def setUp(self):
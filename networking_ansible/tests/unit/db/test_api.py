@@ -0,0 +1,511 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from neutron.db.models import segment as segment_models
+from neutron.db import models_v2
+from neutron.plugins.ml2 import models as ml2_models
+from neutron.services.trunk import models as trunk_models
+from neutron.tests.unit import testlib_api
+from neutron_lib import context as n_context
+from neutron_lib.db import api as neutron_db_api
+from oslo_serialization import jsonutils
+from oslo_utils import timeutils
+from sqlalchemy import event
+
+from networking_ansible import constants as c
+from networking_ansible.db import api as db_api
+from networking_ansible.db import models
+
+
+class TestJournalApi(testlib_api.SqlTestCase):
+    def setUp(self):
+        super(TestJournalApi, self).setUp()
+        self.ctx = n_context.get_admin_context()
+
+    def _record(self, switch_name='switch1', payload=None,
+                object_id='netid', op_type=c.OP_CREATE_VLAN):
+        return db_api.record(self.ctx, op_type, switch_name,
+                             object_id, payload or {'segmentation_id': 37})
+
+    def _pending(self):
+        return [e.seqnum for e in db_api.get_pending(self.ctx)]
+
+    def _get(self, seqnum):
+        return self.ctx.session.query(models.SwitchJournal).filter_by(
+            seqnum=seqnum).one_or_none()
+
+    def test_record(self):
+        entry = self._record()
+        pending = db_api.get_pending(self.ctx)
+        self.assertEqual([entry.seqnum], [e.seqnum for e in pending])
+        self.assertEqual(c.JOURNAL_PENDING, pending[0].state)
+        self.assertEqual(0, pending[0].attempts)
+        self.assertEqual({'segmentation_id': 37},
+                         db_api.get_payload(pending[0]))
+
+    def test_get_pending_in_order(self):
+        entries = [self._record(object_id='netid{}'.format(n))
+                   for n in range(3)]
+        self.assertEqual([e.seqnum for e in entries], self._pending())
+        self.assertEqual([entries[0].seqnum],
+                         [e.seqnum for e in db_api.get_pending(self.ctx,
+                                                               limit=1)])
+
+    def test_get_pending_same_object(self):
+        entry1 = self._record()
+        entry2 = self._record()
+        entry3 = self._record(object_id='netid2')
+        self.assertEqual([entry1.seqnum, entry3.seqnum], self._pending())
+        db_api.claim(self.ctx, entry1.seqnum, 'host1')
+        self.assertEqual([entry3.seqnum], self._pending())
+        db_api.complete(self.ctx, entry1.seqnum)
+        self.assertEqual([entry2.seqnum, entry3.seqnum], self._pending())
+
+    def test_get_pending_same_switch_port(self):
+        entry1 = self._record(payload={'switch_port': 'swp1'},
+                              object_id='portid1', op_type=c.OP_DELETE_PORT)
+        entry2 = self._record(payload={'switch_port': 'swp1'},
+                              object_id='portid2', op_type=c.OP_UPDATE_PORT)
+        entry3 = self._record('switch2', payload={'switch_port': 'swp1'},
+                              object_id='portid3', op_type=c.OP_UPDATE_PORT)
+        self.assertEqual([entry1.seqnum, entry3.seqnum], self._pending())
+        db_api.complete(self.ctx, entry1.seqnum)
+        self.assertEqual([entry2.seqnum, entry3.seqnum], self._pending())
+
+    def test_get_pending_behind_backing_off(self):
+        # a port update can't overtake the delete before it while the
+        # delete waits to be retried
+        delete = self._record(payload={'switch_port': 'swp1'},
+                              object_id='portid', op_type=c.OP_DELETE_PORT)
+        update = self._record(payload={'switch_port': 'swp1'},
+                              object_id='portid', op_type=c.OP_UPDATE_PORT)
+        db_api.claim(self.ctx, delete.seqnum, 'host1')
+        db_api.fail(self.ctx, delete.seqnum, 5, delay=60)
+        self.assertEqual([], self._pending())
+        db_api.fail(self.ctx, delete.seqnum, 1)
+        self.assertEqual([update.seqnum], self._pending())
+
+    def test_claim(self):
+        entry = self._record()
+        self.assertTrue(db_api.claim(self.ctx, entry.seqnum, 'host1'))
+        self.assertFalse(db_api.claim(self.ctx, entry.seqnum, 'host2'))
+        self.assertEqual([], db_api.get_pending(self.ctx))
+        entry = self._get(entry.seqnum)
+        self.assertEqual(c.JOURNAL_PROCESSING, entry.state)
+        self.assertEqual('host1', entry.host)
+
+    def test_count_processing(self):
+        entries = [self._record(), self._record(), self._record('switch2'),
+                   self._record('switch3')]
+        for entry in entries[:3]:
+            db_api.claim(self.ctx, entry.seqnum, 'host1')
+        self.assertEqual({'switch1': 2, 'switch2': 1},
+                         db_api.count_processing(self.ctx))
+
+    def test_complete(self):
+        entry = self._record()
+        db_api.claim(self.ctx, entry.seqnum, 'host1')
+        db_api.complete(self.ctx, entry.seqnum)
+        self.assertIsNone(self._get(entry.seqnum))
+
+    def test_fail_retries(self):
+        entry = self._record()
+        db_api.claim(self.ctx, entry.seqnum, 'host1')
+        self.assertTrue(db_api.fail(self.ctx, entry.seqnum, 2))
+        entry = self._get(entry.seqnum)
+        self.assertEqual(c.JOURNAL_PENDING, entry.state)
+        self.assertEqual(1, entry.attempts)
+        self.assertIsNone(entry.host)
+
+    def test_fail_gives_up(self):
+        entry = self._record()
+        db_api.fail(self.ctx, entry.seqnum, 2)
+        self.assertFalse(db_api.fail(self.ctx, entry.seqnum, 2))
+        self.assertEqual(c.JOURNAL_FAILED, self._get(entry.seqnum).state)
+        self.assertEqual([], db_api.get_pending(self.ctx))
+
+    def test_fail_backs_off(self):
+        entry = self._record()
+        self.assertTrue(db_api.fail(self.ctx, entry.seqnum, 5, delay=60,
+                                    error='unreachable'))
+        self.assertEqual([], db_api.get_pending(self.ctx))
+        self.assertEqual('unreachable', self._get(entry.seqnum).last_error)
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self._get(entry.seqnum).retry_at = (
+                timeutils.utcnow() - datetime.timedelta(seconds=1))
+        self.assertEqual([entry.seqnum],
+                         [e.seqnum for e in db_api.get_pending(self.ctx)])
+
+    def test_fail_permanent(self):
+        entry = self._record()
+        self.assertFalse(db_api.fail(self.ctx, entry.seqnum, 5, delay=60,
+                                     error='invalid vlan', permanent=True))
+        failed = db_api.get_failed(self.ctx)
+        self.assertEqual([entry.seqnum], [e.seqnum for e in failed])
+        self.assertEqual('invalid vlan', failed[0].last_error)
+        self.assertEqual(1, failed[0].attempts)
+        self.assertIsNone(failed[0].retry_at)
+
+    def test_fail_missing(self):
+        self.assertFalse(db_api.fail(self.ctx, 1234, 2))
+
+    def test_get_processing_owners(self):
+        entries = [self._record() for _ in range(4)]
+        db_api.claim(self.ctx, entries[0].seqnum, 'host1:1')
+        db_api.claim(self.ctx, entries[1].seqnum, 'host1:1')
+        db_api.claim(self.ctx, entries[2].seqnum, 'host1:2')
+        self.assertEqual({'host1:1', 'host1:2'},
+                         db_api.get_processing_owners(self.ctx))
+
+    def test_reset_processing_host(self):
+        entry1 = self._record()
+        entry2 = self._record()
+        db_api.claim(self.ctx, entry1.seqnum, 'host1')
+        db_api.claim(self.ctx, entry2.seqnum, 'host2')
+        self.assertEqual(1, db_api.reset_processing(self.ctx, host='host1'))
+        self.assertEqual([entry1.seqnum],
+                         [e.seqnum for e in db_api.get_pending(self.ctx)])
+
+    def test_reset_processing_timeout(self):
+        entry1 = self._record()
+        entry2 = self._record()
+        db_api.claim(self.ctx, entry1.seqnum, 'host1')
+        db_api.claim(self.ctx, entry2.seqnum, 'host2')
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self._get(entry1.seqnum).updated_at = (
+                timeutils.utcnow() - datetime.timedelta(seconds=120))
+        self.assertEqual(1, db_api.reset_processing(self.ctx, timeout=60))
+        self.assertEqual([entry1.seqnum],
+                         [e.seqnum for e in db_api.get_pending(self.ctx)])
+
+    def test_reset_processing_exclude_hosts(self):
+        entry1 = self._record()
+        entry2 = self._record()
+        db_api.claim(self.ctx, entry1.seqnum, 'host1:1')
+        db_api.claim(self.ctx, entry2.seqnum, 'host1:2')
+        self.assertEqual(1, db_api.reset_processing(
+            self.ctx, exclude_hosts={'host1:2'}))
+        self.assertEqual([entry1.seqnum],
+                         [e.seqnum for e in db_api.get_pending(self.ctx)])
+
+    def test_requeue(self):
+        entry = self._record()
+        db_api.claim(self.ctx, entry.seqnum, 'host1')
+        db_api.requeue(self.ctx, entry.seqnum)
+        entry = self._get(entry.seqnum)
+        self.assertEqual(c.JOURNAL_PENDING, entry.state)
+        self.assertEqual(0, entry.attempts)
+        self.assertIsNone(entry.host)
+
+
+class PortsTestCase(testlib_api.SqlTestCase):
+    def setUp(self):
+        super(PortsTestCase, self).setUp()
+        self.ctx = n_context.get_admin_context()
+
+    def _add_network(self, net_id, network_type='vlan',
+                     physnet='physnet', segmentation_id=37):
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(models_v2.Network(id=net_id,
+                                                   project_id='project'))
+            self.ctx.session.add(segment_models.NetworkSegment(
+                id='seg-{}'.format(net_id), network_id=net_id,
+                network_type=network_type, physical_network=physnet,
+                segmentation_id=segmentation_id))
+
+    def _add_port(self, port_id, host, net_id='netid',
+                  device_owner=c.COMPUTE_NOVA, profile=None,
+                  mac_address=None):
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(models_v2.Port(
+                id=port_id, project_id='project', network_id=net_id,
+                mac_address=mac_address or 'fa:16:3e:00:00:0{}'.format(
+                    port_id[-1]),
+                admin_state_up=True, status='ACTIVE', device_id=port_id,
+                device_owner=device_owner))
+            self.ctx.session.add(ml2_models.PortBinding(
+                port_id=port_id, host=host, vnic_type='normal',
+                profile=jsonutils.dumps(profile) if profile else '',
+                vif_type='ovs', vif_details=''))
+
+
+class TestGetPortBindings(PortsTestCase):
+    def setUp(self):
+        super(TestGetPortBindings, self).setUp()
+        self._add_network('netid')
+        self._add_port('port1', 'host1', profile={'pci_slot': '0000:03:00.1'})
+        self._add_port('port2', 'host2')
+        self._add_port('port3', 'host1', device_owner='network:dhcp')
+
+    def test_get_port_bindings(self):
+        bindings = db_api.get_port_bindings(self.ctx, 'netid',
+                                            c.COMPUTE_NOVA)
+        self.assertEqual(
+            [('port1', 'host1', 'normal', {'pci_slot': '0000:03:00.1'}),
+             ('port2', 'host2', 'normal', {})],
+            sorted(bindings))
+
+    def test_get_port_bindings_exclude_port(self):
+        bindings = db_api.get_port_bindings(self.ctx, 'netid',
+                                            c.COMPUTE_NOVA,
+                                            exclude_port_id='port1')
+        self.assertEqual(['port2'], [b[0] for b in bindings])
+
+    def test_get_port_bindings_host(self):
+        bindings = db_api.get_port_bindings(self.ctx, 'netid',
+                                            c.COMPUTE_NOVA, host='host2')
+        self.assertEqual([('port2', 'host2', 'normal', {})], bindings)
+        self.assertEqual([], db_api.get_port_bindings(
+            self.ctx, 'netid', c.COMPUTE_NOVA, host='otherhost'))
+
+    def test_get_port_bindings_segmentation_id(self):
+        self.assertEqual(2, len(db_api.get_port_bindings(
+            self.ctx, 'netid', c.COMPUTE_NOVA, segmentation_id=37)))
+        self.assertEqual([], db_api.get_port_bindings(
+            self.ctx, 'netid', c.COMPUTE_NOVA, segmentation_id=38))
+
+    def test_get_port_bindings_other_network(self):
+        self.assertEqual([], db_api.get_port_bindings(
+            self.ctx, 'othernet', c.COMPUTE_NOVA))
+
+
+class TestGetVlanPortBindings(PortsTestCase):
+    def setUp(self):
+        super(TestGetVlanPortBindings, self).setUp()
+        self._add_network('netid')
+        self._add_network('netid2', segmentation_id=38)
+        self._add_port('port1', 'host1')
+        self._add_port('port2', 'host2', net_id='netid2',
+                       device_owner=c.BAREMETAL_NONE)
+        # a trunk on port2 with two subports on netid
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(trunk_models.Trunk(
+                id='trunkid', project_id='project', port_id='port2'))
+            for vlan, port_id in ((101, 'subport3'), (102, 'subport4')):
+                self._add_port(port_id, 'host2',
+                               device_owner='trunk:subport')
+                self.ctx.session.add(trunk_models.SubPort(
+                    port_id=port_id, trunk_id='trunkid',
+                    segmentation_type='vlan', segmentation_id=vlan))
+
+    def test_get_vlan_port_bindings(self):
+        bindings = db_api.get_vlan_port_bindings(self.ctx, 37)
+        # the subports are plugged in through their parent port
+        self.assertEqual(
+            [('port1', 'netid', c.COMPUTE_NOVA, 'host1', 'normal', 'ovs',
+              {}),
+             ('port2', 'netid2', c.BAREMETAL_NONE, 'host2', 'normal', 'ovs',
+              {})],
+            sorted(bindings))
+
+    def _port_ids(self, segmentation_id, **kwargs):
+        return sorted(b[0] for b in db_api.get_vlan_port_bindings(
+            self.ctx, segmentation_id, **kwargs))
+
+    def test_get_vlan_port_bindings_exclude_port(self):
+        self.assertEqual(['port1'], self._port_ids(37,
+                                                   exclude_port_id='port2'))
+
+    def test_get_vlan_port_bindings_other_vlan(self):
+        self.assertEqual(['port2'], self._port_ids(38))
+        self.assertEqual([], self._port_ids(39))
+
+    def test_query_count(self):
+        # a single query however many ports and subports use the vlan
+        queries = []
+
+        def count(conn, cursor, statement, *args):
+            # leave out the connection's liveness check
+            if statement.startswith('SELECT') and statement != 'SELECT 1':
+                queries.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', count)
+        db_api.get_vlan_port_bindings(self.ctx, 37)
+        event.remove(self.engine, 'before_cursor_execute', count)
+        self.assertEqual(1, len(queries))
+
+
+class TestVlanRefs(PortsTestCase):
+    def setUp(self):
+        super(TestVlanRefs, self).setUp()
+        self._add_network('netid')
+        for port_id in ('port1', 'port2', 'port3'):
+            self._add_port(port_id, 'host1')
+
+    def _refs(self, switch_port='swp1', segmentation_id=37, **kwargs):
+        return sorted(db_api.get_vlan_refs(self.ctx, 'switch1', switch_port,
+                                           segmentation_id, **kwargs))
+
+    def test_add_vlan_ref(self):
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port1')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port2')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp2', 37, 'port3')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 38, 'port3')
+        self.assertEqual(['port1', 'port2'], self._refs())
+        self.assertEqual(['port2'], self._refs(exclude_port_id='port1'))
+        self.assertEqual(['port3'], self._refs(switch_port='swp2'))
+        self.assertEqual([], self._refs(segmentation_id=39))
+
+    def test_add_vlan_ref_twice(self):
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port1')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port1')
+        self.assertEqual(['port1'], self._refs())
+
+    def test_delete_vlan_refs(self):
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port1')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp2', 37, 'port1')
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port2')
+        self.assertEqual(1, db_api.delete_vlan_refs(self.ctx, 'port1',
+                                                    'switch1', 'swp2'))
+        self.assertEqual(['port1', 'port2'], self._refs())
+        self.assertEqual(1, db_api.delete_vlan_refs(self.ctx, 'port1'))
+        self.assertEqual(['port2'], self._refs())
+
+    def test_vlan_ref_backfill(self):
+        self.assertFalse(db_api.has_vlan_ref_backfill(self.ctx, 'switch1',
+                                                      'swp1', 37))
+        db_api.add_vlan_ref_backfill(self.ctx, 'switch1', 'swp1', 37)
+        db_api.add_vlan_ref_backfill(self.ctx, 'switch1', 'swp1', 37)
+        self.assertTrue(db_api.has_vlan_ref_backfill(self.ctx, 'switch1',
+                                                     'swp1', 37))
+        self.assertFalse(db_api.has_vlan_ref_backfill(self.ctx, 'switch1',
+                                                      'swp2', 37))
+        self.assertFalse(db_api.has_vlan_ref_backfill(self.ctx, 'switch1',
+                                                      'swp1', 38))
+
+    def test_port_deleted(self):
+        db_api.add_vlan_ref(self.ctx, 'switch1', 'swp1', 37, 'port1')
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.query(models_v2.Port).filter_by(
+                id='port1').delete()
+        self.assertEqual([], self._refs())
+
+
+class TestHasBoundPortWithMac(PortsTestCase):
+    mac = 'fa:16:3e:00:00:01'
+    lli = {c.LLI: [{'switch_info': 'switch1', 'port_id': 'port1'}]}
+
+    def _has_bound_port(self):
+        return db_api.has_bound_port_with_mac(self.ctx, self.mac, 'physnet')
+
+    def test_no_ports(self):
+        self.assertFalse(self._has_bound_port())
+
+    def test_bound_port(self):
+        self._add_network('netid')
+        self._add_port('port1', 'host1', profile=self.lli)
+        self.assertTrue(self._has_bound_port())
+
+    def test_port_no_lli(self):
+        self._add_network('netid')
+        self._add_port('port1', 'host1', profile={c.LLI: []})
+        self.assertFalse(self._has_bound_port())
+
+    def test_port_other_physnet(self):
+        self._add_network('netid', physnet='physnet2')
+        self._add_port('port1', 'host1', profile=self.lli)
+        self.assertFalse(self._has_bound_port())
+
+    def test_port_not_vlan(self):
+        self._add_network('netid', network_type='vxlan', physnet=None)
+        self._add_port('port1', 'host1', profile=self.lli)
+        self.assertFalse(self._has_bound_port())
+
+    def test_port_other_mac(self):
+        self._add_network('netid')
+        self._add_port('port2', 'host1', profile=self.lli)
+        self.assertFalse(self._has_bound_port())
+
+    def test_query_count(self):
+        # the number of queries doesn't grow with the number of ports
+        # sharing the mac
+        queries = []
+
+        def count(*args, **kwargs):
+            queries.append(args)
+
+        counts = []
+        for n in range(3):
+            for i in range(10 ** n):
+                net_id = 'net-{}-{}'.format(n, i)
+                self._add_network(net_id, physnet='physnet2')
+                self._add_port('{}-port'.format(net_id), 'host1', net_id,
+                               profile=self.lli, mac_address=self.mac)
+            del queries[:]
+            event.listen(self.engine, 'before_cursor_execute', count)
+            self.assertFalse(self._has_bound_port())
+            event.remove(self.engine, 'before_cursor_execute', count)
+            counts.append(len(queries))
+        self.assertEqual([counts[0]] * 3, counts)
+
+
+class TestPortVersion(PortsTestCase):
+    def setUp(self):
+        super(TestPortVersion, self).setUp()
+        self._add_network('netid')
+        self._add_port('port1', 'host1')
+
+    def _revision(self, model, object_id):
+        with neutron_db_api.CONTEXT_READER.using(self.ctx):
+            return self.ctx.session.query(model).filter_by(
+                id=object_id).one().revision_number
+
+    def _add_trunk(self, vlans):
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(trunk_models.Trunk(
+                id='trunkid', project_id='project', port_id='port1'))
+            for vlan in vlans:
+                port_id = 'subport{}'.format(vlan)
+                self._add_port(port_id, 'host1')
+                self.ctx.session.add(trunk_models.SubPort(
+                    port_id=port_id, trunk_id='trunkid',
+                    segmentation_type='vlan', segmentation_id=vlan))
+
+    def test_get_port_version(self):
+        self.assertEqual((self._revision(models_v2.Port, 'port1'),
+                          self._revision(models_v2.Network, 'netid'),
+                          None, ()),
+                         db_api.get_port_version(self.ctx, 'port1'))
+
+    def test_get_port_version_trunk(self):
+        self._add_trunk([73, 37])
+        self.assertEqual((self._revision(models_v2.Port, 'port1'),
+                          self._revision(models_v2.Network, 'netid'),
+                          self._revision(trunk_models.Trunk, 'trunkid'),
+                          (37, 73)),
+                         db_api.get_port_version(self.ctx, 'port1'))
+
+    def test_get_port_version_changed(self):
+        version = db_api.get_port_version(self.ctx, 'port1')
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.query(models_v2.Port).filter_by(
+                id='port1').one().bump_revision()
+        self.assertNotEqual(version,
+                            db_api.get_port_version(self.ctx, 'port1'))
+
+    def test_get_port_version_no_port(self):
+        self.assertIsNone(db_api.get_port_version(self.ctx, 'port2'))
+
+    def test_get_network_revision(self):
+        self.assertEqual(self._revision(models_v2.Network, 'netid'),
+                         db_api.get_network_revision(self.ctx, 'netid'))
+        self.assertIsNone(db_api.get_network_revision(self.ctx, 'othernet'))
+
+    def test_has_vlan_segment(self):
+        self.assertTrue(db_api.has_vlan_segment(self.ctx, 'physnet', 37))
+        self.assertFalse(db_api.has_vlan_segment(self.ctx, 'physnet', 38))
+        self.assertFalse(db_api.has_vlan_segment(self.ctx, 'physnet2', 37))
@@ -0,0 +1,191 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import fixtures
+from network_runner import exceptions as net_runr_exc
+from tooz import coordination
+from unittest import mock
+
+from networking_ansible import exceptions
+from networking_ansible.ml2 import breaker
+from networking_ansible.tests.unit import base
+
+
+FAILED_OUTPUT = """
+PLAY [switch1] *********************************************************
+
+TASK [network-runner : configure vlan 5000] ****************************
+fatal: [switch1]: FAILED! => {"changed": false, "msg": "invalid vlan 5000"}
+
+PLAY RECAP *************************************************************
+switch1 : ok=1 changed=0 unreachable=0 failed=1 skipped=0 rescued=0
+"""
+
+UNREACHABLE_OUTPUT = """
+PLAY [switch1] *********************************************************
+
+TASK [network-runner : configure vlan 37] ******************************
+fatal: [switch1]: UNREACHABLE! => {"changed": false, "msg": "Failed to \
+connect to the host via ssh: ssh: connect to host 10.0.0.1 port 22: \
+Connection timed out", "unreachable": true}
+
+PLAY RECAP *************************************************************
+switch1 : ok=0 changed=0 unreachable=1 failed=0 skipped=0 rescued=0
+"""
+
+
+class TestIsUnreachable(base.BaseTestCase):
+    parse_config = False
+
+    def test_unreachable(self):
+        self.assertTrue(breaker.is_unreachable(Exception(
+            'fatal: [switch1]: UNREACHABLE! => {"changed": false}')))
+        self.assertTrue(breaker.is_unreachable(Exception(
+            'ssh: connect to host 10.0.0.1 port 22: Connection timed out')))
+        self.assertTrue(breaker.is_unreachable(Exception(
+            'ssh connection failed: [Errno 113] No route to host')))
+
+    def test_unreachable_output(self):
+        self.assertTrue(breaker.is_unreachable(
+            net_runr_exc.NetworkRunnerException(UNREACHABLE_OUTPUT)))
+
+    def test_unreachable_recap(self):
+        self.assertTrue(breaker.is_unreachable(Exception(
+            'switch1 : ok=0 changed=0 unreachable=2 failed=0')))
+
+    def test_reachable(self):
+        self.assertFalse(breaker.is_unreachable(Exception(
+            'fatal: [switch1]: FAILED! => {"msg": "invalid vlan"}')))
+
+    def test_reachable_output(self):
+        # every recap has an unreachable count
+        self.assertFalse(breaker.is_unreachable(
+            net_runr_exc.NetworkRunnerException(FAILED_OUTPUT)))
+
+
+class TestSwitchBreakers(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestSwitchBreakers, self).setUp()
+        self.coordinator = mock.Mock()
+        # no other process shares breakers
+        self.coordinator.get_members.return_value.get.return_value = []
+        self.breakers = breaker.SwitchBreakers(self.coordinator, 2, 60)
+        self.now = 1000.0
+        mock.patch.object(breaker.time, 'time',
+                          side_effect=lambda: self.now).start()
+        self.unreachable = Exception('switch1 UNREACHABLE!')
+
+    def _fail(self, switch_name='switch1', times=1):
+        for _ in range(times):
+            self.breakers.check(switch_name)
+            self.breakers.record(switch_name, self.unreachable)
+
+    def test_opens_after_threshold(self):
+        self._fail()
+        self.breakers.check('switch1')
+        self._fail()
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          self.breakers.check, 'switch1')
+        # other switches aren't affected
+        self.breakers.check('switch2')
+        self.coordinator.join_group_create.assert_called_once_with(
+            breaker.c.BREAKER_GROUP,
+            {'breakers': {'switch1': [1000.0, True]}})
+
+    def test_not_consecutive(self):
+        self._fail()
+        self.breakers.record('switch1')
+        self._fail()
+        self.breakers.check('switch1')
+
+    def test_reached_with_error(self):
+        self._fail()
+        self.breakers.record('switch1', Exception('FAILED! invalid vlan'))
+        self._fail()
+        self.breakers.check('switch1')
+
+    def test_probe_closes(self):
+        self._fail(times=2)
+        self.now += 61
+        # one probe at a time
+        self.breakers.check('switch1')
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          self.breakers.check, 'switch1')
+        self.breakers.record('switch1')
+        self.breakers.check('switch1')
+        self.coordinator.update_capabilities.assert_called_once_with(
+            breaker.c.BREAKER_GROUP,
+            {'breakers': {'switch1': [1061.0, False]}})
+
+    def test_probe_fails(self):
+        self._fail(times=2)
+        self.now += 61
+        self._fail()
+        # open for another reset_timeout
+        self.now += 30
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          self.breakers.check, 'switch1')
+        self.now += 31
+        self.breakers.check('switch1')
+
+    def test_lost_probe(self):
+        self._fail(times=2)
+        self.now += 61
+        self.breakers.check('switch1')
+        self.now += 61
+        self.breakers.check('switch1')
+
+    def test_publish_fails(self):
+        self.coordinator.join_group_create.side_effect = (
+            coordination.ToozError('unreachable'))
+        self._fail(times=2)
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          self.breakers.check, 'switch1')
+
+
+class TestSharedSwitchBreakers(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestSharedSwitchBreakers, self).setUp()
+        self.uri = 'file://{}'.format(
+            self.useFixture(fixtures.TempDir()).path)
+
+    def _breakers(self, member_id):
+        coordinator = coordination.get_coordinator(self.uri, member_id)
+        coordinator.start()
+        self.addCleanup(coordinator.stop)
+        return breaker.SwitchBreakers(coordinator, 1, 60,
+                                      refresh_interval=0)
+
+    def test_shared(self):
+        breakers1 = self._breakers(b'member1')
+        breakers2 = self._breakers(b'member2')
+        breakers2.check('switch1')
+
+        breakers1.record('switch1', Exception('UNREACHABLE!'))
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          breakers2.check, 'switch1')
+
+        # the other process closes it after a successful probe
+        with mock.patch.object(breaker.time, 'time',
+                               return_value=time.time() + 61):
+            breakers2.check('switch1')
+            breakers2.record('switch1')
+            breakers1.check('switch1')
@@ -0,0 +1,355 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from network_runner import exceptions as net_runr_exc
+from unittest import mock
+
+from networking_ansible import constants as c
+from networking_ansible import exceptions
+from networking_ansible.ml2 import journal
+from networking_ansible.tests.unit import base
+
+
+@mock.patch('networking_ansible.ml2.journal.n_context')
+@mock.patch('networking_ansible.ml2.journal.db_api', autospec=True)
+class TestJournal(base.BaseTestCase):
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.config(host='host1')
+        mock.patch.object(journal.os, 'getpid', return_value=1234).start()
+        self.handler = mock.Mock(side_effect=lambda ops: [None] * len(ops))
+        self.journal = journal.Journal(self.handler, 2, 10, 600, 5)
+        self.addCleanup(self.journal.stop)
+
+    def _entry(self, seqnum, switch_name='switch1', attempts=0):
+        return mock.Mock(seqnum=seqnum,
+                         switch_name=switch_name,
+                         op_type=c.OP_CREATE_VLAN,
+                         payload='{"segmentation_id": 37}',
+                         attempts=attempts)
+
+    @mock.patch.object(journal.os, 'kill')
+    def test_start_resumes_host_operations(self, mock_kill, mock_db_api,
+                                           mock_context):
+        db = mock_context.get_admin_context.return_value
+
+        def kill(pid, signal):
+            if pid == 4321:
+                raise ProcessLookupError()
+
+        mock_kill.side_effect = kill
+        mock_db_api.reset_processing.return_value = 1
+        # a worker that exited, a sibling worker that's still running and
+        # another host's
+        mock_db_api.get_processing_owners.return_value = {
+            'host1:4321', 'host1:5678', 'host2:4321'}
+        self.journal.start()
+        mock_db_api.reset_processing.assert_called_once_with(
+            db, host='host1:4321')
+
+    @mock.patch.object(journal.os, 'kill')
+    def test_sync_keeps_running_operations(self, mock_kill, mock_db_api,
+                                           mock_context):
+        db = mock_context.get_admin_context.return_value
+
+        def kill(pid, signal):
+            if pid == 4321:
+                raise ProcessLookupError()
+
+        mock_kill.side_effect = kill
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = []
+        # the operations this process and a sibling worker are still
+        # running don't time out, however long they've been queued
+        mock_db_api.get_processing_owners.return_value = {
+            'host1:1234', 'host1:4321', 'host1:5678', 'host2:4321'}
+        self.journal.sync()
+        mock_db_api.reset_processing.assert_called_once_with(
+            db, timeout=600, exclude_hosts={'host1:1234', 'host1:5678'})
+
+    def test_sync(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        entries = [self._entry(1), self._entry(2, 'switch2')]
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = entries
+        mock_db_api.claim.return_value = True
+        mock_db_api.get_payload.return_value = {'segmentation_id': 37}
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.reset_processing.assert_called_once_with(
+            db, timeout=600, exclude_hosts=set())
+        self.assertEqual([mock.call(db, 1, 'host1:1234'),
+                          mock.call(db, 2, 'host1:1234')],
+                         mock_db_api.claim.call_args_list)
+        ops = sorted([op for call in self.handler.call_args_list
+                      for op in call[0][0]],
+                     key=lambda op: op.seqnum)
+        self.assertEqual([(1, 'switch1'), (2, 'switch2')],
+                         [(op.seqnum, op.switch_name) for op in ops])
+        self.assertEqual({'segmentation_id': 37}, ops[0].payload)
+        self.assertEqual([mock.call(db, 1), mock.call(db, 2)],
+                         sorted(mock_db_api.complete.call_args_list))
+
+    def test_sync_wakes_when_finished(self, mock_db_api, mock_context):
+        # the operations after it for the same port can be claimed now
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+
+        self.journal.sync()
+        self.journal._work_queue.shutdown()
+
+        self.assertTrue(self.journal._wake.is_set())
+
+    def test_sync_fails_no_wake(self, mock_db_api, mock_context):
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        self.handler.side_effect = Exception('unreachable')
+
+        self.journal.sync()
+        self.journal._work_queue.shutdown()
+
+        self.assertFalse(self.journal._wake.is_set())
+
+    def test_sync_already_claimed(self, mock_db_api, mock_context):
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = False
+
+        self.journal.sync()
+        self.journal.stop()
+
+        self.handler.assert_not_called()
+        mock_db_api.complete.assert_not_called()
+
+    def test_sync_fails(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        self.handler.side_effect = Exception('unreachable')
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.fail.assert_called_once_with(db, 1, 5, delay=0,
+                                                 error='unreachable')
+        mock_db_api.complete.assert_not_called()
+
+    def test_sync_fails_backs_off(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1, attempts=2)]
+        mock_db_api.claim.return_value = True
+        mock_db_api.fail.return_value = True
+        self.handler.side_effect = Exception('unreachable')
+        self.journal = journal.Journal(self.handler, 2, 10, 600, 5,
+                                       retry_backoff=10,
+                                       retry_backoff_max=600)
+
+        self.journal.sync()
+        self.journal.stop()
+
+        # the third failure waits for up to 4 times the backoff
+        args, kwargs = mock_db_api.fail.call_args
+        self.assertEqual((db, 1, 5), args)
+        self.assertGreaterEqual(kwargs['delay'], 20)
+        self.assertLessEqual(kwargs['delay'], 40)
+
+    def test_sync_fails_permanently(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        self.handler.side_effect = exceptions.LocalLinkInfoMissingException(
+            'no port')
+
+        self.journal.sync()
+        self.journal.stop()
+
+        # retrying can't help, the operation is dead lettered straight away
+        mock_db_api.fail.assert_called_once_with(db, 1, 5, error=mock.ANY,
+                                                 permanent=True)
+
+    def test_sync_fails_playbook(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        # the switch answered, only the task failed
+        self.handler.side_effect = net_runr_exc.NetworkRunnerException(
+            'fatal: [switch1]: FAILED! => {"msg": "invalid vlan"}\n'
+            'PLAY RECAP ***\n'
+            'switch1 : ok=1 changed=0 unreachable=0 failed=1')
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.fail.assert_called_once_with(db, 1, 5, error=mock.ANY,
+                                                 permanent=True)
+
+    def test_sync_lock_timeout(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        self.handler.side_effect = exceptions.SwitchLockTimeout('switch1',
+                                                                30)
+
+        self.journal.sync()
+        self.journal.stop()
+
+        # the operation goes back to the journal without using an attempt
+        mock_db_api.requeue.assert_called_once_with(db, 1)
+        mock_db_api.fail.assert_not_called()
+        mock_db_api.complete.assert_not_called()
+
+    def test_sync_switch_unavailable(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1)]
+        mock_db_api.claim.return_value = True
+        self.handler.side_effect = lambda ops: [
+            exceptions.SwitchUnavailable('switch1')]
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.requeue.assert_called_once_with(db, 1)
+        mock_db_api.fail.assert_not_called()
+
+    def test_sync_batch_partial_failure(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(1),
+                                                self._entry(2)]
+        mock_db_api.claim.return_value = True
+        mock_db_api.fail.return_value = True
+        self.handler.side_effect = lambda ops: [None, Exception('boom')]
+        self.journal = journal.Journal(self.handler, 2, 10, 600, 5,
+                                       batch_size=2, batch_window=0.5)
+
+        self.journal.sync()
+        self.journal.stop()
+
+        self.handler.assert_called_once()
+        mock_db_api.complete.assert_called_once_with(db, 1)
+        mock_db_api.fail.assert_called_once_with(db, 2, 5, delay=0,
+                                                 error='boom')
+
+    def _sharded_journal(self, owned):
+        ring = mock.Mock()
+        ring.owns.side_effect = lambda switch_name: switch_name in owned
+        self.journal = journal.Journal(self.handler, 2, 10, 600, 5,
+                                       ring=ring)
+        return ring
+
+    def test_start_stop_sharded(self, mock_db_api, mock_context):
+        mock_db_api.reset_processing.return_value = 0
+        ring = self._sharded_journal({'switch1'})
+        self.journal.start()
+        ring.start.assert_called_once_with()
+        self.journal.stop()
+        ring.stop.assert_called_once_with()
+
+    def test_sync_sharded(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        ring = self._sharded_journal({'switch1'})
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.count_processing.return_value = {}
+        mock_db_api.get_pending.return_value = [self._entry(1),
+                                                self._entry(2, 'switch2')]
+        mock_db_api.claim.return_value = True
+
+        self.journal.sync()
+        self.journal.stop()
+
+        # before and after claiming
+        self.assertEqual(2, ring.refresh.call_count)
+        # switch2 belongs to another member of the ring
+        mock_db_api.claim.assert_called_once_with(db, 1, 'host1:1234')
+        mock_db_api.complete.assert_called_once_with(db, 1)
+        mock_db_api.requeue.assert_not_called()
+
+    def test_sync_sharded_switch_moved(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        owned = {'switch1', 'switch2'}
+        ring = self._sharded_journal(owned)
+
+        def refresh():
+            # a member that joined while claiming takes switch1
+            if ring.refresh.call_count == 2:
+                owned.discard('switch1')
+
+        ring.refresh.side_effect = refresh
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.count_processing.return_value = {}
+        mock_db_api.get_pending.return_value = [self._entry(1),
+                                                self._entry(2, 'switch2')]
+        mock_db_api.claim.return_value = True
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.requeue.assert_called_once_with(db, 1)
+        mock_db_api.complete.assert_called_once_with(db, 2)
+        self.assertEqual(0, self.journal._claimed['switch1'])
+
+    def test_sync_sharded_switch_busy(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        self._sharded_journal({'switch1', 'switch2'})
+        mock_db_api.reset_processing.return_value = 0
+        # the previous owner of switch1 is still running an operation
+        mock_db_api.count_processing.return_value = {'switch1': 1}
+        mock_db_api.get_pending.return_value = [self._entry(1),
+                                                self._entry(2, 'switch2')]
+        mock_db_api.claim.return_value = True
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.claim.assert_called_once_with(db, 2, 'host1:1234')
+
+    def test_sync_sharded_own_operations(self, mock_db_api, mock_context):
+        db = mock_context.get_admin_context.return_value
+        self._sharded_journal({'switch1'})
+        mock_db_api.reset_processing.return_value = 0
+        mock_db_api.get_pending.return_value = [self._entry(2)]
+        mock_db_api.claim.return_value = True
+        self.journal._claimed['switch1'] = 1
+        # the operation being run is this process's own
+        mock_db_api.count_processing.return_value = {'switch1': 1}
+
+        self.journal.sync()
+        self.journal.stop()
+
+        mock_db_api.claim.assert_called_once_with(db, 2, 'host1:1234')
+        self.assertEqual(1, self.journal._claimed['switch1'])
+
+    def test_wake(self, mock_db_api, mock_context):
+        mock_db_api.reset_processing.return_value = 0
+        synced = threading.Event()
+        with mock.patch.object(self.journal, 'sync',
+                               side_effect=synced.set) as mock_sync:
+            self.journal.start()
+            self.journal.wake()
+            self.assertTrue(synced.wait(5))
+            self.journal.stop()
+        mock_sync.assert_called_once_with()
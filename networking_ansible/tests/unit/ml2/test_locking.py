@@ -0,0 +1,171 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from tooz import coordination
+from unittest import mock
+
+from networking_ansible.ml2 import locking
+from networking_ansible.tests.unit import base
+
+
+class TestHybridLock(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestHybridLock, self).setUp()
+        self.coordinator = mock.Mock()
+        self.tooz_lock = self.coordinator.get_lock.return_value
+        self.tooz_lock.acquire.return_value = True
+        self.lock = locking.HybridLock(self.coordinator, b'switch')
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_acquire_release(self):
+        with self.lock:
+            self.coordinator.get_lock.assert_called_once_with(b'switch')
+            self.tooz_lock.acquire.assert_called_once_with(blocking=True)
+        self.tooz_lock.release.assert_called_once_with()
+
+    def test_local_waiters_take_turns(self):
+        # the second local thread only takes the distributed lock once the
+        # first one released it
+        waiting = threading.Event()
+        taken = threading.Event()
+
+        def take():
+            waiting.set()
+            with self.lock:
+                taken.set()
+
+        with self.lock:
+            thread = threading.Thread(target=take)
+            thread.start()
+            waiting.wait(5)
+            self.assertFalse(taken.wait(0.2))
+            self.assertEqual(1, self.tooz_lock.acquire.call_count)
+        thread.join(5)
+        self.assertTrue(taken.is_set())
+        self.assertEqual(2, self.tooz_lock.acquire.call_count)
+        self.assertEqual(2, self.tooz_lock.release.call_count)
+
+    def test_acquire_nonblocking_held_locally(self):
+        with self.lock:
+            result = []
+            thread = threading.Thread(
+                target=lambda: result.append(self.lock.acquire(False)))
+            thread.start()
+            thread.join(5)
+        self.assertEqual([False], result)
+        self.tooz_lock.acquire.assert_called_once_with(blocking=True)
+
+    def test_acquire_nonblocking_held_elsewhere(self):
+        self.tooz_lock.acquire.return_value = False
+        self.assertFalse(self.lock.acquire(blocking=False))
+        # the local lock isn't kept
+        self.tooz_lock.acquire.return_value = True
+        self.assertTrue(self.lock.acquire(blocking=False))
+
+    def test_acquire_timeout(self):
+        self.assertTrue(self.lock.acquire(timeout=5))
+        args, kwargs = self.tooz_lock.acquire.call_args
+        # tooz is given what's left of the timeout
+        self.assertGreater(kwargs['blocking'], 0)
+        self.assertLessEqual(kwargs['blocking'], 5)
+
+    def test_acquire_timeout_held_locally(self):
+        with self.lock:
+            result = []
+            thread = threading.Thread(
+                target=lambda: result.append(self.lock.acquire(timeout=0.1)))
+            thread.start()
+            thread.join(5)
+        self.assertEqual([False], result)
+        self.tooz_lock.acquire.assert_called_once_with(blocking=True)
+
+    def test_acquire_timeout_held_elsewhere(self):
+        self.tooz_lock.acquire.return_value = False
+        self.assertFalse(self.lock.acquire(timeout=0.1))
+        self.assertTrue(self.lock._local.acquire(blocking=False))
+
+    def test_acquire_fails(self):
+        self.tooz_lock.acquire.side_effect = [
+            coordination.ToozError('unreachable'), True]
+        self.assertRaises(coordination.ToozError, self.lock.acquire)
+        self.assertTrue(self.lock.acquire(blocking=False))
+
+    def test_release_fails(self):
+        self.tooz_lock.release.side_effect = coordination.ToozError(
+            'unreachable')
+        with self.lock:
+            pass
+        self.assertTrue(self.lock.acquire(blocking=False))
+
+    def test_lease_reused(self):
+        lock = locking.HybridLock(self.coordinator, b'switch', lease=60)
+        for _ in range(3):
+            with lock:
+                pass
+        self.tooz_lock.acquire.assert_called_once_with(blocking=True)
+        self.tooz_lock.release.assert_not_called()
+        # the pending lease doesn't keep the process from exiting
+        self.assertTrue(lock._timer.daemon)
+        lock._timer.cancel()
+
+    def test_lease_expires(self):
+        lock = locking.HybridLock(self.coordinator, b'switch', lease=0.05)
+        with lock:
+            pass
+        self.assertTrue(self._wait_for(lambda: self.tooz_lock.release.called))
+        with lock:
+            pass
+        self.assertEqual(2, self.tooz_lock.acquire.call_count)
+
+    def test_lease_not_expired_while_held(self):
+        lock = locking.HybridLock(self.coordinator, b'switch', lease=0.05)
+        with lock:
+            pass
+        with lock:
+            time.sleep(0.2)
+            self.tooz_lock.release.assert_not_called()
+        self.assertTrue(self._wait_for(lambda: self.tooz_lock.release.called))
+        self.tooz_lock.acquire.assert_called_once_with(blocking=True)
+        self.tooz_lock.release.assert_called_once_with()
+
+    def test_local_only(self):
+        lock = locking.HybridLock(None, b'switch', lease=60)
+        with lock:
+            self.assertFalse(lock.acquire(blocking=False))
+        self.assertTrue(lock.acquire(timeout=1))
+        lock.release()
+        self.assertIsNone(lock._timer)
+
+
+class TestLockManager(base.BaseTestCase):
+    parse_config = False
+
+    def test_get_lock(self):
+        manager = locking.LockManager(mock.Mock(), lease=5)
+        lock = manager.get_lock(b'switch')
+        self.assertIsInstance(lock, locking.HybridLock)
+        self.assertIs(lock, manager.get_lock(b'switch'))
+        self.assertIsNot(lock, manager.get_lock(b'otherswitch'))
+        self.assertEqual(5, lock._lease)
@@ -15,13 +15,16 @@
 
 import contextlib
 import fixtures
+import futurist
 import tempfile
+import threading
 import webob.exc
 
 from tooz import coordination
 from unittest import mock
 
 from network_runner import api
+from network_runner import exceptions as net_runr_exc
 from network_runner.types import validators
 from neutron.common import test_lib
 from neutron.objects import network
@@ -32,10 +35,19 @@ from neutron import quota
 from neutron.tests.unit.plugins.ml2 import test_plugin
 from neutron_lib.api.definitions import portbindings
 from neutron_lib.api.definitions import provider_net
+from neutron_lib.callbacks import events
 from neutron_lib.callbacks import resources
 
 from networking_ansible import constants as c
 from networking_ansible import exceptions as netans_ml2exc
+from networking_ansible.ml2 import breaker
+from networking_ansible.ml2 import locking
+from networking_ansible.ml2 import mech_driver
+from networking_ansible.ml2 import port_state
+from networking_ansible.ml2 import runner
+from networking_ansible.ml2 import throttle
+from networking_ansible.ml2 import vlan_set
+from networking_ansible.ml2 import work_queue as mech_driver_work_queue
 from networking_ansible.tests.unit import base
 
 
@@ -145,6 +157,13 @@ class TestIsPortBound(base.NetworkingAnsibleTestCase):
 @mock.patch.object(network.Network, 'get_object')
 @mock.patch.object(api.NetworkRunner, 'create_vlan')
 class TestCreateNetworkPostCommit(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestCreateNetworkPostCommit, self).setUp()
+        self.mock_net_revision = mock.patch(
+            'networking_ansible.ml2.mech_driver.db_api.get_network_revision'
+        ).start()
+        self.mock_net_revision.return_value = self.mock_net.revision_number
+
     def test_create_network_postcommit(self,
                                        mock_create_network,
                                        mock_get_network):
@@ -172,6 +191,58 @@ class TestCreateNetworkPostCommit(base.NetworkingAnsibleTestCase):
         mock_create_network.assert_called_once_with(self.testhost,
                                                     self.testsegid)
 
+    def test_create_network_postcommit_multiple_hosts(self,
+                                                      mock_create_network,
+                                                      mock_get_network):
+        self.m_config.add_host('otherhost')
+        self.mech.kwargs['otherhost'] = {}
+        mock_get_network.return_value = self.mock_net
+        self.mech.create_network_postcommit(self.mock_net_context)
+        self.assertCountEqual([mock.call(self.testhost, self.testsegid),
+                               mock.call('otherhost', self.testsegid)],
+                              mock_create_network.call_args_list)
+
+    def test_create_network_postcommit_multiple_hosts_fails(
+            self, mock_create_network, mock_get_network):
+        self.m_config.add_host('otherhost')
+        self.mech.kwargs['otherhost'] = {}
+        mock_get_network.return_value = self.mock_net
+        mock_create_network.side_effect = [None, Exception('unreachable')]
+        e = self.assertRaises(netans_ml2exc.NetworkingAnsibleMechException,
+                              self.mech.create_network_postcommit,
+                              self.mock_net_context)
+        self.assertIn('unreachable', e.message)
+        self.assertEqual(2, mock_create_network.call_count)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.futurist.'
+                'ThreadPoolExecutor', wraps=futurist.ThreadPoolExecutor)
+    def test_create_network_postcommit_max_workers(self,
+                                                   mock_executor,
+                                                   mock_create_network,
+                                                   mock_get_network):
+        self.m_config.add_host('otherhost')
+        self.mech.kwargs['otherhost'] = {}
+        self.mech.create_network_postcommit(self.mock_net_context)
+        mock_executor.assert_called_once_with(max_workers=2)
+
+        mock_executor.reset_mock()
+        self.config(max_workers=1, group='ml2_ansible')
+        self.mech.create_network_postcommit(self.mock_net_context)
+        mock_executor.assert_called_once_with(max_workers=1)
+
+    def test_create_network_postcommit_physnet_hosts(self,
+                                                     mock_create_network,
+                                                     mock_get_network):
+        self.m_config.add_host('physnethost', physnets=[self.testphysnet])
+        self.m_config.add_host('otherphysnethost', physnets=['other'])
+        self.mech.kwargs['physnethost'] = {}
+        self.mech.kwargs['otherphysnethost'] = {}
+        mock_get_network.return_value = self.mock_net
+        self.mech.create_network_postcommit(self.mock_net_context)
+        self.assertCountEqual([mock.call(self.testhost, self.testsegid),
+                               mock.call('physnethost', self.testsegid)],
+                              mock_create_network.call_args_list)
+
     def test_create_network_postcommit_not_vlan(self,
                                                 mock_create_network,
                                                 mock_get_network):
@@ -193,6 +264,14 @@ class TestCreateNetworkPostCommit(base.NetworkingAnsibleTestCase):
         self.mech.create_network_postcommit(self.mock_net_context)
         mock_create_network.assert_not_called()
 
+    def test_create_network_postcommit_changed_while_locking(
+            self, mock_create_network, mock_get_network):
+        self.mock_net_revision.return_value = -1
+        mock_get_network.side_effect = [self.mock_net, None]
+        self.mech.create_network_postcommit(self.mock_net_context)
+        mock_create_network.assert_not_called()
+        self.assertEqual(2, mock_get_network.call_count)
+
     def test_create_network_postcommit_segment_was_deleted(self,
                                                            mock_create_network,
                                                            mock_get_network):
@@ -202,29 +281,29 @@ class TestCreateNetworkPostCommit(base.NetworkingAnsibleTestCase):
         mock_create_network.assert_not_called()
 
 
-@mock.patch.object(network.NetworkSegment, 'get_objects')
+@mock.patch('networking_ansible.ml2.mech_driver.db_api.has_vlan_segment')
 @mock.patch.object(api.NetworkRunner, 'delete_vlan')
 class TestDeleteNetworkPostCommit(base.NetworkingAnsibleTestCase):
     def test_delete_network_postcommit(self,
                                        mock_delete_network,
-                                       mock_get_segment):
-        mock_get_segment.return_value = []
+                                       mock_has_segment):
+        mock_has_segment.return_value = False
         self.mech.delete_network_postcommit(self.mock_net_context)
         mock_delete_network.assert_called_once_with(self.testhost,
                                                     self.testsegid)
 
     def test_delete_network_postcommit_manage_vlans_false(self,
                                                           mock_delete_network,
-                                                          mock_get_segment):
-        mock_get_segment.return_value = []
+                                                          mock_has_segment):
+        mock_has_segment.return_value = False
         self.m_config.inventory[self.testhost]['manage_vlans'] = False
         self.mech.delete_network_postcommit(self.mock_net_context)
         mock_delete_network.assert_not_called()
 
     def test_delete_network_postcommit_fails(self,
                                              mock_delete_network,
-                                             mock_get_segment):
-        mock_get_segment.return_value = []
+                                             mock_has_segment):
+        mock_has_segment.return_value = False
         mock_delete_network.side_effect = Exception()
         self.assertRaises(netans_ml2exc.NetworkingAnsibleMechException,
                           self.mech.delete_network_postcommit,
@@ -232,35 +311,50 @@ class TestDeleteNetworkPostCommit(base.NetworkingAnsibleTestCase):
         mock_delete_network.assert_called_once_with(self.testhost,
                                                     self.testsegid)
 
+    def test_delete_network_postcommit_physnet_hosts(self,
+                                                     mock_delete_network,
+                                                     mock_has_segment):
+        mock_has_segment.return_value = False
+        self.m_config.add_host('physnethost', physnets=[self.testphysnet])
+        self.m_config.add_host('otherphysnethost', physnets=['other'])
+        self.mech.kwargs['physnethost'] = {}
+        self.mech.kwargs['otherphysnethost'] = {}
+        self.mech.delete_network_postcommit(self.mock_net_context)
+        self.assertCountEqual([mock.call(self.testhost, self.testsegid),
+                               mock.call('physnethost', self.testsegid)],
+                              mock_delete_network.call_args_list)
+
     def test_delete_network_postcommit_not_vlan(self,
                                                 mock_delete_network,
-                                                mock_get_segment):
-        mock_get_segment.return_value = []
+                                                mock_has_segment):
+        mock_has_segment.return_value = False
         self.mock_net_context.current[provider_net.NETWORK_TYPE] = 'not-vlan'
         self.mech.delete_network_postcommit(self.mock_net_context)
         mock_delete_network.assert_not_called()
 
     def test_delete_network_postcommit_not_segmentation_id(self,
                                                            mock_delete_network,
-                                                           mock_get_segment):
-        mock_get_segment.return_value = []
+                                                           mock_has_segment):
+        mock_has_segment.return_value = False
         self.mock_net_context.current[provider_net.SEGMENTATION_ID] = ''
         self.mech.delete_network_postcommit(self.mock_net_context)
         mock_delete_network.assert_not_called()
 
     def test_delete_network_postcommit_recreated_segment(self,
                                                          mock_delete_network,
-                                                         mock_get_segment):
-        mock_get_segment.return_value = [self.mock_netseg]
+                                                         mock_has_segment):
+        mock_has_segment.return_value = True
         self.mech.delete_network_postcommit(self.mock_net_context)
         mock_delete_network.assert_not_called()
 
-    def test_delete_network_postcommit_different_segment(self,
-                                                         mock_delete_network,
-                                                         mock_get_segment):
-        mock_get_segment.return_value = [self.mock_netseg2]
+    def test_delete_network_postcommit_recreated_while_locking(
+            self, mock_delete_network, mock_has_segment):
+        mock_has_segment.side_effect = [False, True]
         self.mech.delete_network_postcommit(self.mock_net_context)
-        mock_delete_network.assert_called_once()
+        mock_delete_network.assert_not_called()
+        mock_has_segment.assert_called_with(
+            self.mock_net_context._plugin_context, self.testphysnet,
+            self.testsegid)
 
 
 @mock.patch('networking_ansible.ml2.mech_driver.'
@@ -319,6 +413,57 @@ class TestInit(base.NetworkingAnsibleTestCase):
         self.assertEqual(self.mech.kwargs,
                          {self.testhost: {'custom': 'param'}})
 
+    @mock.patch('networking_ansible.ml2.mech_driver.runner.tpool')
+    def test_intialize_runner_threads(self, m_tpool, m_config, m_coord):
+        self.config(runner_threads=5, runner_threads_per_switch=2,
+                    group='ml2_ansible')
+        m_coord.get_coordinator = lambda *args: mock.create_autospec(
+            coordination.CoordinationDriver).return_value
+        m_config.return_value = base.MockConfig()
+        self.mech.initialize()
+        m_tpool.set_num_threads.assert_called_once_with(5)
+        self.assertEqual(2, self.mech.net_runr._threads_per_switch)
+
+    def test_intialize_breakers(self, m_config, m_coord):
+        self.config(breaker_threshold=3, group='ml2_ansible')
+        m_config.return_value = base.MockConfig()
+        self.mech.initialize()
+        breakers = self.mech.net_runr._breakers
+        self.assertIsInstance(breakers, breaker.SwitchBreakers)
+        self.assertEqual(3, breakers._threshold)
+        self.assertEqual(60, breakers._reset_timeout)
+        self.assertEqual(self.mech.coordinator, breakers._coordinator)
+
+    def test_intialize_throttle(self, m_config, m_coord):
+        m_config.return_value = base.MockConfig(self.testhost,
+                                                self.testmac)
+        m_config.return_value.session_limits = {self.testhost: 2}
+        self.mech.initialize()
+        switch_throttle = self.mech.net_runr._throttle
+        self.assertIsInstance(switch_throttle, throttle.SwitchThrottle)
+        self.assertEqual({self.testhost: 2}, switch_throttle._session_limits)
+        # the sessions are shared by the neutron-servers
+        lock = switch_throttle._locks.get_lock(b'session')
+        self.assertEqual(self.mech.coordinator, lock._coordinator)
+
+    def test_intialize_no_throttle(self, m_config, m_coord):
+        m_config.return_value = base.MockConfig()
+        self.mech.initialize()
+        self.assertIsNone(self.mech.net_runr._throttle)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.rpc.AgentRunnerApi')
+    def test_intialize_use_agent(self, m_api, m_config, m_coord):
+        self.config(use_agent=True, group='ml2_ansible')
+        m_coord.get_coordinator = lambda *args: mock.create_autospec(
+            coordination.CoordinationDriver).return_value
+        m_config.return_value = base.MockConfig(self.testhost,
+                                                self.testmac)
+        self.mech.initialize()
+        self.assertIsInstance(self.mech.net_runr, runner.RemoteNetworkRunner)
+        self.assertTrue(self.mech.net_runr.has_host(self.testhost))
+        self.mech.net_runr.create_vlan(self.testhost, self.testsegid)
+        m_api.return_value.run_playbook.assert_called_once()
+
 
 @mock.patch('networking_ansible.ml2.mech_driver.'
             'AnsibleMechanismDriver._is_port_bound')
@@ -327,6 +472,12 @@ class TestInit(base.NetworkingAnsibleTestCase):
 @mock.patch('networking_ansible.ml2.mech_driver.'
             'AnsibleMechanismDriver.ensure_port')
 class TestUpdatePortPostCommit(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestUpdatePortPostCommit, self).setUp()
+        self.mock_delete_refs = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.delete_vlan_refs').start()
+
     def test_update_port_postcommit_port_bound_curr(self,
                                                     mock_ensure_port,
                                                     mock_prov_blocks,
@@ -370,7 +521,8 @@ class TestUpdatePortPostCommit(base.NetworkingAnsibleTestCase):
                                                        mock_port_bound):
         mappings = [(self.testhost, self.testport)]
         self.m_config.port_mappings = {self.test_hostid: mappings}
-        self.mock_port_context.current = self.mock_port_context.original
+        self.mock_port_context.current = self.mock_port_vm
+        self.mock_port_context.original = self._unbound(self.mock_port_vm)
         self.mech.update_port_postcommit(self.mock_port_context)
         mock_ensure_port.assert_called_once_with(
             self.mock_port_context.current,
@@ -380,6 +532,9 @@ class TestUpdatePortPostCommit(base.NetworkingAnsibleTestCase):
             self.testphysnet,
             self.mock_port_context,
             self.testsegid)
+        # the references are recorded again by ensure_port
+        self.mock_delete_refs.assert_called_once_with(
+            self.mock_port_context._plugin_context, self.testid2)
 
     def test_update_port_postcommit_port_w_direct_port(self,
                                                        mock_ensure_port,
@@ -389,7 +544,7 @@ class TestUpdatePortPostCommit(base.NetworkingAnsibleTestCase):
         sriov_host_id = '{}-{}'.format(self.test_hostid, self.test_pci_addr)
         self.m_config.port_mappings = {sriov_host_id: mappings}
         self.mock_port_context.current = self.mock_port_dt
-        self.mock_port_context.original = self.mock_port_dt
+        self.mock_port_context.original = self._unbound(self.mock_port_dt)
         self.mech.update_port_postcommit(self.mock_port_context)
         mock_ensure_port.assert_called_once_with(
             self.mock_port_context.current,
@@ -400,6 +555,86 @@ class TestUpdatePortPostCommit(base.NetworkingAnsibleTestCase):
             self.mock_port_context,
             self.testsegid)
 
+    def test_update_port_postcommit_normal_port_unchanged(self,
+                                                          mock_ensure_port,
+                                                          mock_prov_blocks,
+                                                          mock_port_bound):
+        mappings = [(self.testhost, self.testport)]
+        self.m_config.port_mappings = {self.test_hostid: mappings}
+        self.mock_port_context.current = dict(self.mock_port_vm.dict,
+                                              status='ACTIVE',
+                                              description='new')
+        self.mock_port_context.original = dict(self.mock_port_vm.dict,
+                                               status='DOWN',
+                                               description='old')
+        self.mech.update_port_postcommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+
+    def test_update_port_postcommit_direct_port_unchanged(self,
+                                                          mock_ensure_port,
+                                                          mock_prov_blocks,
+                                                          mock_port_bound):
+        mappings = [(self.testhost, self.testport)]
+        sriov_host_id = '{}-{}'.format(self.test_hostid, self.test_pci_addr)
+        self.m_config.port_mappings = {sriov_host_id: mappings}
+        self.mock_port_context.current = self.mock_port_dt
+        self.mock_port_context.original = self.mock_port_dt
+        self.mech.update_port_postcommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+
+    def _unbound(self, port):
+        return dict(port.dict, **{
+            portbindings.HOST_ID: '',
+            portbindings.VIF_TYPE: portbindings.VIF_TYPE_UNBOUND})
+
+
+class TestIsSwitchConfigChanged(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestIsSwitchConfigChanged, self).setUp()
+        self.port = dict(self.mock_port_bm.dict, **{
+            portbindings.PROFILE: self.profile_lli_no_mac,
+            'status': 'DOWN'})
+        self.mock_port_context.original = self.port
+
+    def _changed(self, **kwargs):
+        self.mock_port_context.current = dict(self.port, **kwargs)
+        return self.mech._is_switch_config_changed(self.mock_port_context)
+
+    def test_no_original(self):
+        self.mock_port_context.original = None
+        self.assertTrue(self._changed())
+
+    def test_unchanged(self):
+        self.assertFalse(self._changed(status='ACTIVE',
+                                       description='foo',
+                                       revision_number=3))
+
+    def test_host_changed(self):
+        self.assertTrue(self._changed(**{portbindings.HOST_ID: 'other'}))
+
+    def test_vif_type_changed(self):
+        self.assertTrue(self._changed(**{
+            portbindings.VIF_TYPE: portbindings.VIF_TYPE_UNBOUND}))
+
+    def test_network_changed(self):
+        self.assertTrue(self._changed(network_id='other'))
+
+    def test_trunk_changed(self):
+        self.assertTrue(self._changed(trunk_details={'trunk_id': 'foo',
+                                                     'sub_ports': []}))
+
+    def test_lli_changed(self):
+        self.assertTrue(self._changed(**{
+            portbindings.PROFILE: self.profile_lli_no_info}))
+
+    def test_pci_slot_changed(self):
+        self.assertTrue(self._changed(**{
+            portbindings.PROFILE: self.profile_pci_slot}))
+
+    def test_other_profile_key_changed(self):
+        profile = dict(self.profile_lli_no_mac, capabilities=['foo'])
+        self.assertFalse(self._changed(**{portbindings.PROFILE: profile}))
+
 
 class TestLinkInfo(base.NetworkingAnsibleTestCase):
     def test_switch_meta_from_link_info_obj_no_net(self):
@@ -484,72 +719,17 @@ class TestDeleteSwitchPort(base.NetworkingAnsibleTestCase):
         mock_delete.assert_called_once_with(self.testhost, self.testport)
 
 
-@mock.patch.object(ports.Port, 'get_objects')
-@mock.patch.object(network.Network, 'get_object')
+@mock.patch('networking_ansible.ml2.mech_driver.'
+            'db_api.has_bound_port_with_mac')
 class TestIsDeletedPortInUse(base.NetworkingAnsibleTestCase):
-    def test_is_in_use_no_ports(self,
-                                mock_net_get_object,
-                                mock_port_get_objects):
-        mock_port_get_objects.return_value = []
-        mock_net_get_object.return_value = self.mock_net
-        self.assertFalse(
-            self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
-
-    def test_is_in_use_one_port(self,
-                                mock_net_get_object,
-                                mock_port_get_objects):
-        mock_port_get_objects.return_value = [self.mock_port_bm]
-        mock_net_get_object.return_value = self.mock_net
-        self.assertTrue(
-            self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
-
-    def test_is_in_use_one_port_virtnet(self,
-                                        mock_net_get_object,
-                                        mock_port_get_objects):
-        mock_port_get_objects.return_value = [self.mock_port_bm]
-        mock_net_get_object.return_value = self.mock_net
-        self.mock_net.segments = [self.mock_netseg3]
-        self.assertFalse(
-            self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
-
-    def test_is_in_use_two_port_virtnet_and_physnet(self,
-                                                    mock_net_get_object,
-                                                    mock_port_get_objects):
-        mock_port_get_objects.return_value = [self.mock_port_bm,
-                                              self.mock_port_vm]
-        self.mock_net.segments = [self.mock_netseg3]
-
-        mock_net2 = mock.create_autospec(
-            network.Network).return_value
-        mock_net2.segments = [self.mock_netseg]
-
-        mock_net_get_object.side_effect = [self.mock_net, mock_net2]
+    def test_is_in_use(self, mock_has_bound_port):
+        mock_has_bound_port.return_value = True
         self.assertTrue(
             self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
+        mock_has_bound_port.assert_called_once_with(3, 2, self.testphysnet)
 
-    def test_is_in_use_one_port_no_net(self,
-                                       mock_net_get_object,
-                                       mock_port_get_objects):
-        mock_port_get_objects.return_value = [self.mock_port_bm]
-        mock_net_get_object.return_value = None
-        self.assertFalse(
-            self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
-
-    def test_is_in_use_one_port_no_binding(self,
-                                           mock_net_get_object,
-                                           mock_port_get_objects):
-        self.mock_port_bm.bindings.pop()
-        mock_port_get_objects.return_value = [self.mock_port_bm]
-        mock_net_get_object.return_value = self.mock_net
-        self.assertFalse(
-            self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
-
-    def test_is_in_use_one_port_no_lli(self,
-                                       mock_net_get_object,
-                                       mock_port_get_objects):
-        self.mock_port_bm.bindings[0].profile = {}
-        mock_port_get_objects.return_value = [self.mock_port_bm]
-        mock_net_get_object.return_value = self.mock_net
+    def test_is_not_in_use(self, mock_has_bound_port):
+        mock_has_bound_port.return_value = False
         self.assertFalse(
             self.mech._is_deleted_port_in_use(self.testphysnet, 2, 3))
 
@@ -558,6 +738,30 @@ class TestIsDeletedPortInUse(base.NetworkingAnsibleTestCase):
 @mock.patch.object(ports.Port, 'get_object')
 @mock.patch('network_runner.api.NetworkRunner.has_host')
 class TestEnsurePort(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestEnsurePort, self).setUp()
+        mock.patch.object(network.Network, 'get_object').start()
+        mock.patch.object(trunk.Trunk, 'get_object').start()
+        mock.patch('networking_ansible.ml2.mech_driver.'
+                   'db_api.get_port_version').start()
+        self.mock_get_refs = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.get_vlan_refs').start()
+        self.mock_get_refs.return_value = []
+        self.mock_add_ref = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.add_vlan_ref').start()
+        self.mock_delete_refs = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.delete_vlan_refs').start()
+        self.mock_has_backfill = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.has_vlan_ref_backfill').start()
+        self.mock_has_backfill.return_value = False
+        self.mock_add_backfill = mock.patch(
+            'networking_ansible.ml2.mech_driver.'
+            'db_api.add_vlan_ref_backfill').start()
+
     def test_ensure_port_no_host(self,
                                  mock_has_host,
                                  mock_port_get_object,
@@ -637,7 +841,8 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
             self.mock_port_bm,
             self.mock_port_context._plugin_context,
             self.testhost,
-            self.testport)
+            self.testport,
+            snapshot=mock.ANY)
 
     @mock.patch('networking_ansible.ml2.mech_driver.'
                 'AnsibleMechanismDriver._set_port_state')
@@ -660,7 +865,8 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
             self.mock_port_bm,
             self.mock_port_context._plugin_context,
             self.testhost,
-            self.testport)
+            self.testport,
+            snapshot=mock.ANY)
         self.mock_port_context.set_binding.assert_called_once()
 
     @mock.patch('networking_ansible.ml2.mech_driver.'
@@ -684,7 +890,8 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
             self.mock_port_bm,
             self.mock_port_context._plugin_context,
             self.testhost,
-            self.testport)
+            self.testport,
+            snapshot=mock.ANY)
         self.mock_port_context.set_binding.assert_not_called()
 
     @mock.patch('networking_ansible.ml2.mech_driver.'
@@ -705,16 +912,18 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
         mock_set_state.assert_called_with(self.mock_port_vm,
                                           self.mock_port_vm,
                                           self.testhost,
-                                          self.testport)
+                                          self.testport,
+                                          snapshot=mock.ANY)
 
     @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
-    @mock.patch.object(ports.Port, 'get_objects')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
     def test_ensure_port_normal_port_delete_true(self,
-                                                 mock_get_objects,
+                                                 mock_get_bindings,
                                                  mock_delete_vlan,
                                                  mock_has_host,
                                                  mock_port_get_object,
                                                  mock_get_lock):
+        mock_get_bindings.return_value = []
         self.mech.ensure_port(self.mock_port_vm,
                               self.mock_port_vm,
                               self.testhost,
@@ -723,14 +932,21 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
                               self.mock_port_vm,
                               self.testsegid,
                               delete=True)
+        mock_get_bindings.assert_called_with(
+            self.mock_port_vm,
+            self.mock_port_vm['network_id'],
+            c.COMPUTE_NOVA,
+            segmentation_id=self.testsegid,
+            exclude_port_id=self.mock_port_vm['id'],
+            host=self.test_hostid)
         mock_delete_vlan.assert_called_with(self.testhost,
                                             self.testport,
                                             self.testsegid)
 
     @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
-    @mock.patch.object(ports.Port, 'get_objects')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
     def test_ensure_port_no_delete_w_active_ports_vm(self,
-                                                     mock_get_objects,
+                                                     mock_get_bindings,
                                                      mock_delete_vlan,
                                                      mock_has_host,
                                                      mock_port_get_object,
@@ -742,7 +958,8 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
         the vlan won't be deleted from the compute node's switchport
         so that the other portbindings don't loose connectivity
         '''
-        mock_get_objects.return_value = [self.mock_port_bm]
+        mock_get_bindings.return_value = [
+            (self.testid, self.test_hostid, portbindings.VNIC_NORMAL, {})]
         self.mech.ensure_port(self.mock_port_vm,
                               self.mock_port_vm,
                               self.testhost,
@@ -752,15 +969,41 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
                               self.testsegid,
                               delete=True)
         mock_delete_vlan.assert_not_called()
+        # the switch isn't locked when there's nothing to do on it
+        mock_get_lock.assert_not_called()
 
     @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
-    @mock.patch.object(ports.Port, 'get_objects')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_active_ports_rechecked_in_lock(
+            self,
+            mock_get_bindings,
+            mock_delete_vlan,
+            mock_has_host,
+            mock_port_get_object,
+            mock_get_lock):
+        # a port is bound to the host while waiting for the lock
+        mock_get_bindings.side_effect = [
+            [], [(self.testid, self.test_hostid, portbindings.VNIC_NORMAL,
+                  {})]]
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        mock_delete_vlan.assert_not_called()
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
     def test_ensure_port_direct_port_delete_true(self,
-                                                 mock_get_objects,
+                                                 mock_get_bindings,
                                                  mock_delete_vlan,
                                                  mock_has_host,
                                                  mock_port_get_object,
                                                  mock_get_lock):
+        mock_get_bindings.return_value = []
         self.mech.ensure_port(self.mock_port_dt,
                               self.mock_port_dt,
                               self.testhost,
@@ -769,16 +1012,16 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
                               self.mock_port_dt,
                               self.testsegid,
                               delete=True)
+        # SR-IOV ports on other hosts are matched by their pci address
+        self.assertIsNone(mock_get_bindings.call_args[1]['host'])
         mock_delete_vlan.assert_called_with(self.testhost,
                                             self.testport,
                                             self.testsegid)
 
     @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
-    @mock.patch.object(ports.Port, 'get_objects')
-    @mock.patch.object(network.Network, 'get_object')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
     def test_ensure_port_no_delete_w_active_ports_dt(self,
-                                                     mock_get_object,
-                                                     mock_get_objects,
+                                                     mock_get_bindings,
                                                      mock_delete_vlan,
                                                      mock_has_host,
                                                      mock_port_get_object,
@@ -796,16 +1039,38 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
         sriov_host_id2 = '{}-{}'.format(self.test_hostid, self.test_pci_addr2)
         self.m_config.port_mappings = {sriov_host_id: mappings,
                                        sriov_host_id2: mappings}
+        mock_get_bindings.return_value = [
+            (self.testid2, self.test_hostid, portbindings.VNIC_DIRECT,
+             self.profile_pci_slot2)]
 
-        mock_get_object.return_value = self.mock_net
+        self.mech.ensure_port(self.mock_port_dt,
+                              self.mock_port_dt,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_dt,
+                              self.testsegid,
+                              delete=True)
+        mock_delete_vlan.assert_not_called()
 
-        # Reuse VM port by reassigning it DIRECT properties
-        self.mock_port_vm.dict[portbindings.VNIC_TYPE] = \
-            portbindings.VNIC_DIRECT
-        self.mock_port_vm.dict[portbindings.PROFILE] = \
-            self.profile_pci_slot2
-        self.mock_port_vm.bindings = [self.mock_portbind_dt]
-        mock_get_objects.return_value = [self.mock_port_vm]
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_w_active_ports_dt_other_port(
+            self,
+            mock_get_bindings,
+            mock_delete_vlan,
+            mock_has_host,
+            mock_port_get_object,
+            mock_get_lock):
+        # the other SR-IOV port is plugged into a different switch port
+        sriov_host_id = '{}-{}'.format(self.test_hostid, self.test_pci_addr)
+        sriov_host_id2 = '{}-{}'.format(self.test_hostid, self.test_pci_addr2)
+        self.m_config.port_mappings = {
+            sriov_host_id: [(self.testhost, self.testport)],
+            sriov_host_id2: [(self.testhost, 'otherport')]}
+        mock_get_bindings.return_value = [
+            (self.testid2, self.test_hostid, portbindings.VNIC_DIRECT,
+             self.profile_pci_slot2)]
 
         self.mech.ensure_port(self.mock_port_dt,
                               self.mock_port_dt,
@@ -815,11 +1080,161 @@ class TestEnsurePort(base.NetworkingAnsibleTestCase):
                               self.mock_port_dt,
                               self.testsegid,
                               delete=True)
+        mock_delete_vlan.assert_called_with(self.testhost,
+                                            self.testport,
+                                            self.testsegid)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._set_port_state')
+    def test_ensure_port_normal_port_refs_vlan(self,
+                                               mock_set_state,
+                                               mock_has_host,
+                                               mock_port_get_object,
+                                               mock_get_lock):
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid)
+        self.mock_add_ref.assert_called_once_with(
+            self.mock_port_vm, self.testhost, self.testport,
+            self.testsegid, self.testid2)
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_w_vlan_refs(self,
+                                            mock_get_bindings,
+                                            mock_delete_vlan,
+                                            mock_has_host,
+                                            mock_port_get_object,
+                                            mock_get_lock):
+        self.mock_get_refs.return_value = [self.testid]
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        self.mock_get_refs.assert_called_once_with(
+            self.mock_port_vm, self.testhost, self.testport, self.testsegid,
+            exclude_port_id=self.testid2)
+        # the bindings aren't looked through
+        mock_get_bindings.assert_not_called()
         mock_delete_vlan.assert_not_called()
+        mock_get_lock.assert_not_called()
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_drops_vlan_ref(self,
+                                               mock_get_bindings,
+                                               mock_delete_vlan,
+                                               mock_has_host,
+                                               mock_port_get_object,
+                                               mock_get_lock):
+        mock_get_bindings.return_value = []
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        self.mock_delete_refs.assert_called_once_with(
+            self.mock_port_vm, self.testid2, self.testhost, self.testport)
+        self.mock_add_ref.assert_not_called()
+        mock_delete_vlan.assert_called_once_with(self.testhost,
+                                                 self.testport,
+                                                 self.testsegid)
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_refs_found_ports(self,
+                                                 mock_get_bindings,
+                                                 mock_delete_vlan,
+                                                 mock_has_host,
+                                                 mock_port_get_object,
+                                                 mock_get_lock):
+        # a port plugged in before references were recorded
+        mock_get_bindings.return_value = [
+            (self.testid, self.test_hostid, portbindings.VNIC_NORMAL, {})]
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        self.mock_add_ref.assert_called_once_with(
+            self.mock_port_vm, self.testhost, self.testport,
+            self.testsegid, self.testid)
+        self.mock_add_backfill.assert_called_once_with(
+            self.mock_port_vm, self.testhost, self.testport, self.testsegid)
+        mock_delete_vlan.assert_not_called()
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_last_port_backfills_once(
+            self, mock_get_bindings, mock_delete_vlan, mock_has_host,
+            mock_port_get_object, mock_get_lock):
+        # the check before taking the lock backfills the vlan, the check
+        # under the lock doesn't look through the bindings again
+        self.mock_has_backfill.side_effect = (
+            lambda *args: self.mock_add_backfill.called)
+        mock_get_bindings.return_value = []
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        mock_get_bindings.assert_called_once()
+        self.mock_add_backfill.assert_called_once_with(
+            self.mock_port_vm, self.testhost, self.testport, self.testsegid)
+        mock_delete_vlan.assert_called_once_with(self.testhost,
+                                                 self.testport,
+                                                 self.testsegid)
+
+    @mock.patch('network_runner.api.NetworkRunner.delete_trunk_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_bindings')
+    def test_ensure_port_delete_backfilled(self,
+                                           mock_get_bindings,
+                                           mock_delete_vlan,
+                                           mock_has_host,
+                                           mock_port_get_object,
+                                           mock_get_lock):
+        self.mock_has_backfill.return_value = True
+        self.mech.ensure_port(self.mock_port_vm,
+                              self.mock_port_vm,
+                              self.testhost,
+                              self.testport,
+                              self.testphysnet,
+                              self.mock_port_vm,
+                              self.testsegid,
+                              delete=True)
+        mock_get_bindings.assert_not_called()
+        self.mock_add_backfill.assert_not_called()
+        mock_delete_vlan.assert_called_once_with(self.testhost,
+                                                 self.testport,
+                                                 self.testsegid)
 
 
 @mock.patch.object(ports.Port, 'get_object')
 class TestEnsureSubports(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestEnsureSubports, self).setUp()
+        mock.patch.object(network.Network, 'get_object').start()
+        mock.patch.object(trunk.Trunk, 'get_object').start()
+        mock.patch('networking_ansible.ml2.mech_driver.'
+                   'db_api.get_port_version').start()
+
     @mock.patch.object(coordination.CoordinationDriver, 'get_lock')
     def test_ensure_subports_deleted(self,
                                      mock_get_lock,
@@ -838,18 +1253,78 @@ class TestEnsureSubports(base.NetworkingAnsibleTestCase):
         mock_set_state.assert_called_once_with(self.mock_port_bm,
                                                'testdb',
                                                self.testhost,
-                                               self.testport)
+                                               self.testport,
+                                               snapshot=mock.ANY)
 
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_port_version')
     @mock.patch('networking_ansible.ml2.mech_driver.'
                 'AnsibleMechanismDriver._set_port_state')
     def test_ensure_subports_invalid(self,
                                      mock_set_state,
+                                     mock_get_version,
                                      mock_port_get_object):
-        mock_port_get_object.side_effect = [self.mock_port_bm, None]
+        # the port is deleted while waiting for the lock
+        mock_port_get_object.return_value = self.mock_port_bm
+        mock_get_version.return_value = None
         self.mech.ensure_subports(self.testid, 'testdb')
         mock_set_state.assert_not_called()
 
 
+@mock.patch('networking_ansible.ml2.mech_driver.db_api.get_port_version')
+@mock.patch('networking_ansible.ml2.mech_driver.'
+            'AnsibleMechanismDriver._read_port')
+class TestRefreshPort(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestRefreshPort, self).setUp()
+        self.mock_trunk.revision_number = 3
+        self.mock_subport_2 = mock.Mock(spec=trunk.SubPort)
+        self.mock_subport_2.segmentation_id = self.testsegid
+        self.mock_trunk.sub_ports.append(self.mock_subport_2)
+        self.snapshot = mech_driver.PortSnapshot(self.mock_port_bm,
+                                                 self.mock_net,
+                                                 self.mock_trunk)
+
+    def test_version(self, mock_read_port, mock_get_version):
+        self.assertEqual((self.mock_port_bm.revision_number,
+                          self.mock_net.revision_number,
+                          3, tuple(sorted([self.testsegid,
+                                           self.testsegid2]))),
+                         self.snapshot.version)
+
+    def test_version_no_trunk(self, mock_read_port, mock_get_version):
+        snapshot = mech_driver.PortSnapshot(self.mock_port_bm,
+                                            self.mock_net, None)
+        self.assertEqual((self.mock_port_bm.revision_number,
+                          self.mock_net.revision_number, None, ()),
+                         snapshot.version)
+
+    def test_refresh_port_unchanged(self, mock_read_port, mock_get_version):
+        mock_get_version.return_value = self.snapshot.version
+        self.assertIs(self.snapshot,
+                      self.mech._refresh_port('db', self.testid,
+                                              self.snapshot))
+        mock_read_port.assert_not_called()
+
+    def test_refresh_port_changed(self, mock_read_port, mock_get_version):
+        mock_get_version.return_value = (-1, -1, None, ())
+        self.assertEqual(mock_read_port.return_value,
+                         self.mech._refresh_port('db', self.testid,
+                                                 self.snapshot))
+        mock_read_port.assert_called_once_with('db', self.testid)
+
+    def test_refresh_port_no_snapshot(self, mock_read_port,
+                                      mock_get_version):
+        self.assertEqual(mock_read_port.return_value,
+                         self.mech._refresh_port('db', self.testid, None))
+
+    def test_refresh_port_deleted(self, mock_read_port, mock_get_version):
+        mock_get_version.return_value = None
+        self.assertIsNone(self.mech._refresh_port('db', self.testid,
+                                                  self.snapshot))
+        mock_read_port.assert_not_called()
+
+
 class TestSetPortState(base.NetworkingAnsibleTestCase):
     def test_set_port_state_no_port(self):
         self.assertRaises(ml2_exc.MechanismDriverError,
@@ -982,6 +1457,1182 @@ class TestSetPortState(base.NetworkingAnsibleTestCase):
                                                     self.testsegid)
 
 
+@mock.patch.object(network.Network, 'get_object')
+@mock.patch.object(trunk.Trunk, 'get_object')
+class TestPortStateCache(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestPortStateCache, self).setUp()
+        self.mech.port_states = port_state.PortStateCache(300)
+
+    def _set_port_state(self, port):
+        self.mech._set_port_state(port, 'db', self.testhost, self.testport)
+
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    def test_access_applied(self,
+                            mock_conf_access_port,
+                            mock_trunk,
+                            mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self._set_port_state(self.mock_port_bm)
+        self._set_port_state(self.mock_port_bm)
+        mock_conf_access_port.assert_called_once_with(self.testhost,
+                                                      self.testport,
+                                                      self.testsegid)
+
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    def test_access_vlan_changed(self,
+                                 mock_conf_access_port,
+                                 mock_trunk,
+                                 mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self._set_port_state(self.mock_port_bm)
+        self.mech.port_states.set(self.testhost, self.testport,
+                                  port_state.PortState.access(
+                                      self.testsegid2))
+        self._set_port_state(self.mock_port_bm)
+        self.assertEqual(2, mock_conf_access_port.call_count)
+
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    def test_access_failure_invalidates(self,
+                                        mock_conf_access_port,
+                                        mock_trunk,
+                                        mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self._set_port_state(self.mock_port_bm)
+        mock_conf_access_port.side_effect = Exception()
+        self.mech.port_states.set(self.testhost, self.testport,
+                                  port_state.PortState.deleted())
+        self.assertRaises(netans_ml2exc.NetworkingAnsibleMechException,
+                          self._set_port_state,
+                          self.mock_port_bm)
+        self.assertIsNone(self.mech.port_states.get(self.testhost,
+                                                    self.testport))
+
+    @mock.patch.object(api.NetworkRunner, 'conf_trunk_port')
+    def test_trunk_applied(self,
+                           mock_conf_trunk_port,
+                           mock_trunk,
+                           mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self._set_port_state(self.mock_port_bm)
+        self._set_port_state(self.mock_port_bm)
+        mock_conf_trunk_port.assert_called_once_with(self.testhost,
+                                                     self.testport,
+                                                     self.testsegid,
+                                                     [self.testsegid2])
+
+    def _set_trunk_port_state(self, applied):
+        self.mech.port_states.set(self.testhost, self.testport, applied)
+        self.runner_mocks = {
+            name: mock.patch.object(api.NetworkRunner, name).start()
+            for name in ('conf_trunk_port', 'add_trunk_vlan',
+                         'delete_trunk_vlan')}
+        self._set_port_state(self.mock_port_bm)
+        self.assertEqual(
+            port_state.PortState.trunk(self.testsegid, [self.testsegid2]),
+            self.mech.port_states.get(self.testhost, self.testport))
+
+    def test_trunk_diff(self, mock_trunk, mock_network):
+        self.config(trunk_diff_threshold=3, group='ml2_ansible')
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self._set_trunk_port_state(
+            port_state.PortState.trunk(self.testsegid, [98, 99]))
+        self.runner_mocks['conf_trunk_port'].assert_not_called()
+        self.runner_mocks['add_trunk_vlan'].assert_called_once_with(
+            self.testhost, self.testport, self.testsegid2)
+        self.assertEqual(
+            [mock.call(self.testhost, self.testport, 98),
+             mock.call(self.testhost, self.testport, 99)],
+            self.runner_mocks['delete_trunk_vlan'].call_args_list)
+
+    def test_trunk_diff_too_large(self, mock_trunk, mock_network):
+        self.config(trunk_diff_threshold=2, group='ml2_ansible')
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self._set_trunk_port_state(
+            port_state.PortState.trunk(self.testsegid, [98, 99]))
+        self.runner_mocks['conf_trunk_port'].assert_called_once_with(
+            self.testhost, self.testport, self.testsegid, [self.testsegid2])
+        self.runner_mocks['add_trunk_vlan'].assert_not_called()
+        self.runner_mocks['delete_trunk_vlan'].assert_not_called()
+
+    def test_trunk_diff_disabled(self, mock_trunk, mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self._set_trunk_port_state(
+            port_state.PortState.trunk(self.testsegid, []))
+        self.runner_mocks['conf_trunk_port'].assert_called_once()
+        self.runner_mocks['add_trunk_vlan'].assert_not_called()
+
+    def test_trunk_diff_native_vlan_changed(self, mock_trunk, mock_network):
+        self.config(trunk_diff_threshold=3, group='ml2_ansible')
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self._set_trunk_port_state(
+            port_state.PortState.trunk(99, [self.testsegid2]))
+        self.runner_mocks['conf_trunk_port'].assert_called_once()
+        self.runner_mocks['add_trunk_vlan'].assert_not_called()
+
+    def test_trunk_diff_incomplete(self, mock_trunk, mock_network):
+        self.config(trunk_diff_threshold=3, group='ml2_ansible')
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        # only the vlans added since the port was configured are known
+        self._set_trunk_port_state(port_state.PortState(
+            port_state.TRUNK, None, vlan_set.VlanSet([98]), False))
+        self.runner_mocks['conf_trunk_port'].assert_called_once()
+        self.runner_mocks['add_trunk_vlan'].assert_not_called()
+
+    @mock.patch.object(api.NetworkRunner, 'add_trunk_vlan')
+    def test_add_trunk_vlan_applied(self,
+                                    mock_add_trunk_vlan,
+                                    mock_trunk,
+                                    mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self._set_port_state(self.mock_port_vm)
+        self._set_port_state(self.mock_port_vm)
+        mock_add_trunk_vlan.assert_called_once_with(self.testhost,
+                                                    self.testport,
+                                                    self.testsegid)
+
+    @mock.patch.object(api.NetworkRunner, 'delete_trunk_vlan')
+    def test_delete_trunk_vlan(self,
+                               mock_delete_trunk_vlan,
+                               mock_trunk,
+                               mock_network):
+        self.mech.port_states.add_trunk_vlan(self.testhost, self.testport,
+                                             self.testsegid)
+        self.mech._delete_trunk_vlan(self.testhost, self.testport,
+                                     self.testsegid)
+        mock_delete_trunk_vlan.assert_called_once_with(self.testhost,
+                                                       self.testport,
+                                                       self.testsegid)
+        self.assertFalse(self.mech.port_states.has_trunk_vlan(
+            self.testhost, self.testport, self.testsegid))
+
+    @mock.patch.object(api.NetworkRunner, 'delete_trunk_vlan')
+    def test_delete_trunk_vlan_not_trunked(self,
+                                           mock_delete_trunk_vlan,
+                                           mock_trunk,
+                                           mock_network):
+        self.mech.port_states.set(self.testhost, self.testport,
+                                  port_state.PortState.trunk(
+                                      self.testsegid, [self.testsegid2]))
+        self.mech._delete_trunk_vlan(self.testhost, self.testport,
+                                     self.testsegid)
+        mock_delete_trunk_vlan.assert_not_called()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_trunk_vlan')
+    def test_delete_trunk_vlan_partial_state(self,
+                                             mock_delete_trunk_vlan,
+                                             mock_trunk,
+                                             mock_network):
+        # other vlans may be on the port that the cache doesn't know about
+        self.mech.port_states.add_trunk_vlan(self.testhost, self.testport,
+                                             self.testsegid2)
+        self.mech._delete_trunk_vlan(self.testhost, self.testport,
+                                     self.testsegid)
+        mock_delete_trunk_vlan.assert_called_once()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_trunk_vlan')
+    def test_delete_trunk_vlan_fails(self,
+                                     mock_delete_trunk_vlan,
+                                     mock_trunk,
+                                     mock_network):
+        mock_delete_trunk_vlan.side_effect = (
+            net_runr_exc.NetworkRunnerException('failed'))
+        self.mech.port_states.add_trunk_vlan(self.testhost, self.testport,
+                                             self.testsegid)
+        self.assertRaises(net_runr_exc.NetworkRunnerException,
+                          self.mech._delete_trunk_vlan,
+                          self.testhost, self.testport, self.testsegid)
+        self.assertIsNone(self.mech.port_states.get(self.testhost,
+                                                    self.testport))
+
+    @mock.patch.object(api.NetworkRunner, 'delete_port')
+    def test_delete_switch_port_applied(self,
+                                        mock_delete_port,
+                                        mock_trunk,
+                                        mock_network):
+        self.mech._delete_switch_port(self.testhost, self.testport)
+        self.mech._delete_switch_port(self.testhost, self.testport)
+        mock_delete_port.assert_called_once_with(self.testhost,
+                                                 self.testport)
+
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    def test_disabled(self,
+                      mock_conf_access_port,
+                      mock_trunk,
+                      mock_network):
+        self.mech.port_states = port_state.PortStateCache(0)
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self._set_port_state(self.mock_port_bm)
+        self._set_port_state(self.mock_port_bm)
+        self.assertEqual(2, mock_conf_access_port.call_count)
+
+
+class TestLazyVlans(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestLazyVlans, self).setUp()
+        self.config(lazy_vlans=True, group='ml2_ansible')
+        self.mock_portbind_bm.host = self.test_hostid
+        self.mock_port_bm.id = 'otherportid'
+        self.mock_port_bm.device_owner = c.BAREMETAL_NONE
+        self.mock_netseg.network_id = self.testid
+
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_create_network_postcommit_lazy(self, mock_create_vlan):
+        self.mech.create_network_postcommit(self.mock_net_context)
+        mock_create_vlan.assert_not_called()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    def test_delete_network_postcommit_lazy(self, mock_delete_vlan):
+        self.mech.delete_network_postcommit(self.mock_net_context)
+        mock_delete_vlan.assert_not_called()
+
+    @mock.patch.object(network.Network, 'get_object')
+    @mock.patch.object(trunk.Trunk, 'get_object')
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_set_port_state_creates_vlan(self,
+                                         mock_create_vlan,
+                                         mock_conf_access_port,
+                                         mock_trunk,
+                                         mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self.mech._set_port_state(self.mock_port_bm, 'db',
+                                  self.testhost, self.testport)
+        mock_create_vlan.assert_called_once_with(self.testhost,
+                                                 self.testsegid)
+        mock_conf_access_port.assert_called_once_with(self.testhost,
+                                                      self.testport,
+                                                      self.testsegid)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    @mock.patch.object(network.Network, 'get_object')
+    @mock.patch.object(trunk.Trunk, 'get_object')
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_set_port_state_other_port_binding(self,
+                                               mock_create_vlan,
+                                               mock_conf_access_port,
+                                               mock_trunk,
+                                               mock_network,
+                                               mock_get_bindings):
+        # another port on the segment has its local link information but
+        # isn't bound yet, so the vlan may not be on the switch
+        mock_get_bindings.return_value = [
+            self._binding(vif_type=portbindings.VIF_TYPE_UNBOUND)]
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self.mech._set_port_state(self.mock_port_bm, 'db',
+                                  self.testhost, self.testport)
+        mock_create_vlan.assert_called_once_with(self.testhost,
+                                                 self.testsegid)
+        mock_conf_access_port.assert_called_once()
+
+    @mock.patch.object(network.Network, 'get_object')
+    @mock.patch.object(trunk.Trunk, 'get_object')
+    @mock.patch.object(api.NetworkRunner, 'conf_trunk_port')
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_set_port_state_trunk_creates_vlans(self,
+                                                mock_create_vlan,
+                                                mock_conf_trunk_port,
+                                                mock_trunk,
+                                                mock_network):
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = self.mock_trunk
+        self.mech._set_port_state(self.mock_port_bm, 'db',
+                                  self.testhost, self.testport)
+        self.assertEqual([mock.call(self.testhost, self.testsegid),
+                          mock.call(self.testhost, self.testsegid2)],
+                         mock_create_vlan.call_args_list)
+
+    @mock.patch.object(network.Network, 'get_object')
+    @mock.patch.object(trunk.Trunk, 'get_object')
+    @mock.patch.object(api.NetworkRunner, 'conf_access_port')
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_set_port_state_manage_vlans_false(self,
+                                               mock_create_vlan,
+                                               mock_conf_access_port,
+                                               mock_trunk,
+                                               mock_network):
+        self.m_config.inventory[self.testhost]['manage_vlans'] = False
+        mock_network.return_value = self.mock_net
+        mock_trunk.return_value = None
+        self.mech._set_port_state(self.mock_port_bm, 'db',
+                                  self.testhost, self.testport)
+        mock_create_vlan.assert_not_called()
+        mock_conf_access_port.assert_called_once()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    def test_delete_lazy_vlans(self, mock_in_use, mock_delete_vlan):
+        mock_in_use.return_value = False
+        self.mech._delete_lazy_vlans('db', self.testhost, self.testid,
+                                     [self.testsegid])
+        mock_in_use.assert_called_once_with('db', self.testhost,
+                                            self.testsegid, self.testid)
+        mock_delete_vlan.assert_called_once_with(self.testhost,
+                                                 self.testsegid)
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    def test_delete_lazy_vlans_in_use(self, mock_in_use, mock_delete_vlan):
+        mock_in_use.return_value = True
+        self.mech._delete_lazy_vlans('db', self.testhost, self.testid,
+                                     [self.testsegid])
+        mock_delete_vlan.assert_not_called()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    def test_delete_lazy_vlans_not_lazy(self, mock_in_use, mock_delete_vlan):
+        self.config(lazy_vlans=False, group='ml2_ansible')
+        self.mech._delete_lazy_vlans('db', self.testhost, self.testid,
+                                     [self.testsegid])
+        mock_in_use.assert_not_called()
+        mock_delete_vlan.assert_not_called()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    def test_delete_lazy_vlans_fails(self, mock_in_use, mock_delete_vlan):
+        mock_in_use.return_value = False
+        mock_delete_vlan.side_effect = Exception()
+        self.assertRaises(netans_ml2exc.NetworkingAnsibleMechException,
+                          self.mech._delete_lazy_vlans,
+                          'db', self.testhost, self.testid, [self.testsegid])
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_port_version')
+    @mock.patch.object(coordination.CoordinationDriver, 'get_lock')
+    @mock.patch.object(ports.Port, 'get_object')
+    @mock.patch.object(api.NetworkRunner, 'delete_port')
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_deleted_port_in_use')
+    def test_ensure_port_delete_deletes_vlan(self,
+                                             mock_is_deleted,
+                                             mock_in_use,
+                                             mock_delete_vlan,
+                                             mock_delete_port,
+                                             mock_port_get_object,
+                                             mock_get_lock,
+                                             mock_get_version):
+        mock_port_get_object.return_value = None
+        mock_get_version.return_value = None
+        mock_is_deleted.return_value = False
+        mock_in_use.return_value = False
+        self.mech.ensure_port(
+            self.mock_port_context.current,
+            self.mock_port_context._plugin_context,
+            self.testhost,
+            self.testport,
+            self.testphysnet,
+            self.mock_port_context,
+            self.testsegid,
+            delete=True)
+        mock_delete_port.assert_called_once_with(self.testhost,
+                                                 self.testport)
+        mock_delete_vlan.assert_called_once_with(self.testhost,
+                                                 self.testsegid)
+
+    def _binding(self, port_id='otherportid', device_owner=c.BAREMETAL_NONE,
+                 profile=None, vif_type=portbindings.VIF_TYPE_OTHER):
+        return (port_id, self.testid, device_owner, self.test_hostid,
+                portbindings.VNIC_BAREMETAL, vif_type,
+                self.profile_lli_no_mac if profile is None else profile)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    def test_is_vlan_in_use_no_ports(self, mock_get_bindings):
+        mock_get_bindings.return_value = []
+        self.assertFalse(self.mech._is_vlan_in_use(
+            'db', self.testhost, self.testsegid, self.testid))
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    def test_is_vlan_in_use(self, mock_get_bindings):
+        mock_get_bindings.return_value = [self._binding()]
+        self.assertTrue(self.mech._is_vlan_in_use(
+            'db', self.testhost, self.testsegid, self.testid))
+        # a single query for the ports and the subports' parents
+        mock_get_bindings.assert_called_once_with(
+            'db', self.testsegid, exclude_port_id=self.testid)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    def test_is_vlan_in_use_other_switch(self, mock_get_bindings):
+        mock_get_bindings.return_value = [self._binding()]
+        self.assertFalse(self.mech._is_vlan_in_use(
+            'db', 'otherswitch', self.testsegid, self.testid))
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    def test_is_vlan_in_use_no_lli(self, mock_get_bindings):
+        mock_get_bindings.return_value = [self._binding(profile={})]
+        self.assertFalse(self.mech._is_vlan_in_use(
+            'db', self.testhost, self.testsegid, self.testid))
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_vlan_port_bindings')
+    def test_is_vlan_in_use_unsupported(self, mock_get_bindings):
+        # a subport whose trunk is gone isn't plugged in
+        mock_get_bindings.return_value = [
+            self._binding(device_owner='trunk:subport')]
+        self.assertFalse(self.mech._is_vlan_in_use(
+            'db', self.testhost, self.testsegid, self.testid))
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._set_port_state')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._refresh_port')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._read_port')
+    def test_ensure_subports_deletes_removed_vlans(self,
+                                                   mock_read_port,
+                                                   mock_refresh_port,
+                                                   mock_set_state,
+                                                   mock_in_use,
+                                                   mock_delete_vlan):
+        mock_in_use.return_value = False
+        mock_refresh_port.return_value = mech_driver.PortSnapshot(
+            self.mock_port_bm, self.mock_net, self.mock_trunk)
+        # the parent port's network and a remaining subport still use
+        # their vlans
+        self.mech._ensure_subports_on_switch(
+            self.testid, 'db', self.testhost, self.testport,
+            [self.testsegid, self.testsegid2, 99])
+        mock_in_use.assert_called_once_with('db', self.testhost, 99,
+                                            self.testid)
+        mock_delete_vlan.assert_called_once_with(self.testhost, 99)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'db_api.get_port_version')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._read_port')
+    @mock.patch.object(api.NetworkRunner, 'delete_port')
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_vlan_in_use')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._is_deleted_port_in_use')
+    def test_ensure_port_unbound_trunk_deletes_vlans(self,
+                                                     mock_is_deleted,
+                                                     mock_in_use,
+                                                     mock_delete_vlan,
+                                                     mock_delete_port,
+                                                     mock_read_port,
+                                                     mock_get_version):
+        # the trunk parent is still there, without local link information
+        self.mock_portbind_bm.profile = {}
+        snapshot = mech_driver.PortSnapshot(self.mock_port_bm,
+                                            self.mock_net, self.mock_trunk)
+        mock_read_port.return_value = snapshot
+        mock_get_version.return_value = snapshot.version
+        mock_is_deleted.return_value = False
+        mock_in_use.return_value = False
+        self.mech.ensure_port(
+            self.mock_port_context.current,
+            self.mock_port_context._plugin_context,
+            self.testhost,
+            self.testport,
+            self.testphysnet,
+            self.mock_port_context,
+            self.testsegid,
+            delete=True)
+        mock_delete_port.assert_called_once_with(self.testhost,
+                                                 self.testport)
+        self.assertEqual([mock.call(self.testhost, self.testsegid),
+                          mock.call(self.testhost, self.testsegid2)],
+                         mock_delete_vlan.call_args_list)
+
+
+@mock.patch('networking_ansible.ml2.mech_driver.db_api', autospec=True)
+@mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+            autospec=True)
+@mock.patch('networking_ansible.ml2.mech_driver.'
+            'AnsibleMechanismDriver.ensure_port')
+class TestAsyncMode(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestAsyncMode, self).setUp()
+        self.config(async_mode=True, group='ml2_ansible')
+        self.mech.journal = mock.Mock()
+        self.mock_port_context.current = self.mock_port_bm.dict
+        self.mock_port_bm.dict[portbindings.PROFILE] = self.profile_lli_no_mac
+        self.mock_port_context.original = dict(self.mock_port_bm.dict)
+        self.mock_port_context.original[portbindings.VIF_TYPE] = \
+            portbindings.VIF_TYPE_UNBOUND
+
+    def _port_record(self, db, op_type, port, provision=False):
+        return mock.call(db, op_type, self.testhost, port['id'],
+                         {'port': port,
+                          'switch_port': self.testport,
+                          'physnet': self.testphysnet,
+                          'segmentation_id': self.testsegid,
+                          'provision': provision})
+
+    @mock.patch('networking_ansible.ml2.mech_driver.journal.Journal')
+    @mock.patch('networking_ansible.ml2.mech_driver.registry')
+    def test_initialize(self,
+                        mock_registry,
+                        mock_journal,
+                        mock_ensure_port,
+                        mock_prov_blocks,
+                        mock_db_api):
+        with mock.patch('networking_ansible.ml2.mech_driver.config.Config',
+                        return_value=self.m_config), \
+                mock.patch.object(validators.ChoiceValidator, '__call__',
+                                  return_value=None), \
+                mock.patch(c.COORDINATION):
+            self.mech.initialize()
+        self.assertEqual(mock_journal.return_value, self.mech.journal)
+        mock_registry.subscribe.assert_called_once_with(
+            self.mech._start_journal, resources.PROCESS, events.AFTER_INIT)
+        self.mech._start_journal(resources.PROCESS, events.AFTER_INIT, None)
+        mock_journal.return_value.start.assert_called_once_with()
+
+    @mock.patch('networking_ansible.ml2.mech_driver.sharding.SwitchRing')
+    @mock.patch('networking_ansible.ml2.mech_driver.journal.Journal')
+    @mock.patch('networking_ansible.ml2.mech_driver.registry')
+    def test_initialize_switch_sharding(self,
+                                        mock_registry,
+                                        mock_journal,
+                                        mock_ring,
+                                        mock_ensure_port,
+                                        mock_prov_blocks,
+                                        mock_db_api):
+        self.config(switch_sharding=True, group='ml2_ansible')
+        with mock.patch('networking_ansible.ml2.mech_driver.config.Config',
+                        return_value=self.m_config), \
+                mock.patch.object(validators.ChoiceValidator, '__call__',
+                                  return_value=None), \
+                mock.patch(c.COORDINATION):
+            self.mech.initialize()
+        # each worker joins the ring with a coordinator of its own, the
+        # port states are forgotten when switches move
+        mock_ring.assert_called_once_with(
+            mech_driver.CONF.ml2_ansible.coordination_uri,
+            on_change=self.mech.port_states.clear)
+        self.assertEqual(mock_ring.return_value,
+                         mock_journal.call_args[0][-1])
+        # the switches this process owns are locked locally
+        self.assertIsNone(self.mech.locks.get_lock(b'switch')._coordinator)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.sharding.SwitchRing')
+    @mock.patch('networking_ansible.ml2.mech_driver.journal.Journal')
+    @mock.patch('networking_ansible.ml2.mech_driver.registry')
+    def test_initialize_port_state_ttl(self,
+                                       mock_registry,
+                                       mock_journal,
+                                       mock_ring,
+                                       mock_ensure_port,
+                                       mock_prov_blocks,
+                                       mock_db_api):
+        self.config(port_state_ttl=60, group='ml2_ansible')
+        for sharded, ttl in ((False, 0), (True, 60)):
+            self.config(switch_sharding=sharded, group='ml2_ansible')
+            with mock.patch('networking_ansible.ml2.mech_driver.config.'
+                            'Config', return_value=self.m_config), \
+                    mock.patch.object(validators.ChoiceValidator,
+                                      '__call__', return_value=None), \
+                    mock.patch(c.COORDINATION):
+                self.mech.initialize()
+            # other processes configure the same switch ports unless
+            # the switches are sharded
+            self.assertEqual(ttl, self.mech.port_states.ttl)
+
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_create_network_precommit(self,
+                                      mock_create_vlan,
+                                      mock_ensure_port,
+                                      mock_prov_blocks,
+                                      mock_db_api):
+        self.mech.create_network_precommit(self.mock_net_context)
+        mock_create_vlan.assert_not_called()
+        mock_db_api.record.assert_called_once_with(
+            self.mock_net_context._plugin_context, c.OP_CREATE_VLAN,
+            self.testhost, self.testsegid,
+            {'network_id': self.testsegid,
+             'segmentation_id': self.testsegid})
+
+    @mock.patch.object(api.NetworkRunner, 'create_vlan')
+    def test_create_network_postcommit(self,
+                                       mock_create_vlan,
+                                       mock_ensure_port,
+                                       mock_prov_blocks,
+                                       mock_db_api):
+        self.mech.create_network_postcommit(self.mock_net_context)
+        mock_create_vlan.assert_not_called()
+        mock_db_api.record.assert_not_called()
+        self.mech.journal.wake.assert_called_once_with()
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    def test_delete_network_precommit(self,
+                                      mock_delete_vlan,
+                                      mock_ensure_port,
+                                      mock_prov_blocks,
+                                      mock_db_api):
+        self.mech.delete_network_precommit(self.mock_net_context)
+        mock_delete_vlan.assert_not_called()
+        mock_db_api.record.assert_called_once_with(
+            self.mock_net_context._plugin_context, c.OP_DELETE_VLAN,
+            self.testhost, self.testsegid,
+            {'network_id': self.testsegid,
+             'segmentation_id': self.testsegid,
+             'physnet': self.testphysnet})
+
+    @mock.patch.object(api.NetworkRunner, 'delete_vlan')
+    def test_delete_network_postcommit(self,
+                                       mock_delete_vlan,
+                                       mock_ensure_port,
+                                       mock_prov_blocks,
+                                       mock_db_api):
+        self.mech.delete_network_postcommit(self.mock_net_context)
+        mock_delete_vlan.assert_not_called()
+        mock_db_api.record.assert_not_called()
+        self.mech.journal.wake.assert_called_once_with()
+
+    def test_bind_port_baremetal(self,
+                                 mock_ensure_port,
+                                 mock_prov_blocks,
+                                 mock_db_api):
+        self.mech.bind_port(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        mock_prov_blocks.add_provisioning_component.assert_called_once_with(
+            self.mock_port_context._plugin_context,
+            self.testid,
+            resources.PORT,
+            c.NETWORKING_ENTITY)
+        self.mock_port_context.set_binding.assert_called_once_with(
+            self.testid, portbindings.VIF_TYPE_OTHER, {})
+        mock_db_api.record.assert_not_called()
+
+    def test_bind_port_normal(self,
+                              mock_ensure_port,
+                              mock_prov_blocks,
+                              mock_db_api):
+        self.m_config.port_mappings = {
+            self.test_hostid: [(self.testhost, self.testport)]}
+        self.mock_port_context.current = self.mock_port_vm
+        self.mech.bind_port(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        mock_prov_blocks.add_provisioning_component.assert_not_called()
+        self.mock_port_context.set_binding.assert_not_called()
+
+    def test_update_port_precommit_bound(self,
+                                         mock_ensure_port,
+                                         mock_prov_blocks,
+                                         mock_db_api):
+        self.mech.update_port_precommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        mock_prov_blocks.provisioning_complete.assert_not_called()
+        self.assertEqual(
+            [self._port_record(self.mock_port_context._plugin_context,
+                               c.OP_UPDATE_PORT,
+                               self.mock_port_context.current,
+                               provision=True)],
+            mock_db_api.record.call_args_list)
+
+    def test_update_port_precommit_already_bound(self,
+                                                 mock_ensure_port,
+                                                 mock_prov_blocks,
+                                                 mock_db_api):
+        self.mock_port_context.original = self.mock_port_context.current
+        self.mech.update_port_precommit(self.mock_port_context)
+        mock_prov_blocks.provisioning_complete.assert_not_called()
+        mock_db_api.record.assert_not_called()
+
+    def test_update_port_precommit_unbound(self,
+                                           mock_ensure_port,
+                                           mock_prov_blocks,
+                                           mock_db_api):
+        self.mock_port_context.original = self.mock_port_context.current
+        self.mock_port_context.current = dict(self.mock_port_bm.dict)
+        self.mock_port_context.current[portbindings.VIF_TYPE] = \
+            portbindings.VIF_TYPE_UNBOUND
+        self.mech.update_port_precommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        self.assertEqual(
+            [self._port_record(self.mock_port_context._plugin_context,
+                               c.OP_UPDATE_PORT,
+                               self.mock_port_context.original)],
+            mock_db_api.record.call_args_list)
+
+    def test_update_port_precommit_normal(self,
+                                          mock_ensure_port,
+                                          mock_prov_blocks,
+                                          mock_db_api):
+        self.m_config.port_mappings = {
+            self.test_hostid: [(self.testhost, self.testport)]}
+        self.mock_port_context.current = self.mock_port_vm
+        self.mech.update_port_precommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        self.assertEqual(
+            [self._port_record(self.mock_port_context._plugin_context,
+                               c.OP_UPDATE_PORT,
+                               self.mock_port_vm)],
+            mock_db_api.record.call_args_list)
+
+    def test_update_port_postcommit(self,
+                                    mock_ensure_port,
+                                    mock_prov_blocks,
+                                    mock_db_api):
+        self.mech.update_port_postcommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        mock_prov_blocks.provisioning_complete.assert_not_called()
+        mock_db_api.record.assert_not_called()
+        self.mech.journal.wake.assert_called_once_with()
+
+    def test_delete_port_precommit(self,
+                                   mock_ensure_port,
+                                   mock_prov_blocks,
+                                   mock_db_api):
+        self.mech.delete_port_precommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        self.assertEqual(
+            [self._port_record(self.mock_port_context._plugin_context,
+                               c.OP_DELETE_PORT,
+                               self.mock_port_context.current)],
+            mock_db_api.record.call_args_list)
+
+    def test_delete_port_postcommit(self,
+                                    mock_ensure_port,
+                                    mock_prov_blocks,
+                                    mock_db_api):
+        self.mech.delete_port_postcommit(self.mock_port_context)
+        mock_ensure_port.assert_not_called()
+        mock_db_api.record.assert_not_called()
+        self.mech.journal.wake.assert_called_once_with()
+
+    @mock.patch.object(ports.Port, 'get_object')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._set_port_state')
+    def test_ensure_subports(self,
+                             mock_set_state,
+                             mock_port_get_object,
+                             mock_ensure_port,
+                             mock_prov_blocks,
+                             mock_db_api):
+        mock_port_get_object.return_value = self.mock_port_bm
+        self.mech.ensure_subports(self.testid, 'testdb')
+        mock_set_state.assert_not_called()
+        mock_db_api.record.assert_called_once_with(
+            'testdb', c.OP_UPDATE_SUBPORTS, self.testhost, self.testid,
+            {'port_id': self.testid, 'switch_port': self.testport,
+             'removed_vlans': []})
+        self.mech.journal.wake.assert_called_once_with()
+
+
+@mock.patch('networking_ansible.ml2.mech_driver.db_api', autospec=True)
+class TestRetrySyncFailures(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestRetrySyncFailures, self).setUp()
+        self.config(retry_sync_failures=True, group='ml2_ansible')
+        self.mech.journal = mock.Mock()
+        self.unreachable = net_runr_exc.NetworkRunnerException(
+            'fatal: [testhost]: UNREACHABLE!')
+
+    @mock.patch('networking_ansible.ml2.mech_driver.journal.Journal')
+    @mock.patch('networking_ansible.ml2.mech_driver.registry')
+    def test_initialize(self, mock_registry, mock_journal, mock_db_api):
+        with mock.patch('networking_ansible.ml2.mech_driver.config.Config',
+                        return_value=self.m_config), \
+                mock.patch.object(validators.ChoiceValidator, '__call__',
+                                  return_value=None), \
+                mock.patch(c.COORDINATION):
+            self.mech.initialize()
+        self.assertEqual(mock_journal.return_value, self.mech.journal)
+        mock_registry.subscribe.assert_called_once_with(
+            self.mech._start_journal, resources.PROCESS, events.AFTER_INIT)
+
+    def test_create_network_retried(self, mock_db_api):
+        with mock.patch.object(self.mech, '_create_vlan_on_host',
+                               side_effect=self.unreachable):
+            self.mech.create_network_postcommit(self.mock_net_context)
+        mock_db_api.record.assert_called_once_with(
+            self.mock_net_context._plugin_context, c.OP_CREATE_VLAN,
+            self.testhost, self.testsegid,
+            {'network_id': self.testsegid,
+             'segmentation_id': self.testsegid})
+        self.mech.journal.wake.assert_called_once_with()
+
+    def test_create_network_permanent_failure(self, mock_db_api):
+        error = net_runr_exc.NetworkRunnerException(
+            'fatal: [testhost]: FAILED! => {"msg": "invalid vlan"}\n'
+            'PLAY RECAP ***\n'
+            'testhost : ok=1 changed=0 unreachable=0 failed=1')
+        with mock.patch.object(self.mech, '_create_vlan_on_host',
+                               side_effect=error):
+            self.assertRaises(netans_ml2exc.NetworkingAnsibleMechException,
+                              self.mech.create_network_postcommit,
+                              self.mock_net_context)
+        mock_db_api.record.assert_not_called()
+
+    def test_delete_network_retried(self, mock_db_api):
+        with mock.patch.object(self.mech, '_delete_vlan_on_host',
+                               side_effect=self.unreachable):
+            self.mech.delete_network_postcommit(self.mock_net_context)
+        mock_db_api.record.assert_called_once_with(
+            self.mock_net_context._plugin_context, c.OP_DELETE_VLAN,
+            self.testhost, self.testsegid,
+            {'network_id': self.testsegid,
+             'segmentation_id': self.testsegid,
+             'physnet': self.testphysnet})
+        self.mech.journal.wake.assert_called_once_with()
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_delete_port_retried(self, mock_ensure_port, mock_db_api):
+        mock_ensure_port.side_effect = netans_ml2exc.SwitchLockTimeout(
+            self.testhost, 30)
+        port = self.mock_port_context.current
+        self.mech.delete_port_postcommit(self.mock_port_context)
+        mock_db_api.record.assert_called_once_with(
+            self.mock_port_context._plugin_context, c.OP_DELETE_PORT,
+            self.testhost, port['id'],
+            {'port': port,
+             'switch_port': self.testport,
+             'physnet': self.testphysnet,
+             'segmentation_id': self.testsegid,
+             'provision': False})
+        self.mech.journal.wake.assert_called_once_with()
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_delete_port_unknown_error(self, mock_ensure_port, mock_db_api):
+        mock_ensure_port.side_effect = ValueError('foo')
+        self.assertRaises(ValueError, self.mech.delete_port_postcommit,
+                          self.mock_port_context)
+        mock_db_api.record.assert_not_called()
+
+    @mock.patch.object(ports.Port, 'get_object')
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._ensure_subports_on_switch')
+    def test_ensure_subports_retried(self, mock_ensure, mock_get_port,
+                                     mock_db_api):
+        mock_get_port.return_value = self.mock_port_bm
+        mock_ensure.side_effect = self.unreachable
+        self.mech.ensure_subports(self.testid, 'testdb')
+        mock_db_api.record.assert_called_once_with(
+            'testdb', c.OP_UPDATE_SUBPORTS, self.testhost, self.testid,
+            {'port_id': self.testid, 'switch_port': self.testport,
+             'removed_vlans': []})
+        self.mech.journal.wake.assert_called_once_with()
+
+    def test_disabled(self, mock_db_api):
+        self.config(retry_sync_failures=False, group='ml2_ansible')
+        with mock.patch.object(self.mech, '_delete_vlan_on_host',
+                               side_effect=self.unreachable):
+            self.assertRaises(net_runr_exc.NetworkRunnerException,
+                              self.mech.delete_network_postcommit,
+                              self.mock_net_context)
+        mock_db_api.record.assert_not_called()
+
+
+@mock.patch('networking_ansible.ml2.mech_driver.n_context')
+class TestRunOperations(base.NetworkingAnsibleTestCase):
+    def _op(self, op_type, **payload):
+        return mech_driver_work_queue.SwitchOperation(op_type,
+                                                      self.testhost,
+                                                      payload)
+
+    def _port_op(self, op_type, provision=False):
+        return self._op(op_type,
+                        port=self.mock_port_bm,
+                        switch_port=self.testport,
+                        physnet=self.testphysnet,
+                        segmentation_id=self.testsegid,
+                        provision=provision)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._create_vlan_on_host')
+    def test_run_create_vlan(self, mock_create, mock_context):
+        errors = self.mech._run_operations(
+            [self._op(c.OP_CREATE_VLAN,
+                      network_id=self.testid,
+                      segmentation_id=self.testsegid)])
+        self.assertEqual([None], errors)
+        mock_create.assert_called_once_with(self.testhost, self.testid,
+                                            self.testsegid)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._delete_vlan_on_host')
+    def test_run_delete_vlan(self, mock_delete, mock_context):
+        errors = self.mech._run_operations(
+            [self._op(c.OP_DELETE_VLAN,
+                      network_id=self.testid,
+                      segmentation_id=self.testsegid,
+                      physnet=self.testphysnet)])
+        self.assertEqual([None], errors)
+        mock_delete.assert_called_once_with(
+            mock_context.get_admin_context.return_value,
+            self.testhost, self.testid, self.testsegid, self.testphysnet)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+                autospec=True)
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_run_update_port(self, mock_ensure_port, mock_prov_blocks,
+                             mock_context):
+        db = mock_context.get_admin_context.return_value
+        errors = self.mech._run_operations(
+            [self._port_op(c.OP_UPDATE_PORT, provision=True)])
+        self.assertEqual([None], errors)
+        mock_ensure_port.assert_called_once_with(
+            self.mock_port_bm, db, self.testhost, self.testport,
+            self.testphysnet, None, self.testsegid, delete=False)
+        mock_prov_blocks.provisioning_complete.assert_called_once_with(
+            db, self.testid, resources.PORT, c.NETWORKING_ENTITY)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+                autospec=True)
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_run_update_port_fails(self, mock_ensure_port, mock_prov_blocks,
+                                   mock_context):
+        error = netans_ml2exc.NetworkingAnsibleMechException('foo')
+        mock_ensure_port.side_effect = error
+        errors = self.mech._run_operations(
+            [self._port_op(c.OP_UPDATE_PORT, provision=True)])
+        self.assertEqual([error], errors)
+        mock_prov_blocks.provisioning_complete.assert_not_called()
+
+    @mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+                autospec=True)
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_run_delete_port(self, mock_ensure_port, mock_prov_blocks,
+                             mock_context):
+        db = mock_context.get_admin_context.return_value
+        errors = self.mech._run_operations(
+            [self._port_op(c.OP_DELETE_PORT)])
+        self.assertEqual([None], errors)
+        mock_ensure_port.assert_called_once_with(
+            self.mock_port_bm, db, self.testhost, self.testport,
+            self.testphysnet, None, self.testsegid, delete=True)
+        mock_prov_blocks.provisioning_complete.assert_not_called()
+
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver._ensure_subports_on_switch')
+    def test_run_update_subports(self, mock_ensure, mock_context):
+        errors = self.mech._run_operations(
+            [self._op(c.OP_UPDATE_SUBPORTS,
+                      port_id=self.testid,
+                      switch_port=self.testport,
+                      removed_vlans=[self.testsegid2])])
+        self.assertEqual([None], errors)
+        mock_ensure.assert_called_once_with(
+            self.testid, mock_context.get_admin_context.return_value,
+            self.testhost, self.testport, [self.testsegid2])
+
+    @mock.patch.object(runner.BatchNetworkRunner, 'run')
+    @mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+                autospec=True)
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_run_batch(self, mock_ensure_port, mock_prov_blocks,
+                       mock_run, mock_context):
+        def ensure_port(port, db, switch_name, switch_port, *args, **kwargs):
+            self.mech.net_runr.conf_access_port(switch_name, switch_port,
+                                                self.testsegid)
+        mock_ensure_port.side_effect = ensure_port
+
+        errors = self.mech._run_operations(
+            [self._port_op(c.OP_UPDATE_PORT, provision=True),
+             self._port_op(c.OP_UPDATE_PORT, provision=True)])
+
+        self.assertEqual([None, None], errors)
+        # one lock acquisition and one ansible run for both operations
+        self.mech.coordinator.get_lock.assert_called_once_with(
+            self.testhost.encode())
+        mock_run.assert_called_once()
+        play = mock_run.call_args[0][0].serialize()[0]
+        self.assertEqual(self.testhost, play['hosts'])
+        self.assertEqual(['conf_access_port', 'conf_access_port'],
+                         [task['args']['tasks_from']
+                          for task in play['tasks']])
+        self.assertEqual(2, mock_prov_blocks.provisioning_complete.call_count)
+
+    @mock.patch.object(runner.BatchNetworkRunner, 'run')
+    @mock.patch('networking_ansible.ml2.mech_driver.provisioning_blocks',
+                autospec=True)
+    @mock.patch('networking_ansible.ml2.mech_driver.'
+                'AnsibleMechanismDriver.ensure_port')
+    def test_run_batch_fails(self, mock_ensure_port, mock_prov_blocks,
+                             mock_run, mock_context):
+        mock_invalidate = mock.Mock()
+        self.mech.port_states.invalidate = mock_invalidate
+        db = mock_context.get_admin_context.return_value
+        ports = ['port1', 'port2']
+
+        def ensure_port(port, db, switch_name, switch_port, *args, **kwargs):
+            self.mech.net_runr.conf_access_port(switch_name, port['id'],
+                                                self.testsegid)
+        mock_ensure_port.side_effect = ensure_port
+
+        def run(playbook):
+            port_names = [task['vars']['port_name'] for play in
+                          playbook.serialize() for task in play['tasks']]
+            if ports[1] in port_names:
+                raise Exception('unreachable')
+        mock_run.side_effect = run
+
+        ops = [self._port_op(c.OP_UPDATE_PORT, provision=True)
+               for port in ports]
+        for op, port in zip(ops, ports):
+            op.payload['port'] = {'id': port}
+        errors = self.mech._run_operations(ops)
+
+        # the batch fails and each operation is run again on its own
+        self.assertEqual(3, mock_run.call_count)
+        mock_invalidate.assert_called_once_with(self.testhost)
+        self.assertIsNone(errors[0])
+        self.assertEqual('unreachable', str(errors[1]))
+        mock_prov_blocks.provisioning_complete.assert_called_once_with(
+            db, ports[0], resources.PORT, c.NETWORKING_ENTITY)
+
+    def test_switch_lock_reentrant(self, mock_context):
+        with self.mech._switch_lock(self.testhost):
+            with self.mech._switch_lock(self.testhost):
+                pass
+            with self.mech._switch_lock('otherhost'):
+                pass
+        self.assertEqual([mock.call(self.testhost.encode()),
+                          mock.call(b'otherhost')],
+                         self.mech.coordinator.get_lock.call_args_list)
+
+    @mock.patch('networking_ansible.ml2.mech_driver.LOG')
+    def test_switch_lock_logs_hold_time(self, mock_log, mock_context):
+        with self.mech._switch_lock(self.testhost):
+            mock_log.debug.assert_not_called()
+        self.assertIn('held', mock_log.debug.call_args[0][0])
+
+
+class TestSwitchLocks(base.NetworkingAnsibleTestCase):
+    def setUp(self):
+        super(TestSwitchLocks, self).setUp()
+        self.mech.coordinator = coordination.get_coordinator(
+            'file://{}'.format(tempfile.mkdtemp()), b'testmember')
+        self.mech.coordinator.start()
+        self.addCleanup(self.mech.coordinator.stop)
+        self.mech.locks = locking.LockManager(self.mech.coordinator)
+
+    def _is_blocked(self, held, lock):
+        """Check whether holding a lock blocks taking another in a thread"""
+        locked = threading.Event()
+
+        def take():
+            with lock:
+                locked.set()
+        thread = threading.Thread(target=take)
+        with held:
+            thread.start()
+            blocked = not locked.wait(0.5)
+        thread.join(5)
+        # it's taken once the lock holding it up is released
+        self.assertTrue(locked.is_set())
+        return blocked
+
+    def test_port_locks_parallel(self):
+        self.config(max_port_operations=2, group='ml2_ansible')
+        self.assertFalse(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._port_lock(self.testhost, 'port2')))
+
+    def test_port_locks_capped(self):
+        self.assertTrue(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._port_lock(self.testhost, 'port2')))
+
+    def test_port_locks_other_switch(self):
+        self.assertFalse(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._port_lock('otherhost', 'port1')))
+
+    def test_port_lock_same_port(self):
+        self.config(max_port_operations=2, group='ml2_ansible')
+        self.assertTrue(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._port_lock(self.testhost, 'port1')))
+
+    def test_switch_lock_blocks_ports(self):
+        self.config(max_port_operations=2, group='ml2_ansible')
+        self.assertTrue(self._is_blocked(
+            self.mech._switch_lock(self.testhost),
+            self.mech._port_lock(self.testhost, 'port1')))
+
+    def test_port_lock_blocks_switch(self):
+        self.config(max_port_operations=2, group='ml2_ansible')
+        self.assertTrue(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._switch_lock(self.testhost)))
+
+    def _hold_in_thread(self, lock):
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with lock:
+                locked.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        self.assertTrue(locked.wait(5))
+
+    def test_switch_lock_timeout(self):
+        self.config(lock_timeout=1, group='ml2_ansible')
+        self._hold_in_thread(self.mech._port_lock(self.testhost, 'port1'))
+        e = self.assertRaises(netans_ml2exc.SwitchLockTimeout,
+                              self.mech._switch_lock(self.testhost).__enter__)
+        self.assertIn(self.testhost, e.message)
+        self.assertEqual(1, self.mech.lock_timeouts[self.testhost])
+
+    def test_port_lock_timeout(self):
+        self.config(lock_timeout=1, max_port_operations=2,
+                    group='ml2_ansible')
+        self._hold_in_thread(self.mech._port_lock(self.testhost, 'port1'))
+        self.assertRaises(netans_ml2exc.SwitchLockTimeout,
+                          self.mech._port_lock(self.testhost,
+                                               'port1').__enter__)
+        self.assertEqual(1, self.mech.lock_timeouts[self.testhost])
+        # the slot it took is released again
+        with self.mech._port_lock(self.testhost, 'port2'):
+            pass
+
+    def test_port_lock_reentrant(self):
+        with self.mech._switch_lock(self.testhost):
+            with self.mech._port_lock(self.testhost, 'port1'):
+                with self.mech._port_lock(self.testhost, 'port1'):
+                    pass
+
+    def test_port_lock_lazy_vlans(self):
+        self.config(max_port_operations=2, lazy_vlans=True,
+                    group='ml2_ansible')
+        self.assertTrue(self._is_blocked(
+            self.mech._port_lock(self.testhost, 'port1'),
+            self.mech._port_lock(self.testhost, 'port2')))
+
+
 @mock.patch.object(api.NetworkRunner, 'create_vlan')
 class TestML2PluginIntegration(NetAnsibleML2Base):
     _mechanism_drivers = ['ansible']
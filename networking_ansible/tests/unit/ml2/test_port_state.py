@@ -0,0 +1,99 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+from networking_ansible.ml2 import port_state
+from networking_ansible.tests.unit import base
+
+
+@mock.patch('networking_ansible.ml2.port_state.time')
+class TestPortStateCache(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestPortStateCache, self).setUp()
+        self.cache = port_state.PortStateCache(60)
+        self.access = port_state.PortState.access(37)
+
+    def test_get_unknown(self, mock_time):
+        self.assertIsNone(self.cache.get('switch1', 'port1'))
+
+    def test_set(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1', self.access)
+        self.assertEqual(self.access, self.cache.get('switch1', 'port1'))
+        self.assertTrue(self.cache.is_applied('switch1', 'port1',
+                                              self.access))
+        self.assertFalse(self.cache.is_applied('switch1', 'port1',
+                                               port_state.PortState.access(
+                                                   73)))
+
+    def test_ttl(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1', self.access)
+        mock_time.monotonic.return_value = 161
+        self.assertIsNone(self.cache.get('switch1', 'port1'))
+
+    def test_disabled(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache = port_state.PortStateCache(0)
+        self.cache.set('switch1', 'port1', self.access)
+        self.assertIsNone(self.cache.get('switch1', 'port1'))
+
+    def test_invalidate_port(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1', self.access)
+        self.cache.set('switch1', 'port2', self.access)
+        self.cache.invalidate('switch1', 'port1')
+        self.assertIsNone(self.cache.get('switch1', 'port1'))
+        self.assertEqual(self.access, self.cache.get('switch1', 'port2'))
+
+    def test_invalidate_switch(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1', self.access)
+        self.cache.set('switch1', 'port2', self.access)
+        self.cache.set('switch2', 'port1', self.access)
+        self.cache.invalidate('switch1')
+        self.assertIsNone(self.cache.get('switch1', 'port1'))
+        self.assertIsNone(self.cache.get('switch1', 'port2'))
+        self.assertEqual(self.access, self.cache.get('switch2', 'port1'))
+
+    def test_trunk_vlans(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1',
+                       port_state.PortState.trunk(37, [73]))
+        self.assertTrue(self.cache.has_trunk_vlan('switch1', 'port1', 73))
+        self.assertFalse(self.cache.has_trunk_vlan('switch1', 'port1', 42))
+        self.assertTrue(self.cache.lacks_trunk_vlan('switch1', 'port1', 42))
+
+        self.cache.add_trunk_vlan('switch1', 'port1', 42)
+        self.assertTrue(self.cache.has_trunk_vlan('switch1', 'port1', 42))
+        self.cache.delete_trunk_vlan('switch1', 'port1', 73)
+        self.assertTrue(self.cache.lacks_trunk_vlan('switch1', 'port1', 73))
+        self.assertEqual(port_state.PortState.trunk(37, [42]),
+                         self.cache.get('switch1', 'port1'))
+
+    def test_add_trunk_vlan_unknown_port(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.add_trunk_vlan('switch1', 'port1', 37)
+        self.assertTrue(self.cache.has_trunk_vlan('switch1', 'port1', 37))
+        # the rest of the port's configuration isn't known
+        self.assertFalse(self.cache.lacks_trunk_vlan('switch1', 'port1', 73))
+
+    def test_access_port_has_no_trunk_vlans(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        self.cache.set('switch1', 'port1', self.access)
+        self.assertFalse(self.cache.has_trunk_vlan('switch1', 'port1', 37))
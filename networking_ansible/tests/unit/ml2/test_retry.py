@@ -0,0 +1,125 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from network_runner import exceptions as net_runr_exc
+import oslo_messaging
+from unittest import mock
+
+from networking_ansible import exceptions
+from networking_ansible.ml2 import retry
+from networking_ansible.tests.unit import base
+
+FAILED_OUTPUT = """
+TASK [network-runner : configure vlan 5000] ****************************
+fatal: [switch1]: FAILED! => {"changed": false, "msg": "invalid vlan 5000"}
+
+PLAY RECAP *************************************************************
+switch1 : ok=1 changed=0 unreachable=0 failed=1 skipped=0 rescued=0
+"""
+
+UNREACHABLE_OUTPUT = """
+TASK [network-runner : configure vlan 37] ******************************
+fatal: [switch1]: UNREACHABLE! => {"changed": false, "unreachable": true}
+
+PLAY RECAP *************************************************************
+switch1 : ok=0 changed=0 unreachable=1 failed=0 skipped=0 rescued=0
+"""
+
+
+class TestClassify(base.BaseTestCase):
+    parse_config = False
+
+    def _wrapped(self, error):
+        # the mech driver raises its own exception while handling the
+        # runner's
+        try:
+            try:
+                raise error
+            except Exception as e:
+                raise exceptions.NetworkingAnsibleMechException(e)
+        except Exception as e:
+            return e
+
+    def test_transient(self):
+        for error in (exceptions.SwitchLockTimeout('switch1', 5),
+                      exceptions.SwitchUnavailable('switch1'),
+                      oslo_messaging.MessagingTimeout(),
+                      net_runr_exc.NetworkRunnerException(
+                          'fatal: [switch1]: UNREACHABLE!')):
+            self.assertTrue(retry.is_transient(error))
+            self.assertFalse(retry.is_permanent(error))
+
+    def test_permanent(self):
+        for error in (net_runr_exc.NetworkRunnerException(
+                      'fatal: [switch1]: FAILED! => invalid vlan'),
+                      exceptions.LocalLinkInfoMissingException('foo')):
+            self.assertFalse(retry.is_transient(error))
+            self.assertTrue(retry.is_permanent(error))
+
+    def test_recap(self):
+        # every recap has an unreachable count, a failed task is permanent
+        error = net_runr_exc.NetworkRunnerException(FAILED_OUTPUT)
+        self.assertTrue(retry.is_permanent(error))
+        self.assertFalse(retry.is_transient(error))
+        self.assertTrue(retry.is_permanent(self._wrapped(error)))
+        error = net_runr_exc.NetworkRunnerException(UNREACHABLE_OUTPUT)
+        self.assertTrue(retry.is_transient(error))
+        self.assertFalse(retry.is_permanent(error))
+
+    def test_unknown(self):
+        error = ValueError('foo')
+        self.assertFalse(retry.is_transient(error))
+        self.assertFalse(retry.is_permanent(error))
+
+    def test_wrapped(self):
+        self.assertTrue(retry.is_transient(self._wrapped(
+            net_runr_exc.NetworkRunnerException('UNREACHABLE!'))))
+        self.assertTrue(retry.is_permanent(self._wrapped(
+            net_runr_exc.NetworkRunnerException('FAILED!'))))
+
+    def test_remote(self):
+        error = oslo_messaging.RemoteError('NetworkRunnerException',
+                                           'FAILED!')
+        self.assertTrue(retry.is_permanent(error))
+        error = oslo_messaging.RemoteError('NetworkRunnerException',
+                                           'UNREACHABLE!')
+        self.assertTrue(retry.is_transient(error))
+
+    def test_describe(self):
+        self.assertEqual('foo', retry.describe(ValueError('foo')))
+        error = self._wrapped(ValueError('foo'))
+        self.assertIn('foo', retry.describe(error))
+
+
+class TestBackoff(base.BaseTestCase):
+    parse_config = False
+
+    def test_doubles(self):
+        with mock.patch.object(retry.random, 'uniform',
+                               side_effect=lambda low, high: high):
+            self.assertEqual([10, 20, 40, 60, 60],
+                             [retry.backoff(i, 10, 60) for i in range(1, 6)])
+
+    def test_jitter(self):
+        for _ in range(100):
+            delay = retry.backoff(3, 10, 600)
+            self.assertGreaterEqual(delay, 20)
+            self.assertLessEqual(delay, 40)
+
+    def test_no_backoff(self):
+        self.assertEqual(0, retry.backoff(0, 10, 60))
+        self.assertEqual(0, retry.backoff(3, 0, 60))
+        # doesn't overflow after many attempts
+        self.assertLessEqual(retry.backoff(10000, 10, 60), 60)
@@ -0,0 +1,75 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from network_runner import exceptions as net_runr_exc
+from network_runner.models.playbook import Playbook
+from neutron_lib import rpc as n_rpc
+from oslo_config import cfg
+import oslo_messaging
+from unittest import mock
+
+from networking_ansible import constants as c
+from networking_ansible.ml2 import rpc
+from networking_ansible.tests.unit import base
+
+
+class TestAgentRunnerRpc(base.BaseTestCase):
+    def setUp(self):
+        super(TestAgentRunnerRpc, self).setUp()
+        transport = oslo_messaging.get_rpc_transport(cfg.CONF,
+                                                     url='fake:/')
+        self.addCleanup(transport.cleanup)
+        mock.patch.object(n_rpc, 'TRANSPORT', transport).start()
+
+        self.runner = mock.Mock()
+        target = oslo_messaging.Target(topic=c.AGENT_TOPIC, server='agent1')
+        server = oslo_messaging.get_rpc_server(
+            transport, target, [rpc.AgentRunnerEndpoint(self.runner)],
+            executor='threading',
+            serializer=n_rpc.RequestContextSerializer())
+        server.start()
+        self.addCleanup(server.wait)
+        self.addCleanup(server.stop)
+        self.api = rpc.AgentRunnerApi()
+
+    def _playbook(self):
+        pb = Playbook()
+        play = pb.new(hosts='switch1', gather_facts=False)
+        task = play.tasks.new(action='import_role')
+        task.args = {'name': 'network-runner', 'tasks_from': 'create_vlan'}
+        task.vars = {'vlan_id': 37}
+        return pb
+
+    def test_run_playbook(self):
+        playbook = self._playbook()
+        self.api.run_playbook(playbook)
+        self.runner.run.assert_called_once()
+        self.assertEqual(playbook.serialize(),
+                         self.runner.run.call_args[0][0].serialize())
+
+    def test_run_playbook_fails(self):
+        self.runner.run.side_effect = net_runr_exc.NetworkRunnerException(
+            'switch1 unreachable')
+        # the fake transport raises the agent's exception as it is, a real
+        # one wraps it in a RemoteError
+        self.assertRaises((oslo_messaging.RemoteError,
+                           net_runr_exc.NetworkRunnerException),
+                          self.api.run_playbook, self._playbook())
+
+    def test_run_playbook_timeout(self):
+        self.config(agent_timeout=5, group='ml2_ansible')
+        with mock.patch.object(self.api.client, 'prepare') as m_prepare:
+            self.api.run_playbook(self._playbook())
+        m_prepare.assert_called_once_with(timeout=5)
@@ -0,0 +1,318 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+import eventlet
+from unittest import mock
+
+from network_runner import api as net_runr_api
+from network_runner import exceptions as net_runr_exc
+from network_runner.models.inventory import Inventory
+from network_runner.models.playbook import Playbook
+
+from networking_ansible import exceptions
+from networking_ansible.ml2 import runner
+from networking_ansible.tests.unit import base
+
+
+@mock.patch.object(net_runr_api.NetworkRunner, 'run')
+class TestBatchNetworkRunner(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestBatchNetworkRunner, self).setUp()
+        self.runner = runner.BatchNetworkRunner(Inventory())
+
+    def _tasks(self, playbook):
+        return [(play['hosts'], task['args']['tasks_from'],
+                 task.get('vars'))
+                for play in playbook.serialize() for task in play['tasks']]
+
+    def test_play_without_batch(self, mock_run):
+        self.runner.create_vlan('switch1', 37)
+        mock_run.assert_called_once()
+        self.assertEqual([('switch1', 'create_vlan',
+                           {'vlan_id': 37, 'vlan_name': None})],
+                         self._tasks(mock_run.call_args[0][0]))
+
+    def test_batch(self, mock_run):
+        with self.runner.batch() as batch:
+            batch.owner = 'op1'
+            self.runner.create_vlan('switch1', 37)
+            batch.owner = 'op2'
+            self.runner.conf_access_port('switch1', 'port1', 37)
+            self.runner.delete_vlan('switch2', 73)
+        mock_run.assert_not_called()
+
+        self.assertEqual({}, batch.run())
+        mock_run.assert_called_once()
+        playbook = mock_run.call_args[0][0].serialize()
+        self.assertEqual(['switch1', 'switch2'],
+                         [play['hosts'] for play in playbook])
+        self.assertEqual(['create_vlan', 'conf_access_port', 'delete_vlan'],
+                         [t[1] for t in self._tasks(mock_run.call_args[0][0])])
+
+    def test_batch_empty(self, mock_run):
+        with self.runner.batch() as batch:
+            pass
+        self.assertEqual({}, batch.run())
+        mock_run.assert_not_called()
+
+    def test_batch_discard(self, mock_run):
+        with self.runner.batch() as batch:
+            batch.owner = 'op1'
+            self.runner.create_vlan('switch1', 37)
+            batch.owner = 'op2'
+            self.runner.create_vlan('switch1', 73)
+        batch.discard('op1')
+        batch.run()
+        self.assertEqual([('switch1', 'create_vlan',
+                           {'vlan_id': 73, 'vlan_name': None})],
+                         self._tasks(mock_run.call_args[0][0]))
+
+    def test_batch_fails_single_owner(self, mock_run):
+        error = Exception('unreachable')
+        mock_run.side_effect = error
+        with self.runner.batch() as batch:
+            batch.owner = 'op1'
+            self.runner.create_vlan('switch1', 37)
+            self.runner.create_vlan('switch1', 73)
+        self.assertEqual({'op1': error}, batch.run())
+        mock_run.assert_called_once()
+
+    def test_batch_fails_runs_owners_alone(self, mock_run):
+        def run(playbook):
+            vlans = [t[2]['vlan_id'] for t in self._tasks(playbook)]
+            if 73 in vlans:
+                raise Exception('unreachable')
+        mock_run.side_effect = run
+
+        with self.runner.batch() as batch:
+            for owner, vlan in (('op1', 37), ('op2', 73), ('op3', 42)):
+                batch.owner = owner
+                self.runner.create_vlan('switch1', vlan)
+        errors = batch.run()
+
+        self.assertEqual(['op2'], list(errors))
+        self.assertEqual(4, mock_run.call_count)
+
+    def test_batch_is_per_thread(self, mock_run):
+        with self.runner.batch() as batch:
+            thread = threading.Thread(target=self.runner.create_vlan,
+                                      args=('switch1', 37))
+            thread.start()
+            thread.join()
+        mock_run.assert_called_once()
+        self.assertEqual([], batch.tasks)
+
+    def test_merged(self, mock_run):
+        with self.runner.merged():
+            self.runner.add_trunk_vlan('switch1', 'port1', 37)
+            self.runner.delete_trunk_vlan('switch1', 'port1', 73)
+            mock_run.assert_not_called()
+        mock_run.assert_called_once()
+        self.assertEqual(['add_trunk_vlan', 'delete_trunk_vlan'],
+                         [t[1] for t in self._tasks(mock_run.call_args[0][0])])
+
+    def test_merged_fails(self, mock_run):
+        mock_run.side_effect = net_runr_exc.NetworkRunnerException('boom')
+
+        def apply():
+            with self.runner.merged():
+                self.runner.add_trunk_vlan('switch1', 'port1', 37)
+
+        self.assertRaises(net_runr_exc.NetworkRunnerException, apply)
+
+    def test_merged_in_batch(self, mock_run):
+        with self.runner.batch() as batch:
+            self.runner.create_vlan('switch1', 37)
+            with self.runner.merged():
+                self.runner.add_trunk_vlan('switch1', 'port1', 37)
+            # the plays join the batch
+            mock_run.assert_not_called()
+        self.assertEqual({}, batch.run())
+        self.assertEqual(['create_vlan', 'add_trunk_vlan'],
+                         [t[1] for t in self._tasks(mock_run.call_args[0][0])])
+
+
+class TestNativeThreads(base.BaseTestCase):
+    parse_config = False
+
+    def _playbook(self, *hosts):
+        pb = Playbook()
+        for host in hosts:
+            pb.new(hosts=host, gather_facts=False)
+        return pb
+
+    @mock.patch.object(runner.patcher, 'is_monkey_patched',
+                       return_value=False)
+    @mock.patch.object(net_runr_api.NetworkRunner, 'run')
+    @mock.patch.object(runner.tpool, 'execute')
+    def test_run_without_eventlet(self, mock_execute, mock_run,
+                                  mock_patched):
+        runner.BatchNetworkRunner(Inventory()).run(self._playbook('switch1'))
+        mock_execute.assert_not_called()
+        mock_run.assert_called_once()
+
+    @mock.patch.object(runner.patcher, 'is_monkey_patched',
+                       return_value=True)
+    @mock.patch.object(runner.tpool, 'execute')
+    def test_run_under_eventlet(self, mock_execute, mock_patched):
+        playbook = self._playbook('switch1')
+        result = runner.BatchNetworkRunner(Inventory()).run(playbook)
+        self.assertEqual(mock_execute.return_value, result)
+        mock_execute.assert_called_once_with(mock.ANY, playbook)
+
+    @mock.patch.object(net_runr_api.NetworkRunner, 'run')
+    def test_threads_per_switch(self, mock_run):
+        net_runr = runner.BatchNetworkRunner(Inventory(),
+                                             threads_per_switch=1)
+        running = []
+        overlaps = []
+        lock = threading.Lock()
+
+        def run(playbook):
+            hosts = {play.hosts for play in playbook}
+            with lock:
+                overlaps.extend(hosts & set(running))
+                running.extend(hosts)
+            time.sleep(0.05)
+            with lock:
+                for host in hosts:
+                    running.remove(host)
+        mock_run.side_effect = run
+
+        threads = [threading.Thread(
+            target=net_runr.run, args=(self._playbook(*hosts),))
+            for hosts in (['switch1'], ['switch1', 'switch2'],
+                          ['switch2', 'switch1'], ['switch2'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(4, mock_run.call_count)
+        self.assertEqual([], overlaps)
+
+    @mock.patch.object(runner.patcher, 'is_monkey_patched',
+                       return_value=True)
+    @mock.patch.object(net_runr_api.NetworkRunner, 'run',
+                       side_effect=lambda playbook: time.sleep(0.5))
+    def test_benchmark_hub_not_blocked(self, mock_run, mock_patched):
+        # a greenthread standing in for an api request keeps getting
+        # scheduled while playbooks block in native threads
+        net_runr = runner.BatchNetworkRunner(Inventory())
+        gaps = []
+
+        def request():
+            last = time.monotonic()
+            for _ in range(40):
+                eventlet.sleep(0.01)
+                now = time.monotonic()
+                gaps.append(now - last)
+                last = now
+
+        pool = eventlet.GreenPool()
+        pool.spawn(request)
+        for n in range(4):
+            pool.spawn(net_runr.run, self._playbook('switch{}'.format(n)))
+        pool.waitall()
+        self.assertEqual(4, mock_run.call_count)
+        # running the playbooks inline would stall it for 0.5s each
+        self.assertLess(max(gaps), 0.25)
+
+
+@mock.patch.object(runner.BatchNetworkRunner, '_execute')
+class TestBreakers(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestBreakers, self).setUp()
+        self.breakers = mock.Mock()
+        self.runner = runner.BatchNetworkRunner(Inventory(),
+                                                breakers=self.breakers)
+
+    def test_run(self, mock_execute):
+        self.runner.create_vlan('switch1', 37)
+        self.breakers.check.assert_called_once_with('switch1')
+        self.breakers.record.assert_called_once_with('switch1', None)
+
+    def test_run_fails(self, mock_execute):
+        error = net_runr_exc.NetworkRunnerException('UNREACHABLE!')
+        mock_execute.side_effect = error
+        self.assertRaises(net_runr_exc.NetworkRunnerException,
+                          self.runner.create_vlan, 'switch1', 37)
+        self.breakers.record.assert_called_once_with('switch1', error)
+
+    def test_breaker_open(self, mock_execute):
+        self.breakers.check.side_effect = exceptions.SwitchUnavailable(
+            'switch1')
+        self.assertRaises(exceptions.SwitchUnavailable,
+                          self.runner.create_vlan, 'switch1', 37)
+        mock_execute.assert_not_called()
+        self.breakers.record.assert_not_called()
+
+
+@mock.patch.object(runner.BatchNetworkRunner, '_execute')
+class TestThrottle(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestThrottle, self).setUp()
+        self.throttle = mock.MagicMock()
+        self.runner = runner.BatchNetworkRunner(Inventory(),
+                                                throttle=self.throttle)
+
+    def test_run(self, mock_execute):
+        session = self.throttle.session.return_value
+        self.runner.create_vlan('switch1', 37)
+        self.throttle.session.assert_called_once_with('switch1')
+        session.__enter__.assert_called_once()
+        mock_execute.assert_called_once()
+        session.__exit__.assert_called_once()
+
+
+class TestRemoteNetworkRunner(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestRemoteNetworkRunner, self).setUp()
+        self.api = mock.Mock()
+        self.runner = runner.RemoteNetworkRunner(Inventory(), self.api)
+
+    def test_play(self):
+        self.runner.create_vlan('switch1', 37)
+        self.api.run_playbook.assert_called_once()
+        playbook = self.api.run_playbook.call_args[0][0].serialize()
+        self.assertEqual(['switch1'], [play['hosts'] for play in playbook])
+
+    def test_batch(self):
+        with self.runner.batch() as batch:
+            batch.owner = 'op1'
+            self.runner.create_vlan('switch1', 37)
+            batch.owner = 'op2'
+            self.runner.conf_access_port('switch1', 'port1', 37)
+        self.api.run_playbook.assert_not_called()
+        self.assertEqual({}, batch.run())
+        self.api.run_playbook.assert_called_once()
+
+    def test_batch_fails(self):
+        error = Exception('unreachable')
+        self.api.run_playbook.side_effect = error
+        with self.runner.batch() as batch:
+            batch.owner = 'op1'
+            self.runner.create_vlan('switch1', 37)
+        self.assertEqual({'op1': error}, batch.run())
@@ -0,0 +1,96 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from unittest import mock
+
+import fixtures
+
+from networking_ansible.ml2 import sharding
+from networking_ansible.tests.unit import base
+
+
+class TestSwitchRing(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestSwitchRing, self).setUp()
+        self.uri = 'file://{}'.format(
+            self.useFixture(fixtures.TempDir()).path)
+        self.switches = ['switch{}'.format(i) for i in range(20)]
+
+    def _ring(self, member_id, on_change=None):
+        ring = sharding.SwitchRing(self.uri, on_change=on_change,
+                                   member_id=member_id)
+        ring.start()
+        self.addCleanup(ring.stop)
+        return ring
+
+    def test_single_member_owns_all(self):
+        ring = self._ring(b'member1')
+        self.assertTrue(all(ring.owns(s) for s in self.switches))
+
+    def test_switches_shared(self):
+        ring1 = self._ring(b'member1')
+        ring2 = self._ring(b'member2')
+        ring1.refresh()
+
+        owned1 = {s for s in self.switches if ring1.owns(s)}
+        owned2 = {s for s in self.switches if ring2.owns(s)}
+        # every switch has exactly one owner
+        self.assertEqual(set(self.switches), owned1 | owned2)
+        self.assertFalse(owned1 & owned2)
+        self.assertTrue(owned1)
+        self.assertTrue(owned2)
+
+    def test_member_leaves(self):
+        ring1 = self._ring(b'member1')
+        ring2 = self._ring(b'member2')
+        ring1.refresh()
+        owned1 = {s for s in self.switches if ring1.owns(s)}
+
+        ring2.stop()
+        ring1.refresh()
+        self.assertTrue(all(ring1.owns(s) for s in self.switches))
+
+        # the switches come back to the member that rejoins
+        ring2.start()
+        ring1.refresh()
+        self.assertEqual(owned1, {s for s in self.switches if ring1.owns(s)})
+
+    def test_on_change(self):
+        on_change = mock.Mock()
+        ring1 = self._ring(b'member1', on_change)
+        ring1.refresh()
+        on_change.assert_not_called()
+        self._ring(b'member2')
+        ring1.refresh()
+        ring1.refresh()
+        on_change.assert_called_once_with()
+
+    @mock.patch('networking_ansible.ml2.sharding.os.getpid')
+    @mock.patch('networking_ansible.ml2.sharding.coordination.'
+                'get_coordinator')
+    def test_member_per_process(self, mock_get_coordinator, mock_getpid):
+        self.config(host='host1')
+        ring = sharding.SwitchRing(self.uri)
+        # the ring is created before the workers are forked, each worker
+        # joins as itself
+        mock_getpid.return_value = 123
+        ring.start()
+        mock_get_coordinator.assert_called_once_with(self.uri, b'host1-123')
+        coordinator = mock_get_coordinator.return_value
+        coordinator.start.assert_called_once_with(start_heart=True)
+        ring.stop()
+        coordinator.stop.assert_called_once_with()
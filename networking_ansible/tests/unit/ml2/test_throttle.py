@@ -0,0 +1,129 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+import fixtures
+from tooz import coordination
+from unittest import mock
+
+from networking_ansible.ml2 import locking
+from networking_ansible.ml2 import throttle
+from networking_ansible.tests.unit import base
+
+
+class TestSwitchThrottle(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestSwitchThrottle, self).setUp()
+        self.uri = 'file://{}'.format(
+            self.useFixture(fixtures.TempDir()).path)
+
+    def _throttle(self, member_id, session_limits=None, rate_limits=None):
+        # each throttle stands in for a neutron-server process with a
+        # coordinator of its own
+        coordinator = coordination.get_coordinator(self.uri, member_id)
+        coordinator.start()
+        self.addCleanup(coordinator.stop)
+        return throttle.SwitchThrottle(locking.LockManager(coordinator),
+                                       session_limits or {},
+                                       rate_limits or {},
+                                       poll_interval=0.01)
+
+    def _run_sessions(self, throttles, count, hold=0):
+        lock = threading.Lock()
+        state = {'open': 0, 'max_open': 0, 'started': []}
+
+        def session(switch_throttle):
+            with switch_throttle.session('switch1'):
+                with lock:
+                    state['open'] += 1
+                    state['max_open'] = max(state['max_open'],
+                                            state['open'])
+                    state['started'].append(time.monotonic())
+                time.sleep(hold)
+                with lock:
+                    state['open'] -= 1
+
+        threads = [threading.Thread(target=session,
+                                    args=(throttles[i % len(throttles)],))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(count, len(state['started']))
+        return state
+
+    def test_no_limits(self):
+        locks = mock.Mock()
+        switch_throttle = throttle.SwitchThrottle(locks, {}, {})
+        with switch_throttle.session('switch1'):
+            pass
+        locks.get_lock.assert_not_called()
+
+    def test_session_limit(self):
+        throttles = [self._throttle(b'member1', {'switch1': 2}),
+                     self._throttle(b'member2', {'switch1': 2})]
+        state = self._run_sessions(throttles, 8, hold=0.05)
+        # the limit is shared by the processes
+        self.assertEqual(2, state['max_open'])
+
+    def test_session_limit_other_switch(self):
+        switch_throttle = self._throttle(b'member1', {'switch1': 1})
+        with switch_throttle.session('switch1'):
+            # the other switches don't wait
+            with switch_throttle.session('switch2'):
+                pass
+
+    def test_rate_limit(self):
+        throttles = [self._throttle(b'member1', rate_limits={'switch1': 20}),
+                     self._throttle(b'member2', rate_limits={'switch1': 20})]
+        state = self._run_sessions(throttles, 5)
+        started = sorted(state['started'])
+        # the sessions are opened 1 / 20 seconds apart whichever process
+        # opens them
+        self.assertGreaterEqual(started[-1] - started[0], 0.19)
+
+    @mock.patch('networking_ansible.ml2.throttle.random.uniform',
+                side_effect=lambda low, high: high)
+    def test_session_wait_backoff(self, mock_uniform):
+        locks = mock.Mock()
+        slots = [mock.Mock(), mock.Mock()]
+        locks.get_lock.side_effect = slots
+        checks = []
+        waits = []
+
+        def acquire(blocking=True, timeout=None):
+            if not blocking:
+                checks.append(timeout)
+                return False
+            waits.append(timeout)
+            return len(waits) == 5
+
+        for slot in slots:
+            slot.acquire.side_effect = acquire
+        switch_throttle = throttle.SwitchThrottle(locks, {'switch1': 2}, {},
+                                                  poll_interval=0.1,
+                                                  max_poll_interval=0.4)
+        with switch_throttle.session('switch1'):
+            pass
+        # each round waits on one slot, for twice as long as the last
+        # round up to the maximum
+        self.assertEqual([0.1, 0.2, 0.4, 0.4, 0.4], waits)
+        # and every slot is only checked once a round
+        self.assertEqual(10, len(checks))
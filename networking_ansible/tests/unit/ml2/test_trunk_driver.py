@@ -10,16 +10,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import threading
+import time
 
+from neutron.db import models_v2
 from neutron.objects import trunk
+from neutron.plugins.ml2 import models as ml2_models
+from neutron.tests.unit import testlib_api
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
 from neutron_lib.callbacks import resources
 from neutron_lib import context as n_context
+from neutron_lib.db import api as neutron_db_api
 from oslo_config import cfg
+from oslo_serialization import jsonutils
+from oslo_utils import uuidutils
 
+from networking_ansible import constants as c
+from networking_ansible.db import api as db_api
 from networking_ansible.ml2 import mech_driver
 from networking_ansible.ml2 import trunk_driver
+from networking_ansible.tests.unit import base as netans_base
 from neutron.conf.plugins.ml2.config import ml2_opts
 from neutron.tests import base
 from unittest import mock
@@ -39,7 +50,7 @@ class NetAnsibleTrunkHandlerTestCase(base.BaseTestCase):
         payload.subports = []
         handler.subports_added(None, None, None, payload)
         driver.ensure_subports.assert_called_once_with(
-            payload.current_trunk.port_id, mock_context())
+            payload.current_trunk.port_id, mock_context(), removed_vlans=())
 
     def test_subports_deleted(self, mock_context):
         driver = mock.Mock(spec=mech_driver.AnsibleMechanismDriver)
@@ -47,10 +58,131 @@ class NetAnsibleTrunkHandlerTestCase(base.BaseTestCase):
         payload = mock.Mock()
         payload.original_trunk = mock.Mock(spec=trunk.Trunk)
         payload.original_trunk.port_id = TEST_PORT_ID
-        payload.subports = []
+        payload.subports = [mock.Mock(segmentation_id=101)]
         handler.subports_deleted(None, None, None, payload)
         driver.ensure_subports.assert_called_once_with(
-            payload.original_trunk.port_id, mock_context())
+            payload.original_trunk.port_id, mock_context(),
+            removed_vlans=[101])
+
+
+@mock.patch.object(n_context, 'get_admin_context')
+class NetAnsibleTrunkHandlerDebounceTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(NetAnsibleTrunkHandlerDebounceTestCase, self).setUp()
+        self.driver = mock.Mock(spec=mech_driver.AnsibleMechanismDriver)
+        self.handler = trunk_driver.NetAnsibleTrunkHandler(self.driver,
+                                                           0.05)
+        self.payload = mock.Mock()
+        self.payload.current_trunk = mock.Mock(spec=trunk.Trunk)
+        self.payload.current_trunk.port_id = TEST_PORT_ID
+
+    def _add_subports(self, count=1):
+        for _ in range(count):
+            self.handler.subports_added(None, None, None, self.payload)
+
+    def _wait_for_idle(self):
+        deadline = time.monotonic() + 5
+        while self.handler._trunks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({}, self.handler._trunks)
+
+    def test_changes_collapsed(self, mock_context):
+        self._add_subports(10)
+        self.driver.ensure_subports.assert_not_called()
+        self._wait_for_idle()
+        self.driver.ensure_subports.assert_called_once_with(
+            TEST_PORT_ID, mock_context(), removed_vlans=set())
+
+    def test_removed_vlans_collapsed(self, mock_context):
+        self.payload.original_trunk = self.payload.current_trunk
+        for vlan in (101, 102):
+            self.payload.subports = [mock.Mock(segmentation_id=vlan)]
+            self.handler.subports_deleted(None, None, None, self.payload)
+        self._add_subports()
+        self._wait_for_idle()
+        self.driver.ensure_subports.assert_called_once_with(
+            TEST_PORT_ID, mock_context(), removed_vlans={101, 102})
+        self.assertEqual({}, self.handler._removed_vlans)
+
+    def test_changes_while_applying(self, mock_context):
+        running = threading.Event()
+        release = threading.Event()
+
+        def ensure_subports(port_id, context, removed_vlans):
+            if not running.is_set():
+                running.set()
+                release.wait(5)
+
+        self.driver.ensure_subports.side_effect = ensure_subports
+        self._add_subports()
+        self.assertTrue(running.wait(5))
+        self._add_subports(5)
+        release.set()
+        self._wait_for_idle()
+        # the changes made while applying get a single follow-up
+        self.assertEqual(2, self.driver.ensure_subports.call_count)
+
+    def test_apply_fails(self, mock_context):
+        self.driver.ensure_subports.side_effect = Exception('boom')
+        self._add_subports()
+        self._wait_for_idle()
+        self._add_subports()
+        self._wait_for_idle()
+        self.assertEqual(2, self.driver.ensure_subports.call_count)
+
+    def test_trunks_independent(self, mock_context):
+        self._add_subports()
+        self.payload.current_trunk.port_id = 'other-port'
+        self._add_subports()
+        self._wait_for_idle()
+        self.assertCountEqual(
+            [mock.call(TEST_PORT_ID, mock_context(), removed_vlans=set()),
+             mock.call('other-port', mock_context(), removed_vlans=set())],
+            self.driver.ensure_subports.call_args_list)
+
+
+class NetAnsibleTrunkHandlerDbTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(NetAnsibleTrunkHandlerDbTestCase, self).setUp()
+        cfg.CONF.set_override('async_mode', True, group='ml2_ansible')
+        self.addCleanup(cfg.CONF.clear_override, 'async_mode',
+                        group='ml2_ansible')
+        self.driver = mech_driver.AnsibleMechanismDriver()
+        self.driver.ml2config = netans_base.MockConfig()
+        self.driver.journal = mock.Mock()
+        self.ctx = n_context.get_admin_context()
+        self.port_id = uuidutils.generate_uuid()
+        network_id = uuidutils.generate_uuid()
+        lli = {c.LLI: [{'switch_info': 'switch1', 'port_id': 'swp1'}]}
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(models_v2.Network(id=network_id,
+                                                   project_id='project'))
+        with neutron_db_api.CONTEXT_WRITER.using(self.ctx):
+            self.ctx.session.add(models_v2.Port(
+                id=self.port_id, project_id='project', network_id=network_id,
+                mac_address='fa:16:3e:00:00:01', admin_state_up=True,
+                status='ACTIVE', device_id='device',
+                device_owner=c.BAREMETAL_NONE))
+            self.ctx.session.add(ml2_models.PortBinding(
+                port_id=self.port_id, host='host1', vnic_type='baremetal',
+                profile=jsonutils.dumps(lli), vif_type='other',
+                vif_details=''))
+
+    def test_subports_journaled(self):
+        handler = trunk_driver.NetAnsibleTrunkHandler(self.driver)
+        payload = mock.Mock()
+        payload.current_trunk.port_id = self.port_id
+        handler.subports_added(None, None, None, payload)
+        pending = db_api.get_pending(self.ctx)
+        self.assertEqual([(c.OP_UPDATE_SUBPORTS, 'switch1', self.port_id)],
+                         [(e.op_type, e.switch_name, e.object_id)
+                          for e in pending])
+        self.assertEqual({'port_id': self.port_id, 'switch_port': 'swp1',
+                          'removed_vlans': []},
+                         db_api.get_payload(pending[0]))
+        self.driver.journal.wake.assert_called_once_with()
 
 
 class NetAnsibleTrunkDriverTestCase(base.BaseTestCase):
@@ -0,0 +1,106 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pickle
+
+from networking_ansible.ml2 import vlan_set
+from networking_ansible.tests.unit import base
+
+
+class TestVlanSet(base.BaseTestCase):
+    parse_config = False
+
+    def test_empty(self):
+        vlans = vlan_set.VlanSet()
+        self.assertFalse(vlans)
+        self.assertEqual(0, len(vlans))
+        self.assertEqual([], list(vlans))
+        self.assertEqual('', str(vlans))
+
+    def test_iterate_sorted(self):
+        vlans = vlan_set.VlanSet([300, 4095, 2, 0, 100])
+        self.assertEqual([0, 2, 100, 300, 4095], list(vlans))
+        self.assertEqual(5, len(vlans))
+
+    def test_contains(self):
+        vlans = vlan_set.VlanSet([100, 4095])
+        self.assertIn(100, vlans)
+        self.assertIn(4095, vlans)
+        self.assertNotIn(101, vlans)
+        self.assertNotIn(-1, vlans)
+        self.assertNotIn(None, vlans)
+
+    def test_out_of_range(self):
+        self.assertRaises(ValueError, vlan_set.VlanSet, [4096])
+        self.assertRaises(ValueError, vlan_set.VlanSet, [-1])
+
+    def test_set_operations(self):
+        first = vlan_set.VlanSet([1, 2, 3])
+        second = vlan_set.VlanSet([3, 4])
+        self.assertEqual(vlan_set.VlanSet([1, 2, 3, 4]), first | second)
+        self.assertEqual(vlan_set.VlanSet([1, 2]), first - second)
+        self.assertEqual(vlan_set.VlanSet([3]), first & second)
+        self.assertEqual(vlan_set.VlanSet([1, 2, 4]), first ^ second)
+        # the operands are left alone
+        self.assertEqual([1, 2, 3], list(first))
+
+    def test_set_operations_iterables(self):
+        vlans = vlan_set.VlanSet([1, 2])
+        self.assertEqual(vlan_set.VlanSet([1, 2, 3]), vlans | {3})
+        self.assertEqual(vlan_set.VlanSet([1]), vlans - {2})
+        self.assertEqual(vlan_set.VlanSet([3]), {2, 3} - vlans)
+
+    def test_equal_hash(self):
+        first = vlan_set.VlanSet([5, 10])
+        second = vlan_set.VlanSet([10, 5, 5])
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertNotEqual(first, vlan_set.VlanSet([5]))
+        self.assertNotEqual(first, [5, 10])
+
+    def test_immutable(self):
+        vlans = vlan_set.VlanSet([1])
+        self.assertRaises(AttributeError, setattr, vlans, '_bits', 0)
+
+    def test_str(self):
+        expected = list(range(100, 141)) + [200] + list(range(300, 311))
+        vlans = vlan_set.VlanSet(expected)
+        self.assertEqual('100-140,200,300-310', str(vlans))
+        self.assertEqual('0-4095', str(vlan_set.VlanSet(range(4096))))
+        self.assertEqual('1,3,5-6', str(vlan_set.VlanSet([6, 5, 3, 1])))
+
+    def test_ranges(self):
+        vlans = vlan_set.VlanSet([1, 2, 3, 7, 4094, 4095])
+        self.assertEqual([(1, 3), (7, 7), (4094, 4095)], vlans.ranges())
+
+    def test_from_ranges(self):
+        vlans = vlan_set.VlanSet.from_ranges('100-140, 200,300-310,')
+        expected = list(range(100, 141)) + [200] + list(range(300, 311))
+        self.assertEqual(expected, list(vlans))
+        self.assertEqual(vlan_set.VlanSet(),
+                         vlan_set.VlanSet.from_ranges(''))
+
+    def test_from_ranges_round_trip(self):
+        vlans = vlan_set.VlanSet([1, 5, 6, 7, 1000, 4095])
+        self.assertEqual(vlans, vlan_set.VlanSet.from_ranges(str(vlans)))
+
+    def test_from_ranges_invalid(self):
+        for ranges in ('10-5', '5000', 'abc', '1-2-3', '-5'):
+            self.assertRaises(ValueError, vlan_set.VlanSet.from_ranges,
+                              ranges)
+
+    def test_pickle(self):
+        vlans = vlan_set.VlanSet([1, 2, 3, 99])
+        self.assertEqual(vlans, pickle.loads(pickle.dumps(vlans)))
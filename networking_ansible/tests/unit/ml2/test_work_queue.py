@@ -0,0 +1,120 @@
+# Copyright (c) 2018 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+from unittest import mock
+
+from networking_ansible.ml2 import work_queue
+from networking_ansible.tests.unit import base
+
+
+class TestSwitchWorkQueue(base.BaseTestCase):
+    parse_config = False
+
+    def setUp(self):
+        super(TestSwitchWorkQueue, self).setUp()
+        self.ran = []
+        self.handler = mock.Mock(side_effect=self.ran.extend)
+        self.queue = work_queue.SwitchWorkQueue(self.handler, 2)
+
+    def _op(self, switch_name, n):
+        return work_queue.SwitchOperation('op', switch_name, {'n': n})
+
+    def test_enqueue_runs_in_order(self):
+        ops = [self._op('switch1', n) for n in range(5)]
+        for op in ops:
+            self.queue.enqueue(op)
+        self.queue.shutdown()
+        self.assertEqual(ops, self.ran)
+
+    def test_enqueue_multiple_switches(self):
+        ops1 = [self._op('switch1', n) for n in range(3)]
+        ops2 = [self._op('switch2', n) for n in range(3)]
+        for op1, op2 in zip(ops1, ops2):
+            self.queue.enqueue(op1)
+            self.queue.enqueue(op2)
+        self.queue.shutdown()
+        self.assertEqual(ops1, [op for op in self.ran
+                                if op.switch_name == 'switch1'])
+        self.assertEqual(ops2, [op for op in self.ran
+                                if op.switch_name == 'switch2'])
+
+    def test_enqueue_switches_in_parallel(self):
+        # both switches have to be running at the same time for either
+        # of them to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        self.handler.side_effect = lambda ops: barrier.wait()
+        self.queue.enqueue(self._op('switch1', 0))
+        self.queue.enqueue(self._op('switch2', 0))
+        self.queue.shutdown()
+        self.assertFalse(barrier.broken)
+
+    def test_handler_error_continues(self):
+        ops = [self._op('switch1', n) for n in range(2)]
+        self.handler.side_effect = [Exception('boom'), None]
+        for op in ops:
+            self.queue.enqueue(op)
+        self.queue.shutdown()
+        self.assertEqual([mock.call([op]) for op in ops],
+                         self.handler.call_args_list)
+
+    def test_pending(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(ops):
+            started.set()
+            release.wait(5)
+        self.handler.side_effect = handler
+
+        self.queue.enqueue(self._op('switch1', 0))
+        started.wait(5)
+        self.queue.enqueue(self._op('switch1', 1))
+        self.queue.enqueue(self._op('switch2', 0))
+        self.assertEqual(1, self.queue.pending('switch1'))
+        release.set()
+        self.queue.shutdown()
+        self.assertEqual(0, self.queue.pending())
+
+    def test_batch(self):
+        started = threading.Event()
+        release = threading.Event()
+        queue = work_queue.SwitchWorkQueue(self.handler, 2, batch_size=2)
+
+        def handler(ops):
+            started.set()
+            release.wait(5)
+        self.handler.side_effect = handler
+
+        ops = [self._op('switch1', n) for n in range(4)]
+        queue.enqueue(ops[0])
+        started.wait(5)
+        for op in ops[1:]:
+            queue.enqueue(op)
+        release.set()
+        queue.shutdown()
+        self.assertEqual([mock.call(ops[:1]), mock.call(ops[1:3]),
+                          mock.call(ops[3:])],
+                         self.handler.call_args_list)
+
+    def test_batch_window(self):
+        queue = work_queue.SwitchWorkQueue(self.handler, 2, batch_size=3,
+                                           batch_window=0.5)
+        ops = [self._op('switch1', n) for n in range(3)]
+        for op in ops:
+            queue.enqueue(op)
+        queue.shutdown()
+        self.assertEqual([mock.call(ops)], self.handler.call_args_list)
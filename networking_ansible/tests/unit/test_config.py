@@ -37,6 +37,26 @@ class MockedConfigParser(mock.Mock):
                 'ansible:h2': {'manage_vlans': ['true']},
                 'ansible:h3': {'manage_vlans': ['false']},
             }
+        elif self.conffile == 'physnets':
+            section_data = {
+                'ansible:h1': {'physnets': ['physnet1, physnet2']},
+                'ansible:h2': {'physnets': ['physnet2']},
+                'ansible:h3': {'mac': ['01:23:45:67:89:ab']},
+            }
+        elif self.conffile == 'limits':
+            section_data = {
+                'ansible:h1': {'max_concurrent_sessions': ['2'],
+                               'ops_per_second': ['0.5']},
+                'ansible:h2': {'max_concurrent_sessions': ['3']},
+                'ansible:h3': {'mac': ['01:23:45:67:89:ab']},
+            }
+        elif self.conffile == 'multi_port_mapping':
+            section_data = {'ansible:port_mappings':
+                            {'host1': ['sw1::port1, sw2::port2,invalid'],
+                             'host1-37:0b': ['sw1::port3'],
+                             'host-2-0001:03:00': ['sw2::Ethernet1:2']},
+                            'ansible:sw1': {'mac': ['01:23:45:67:89:ab']}
+                            }
         elif self.conffile == 'invalid_port_mapping':
             section_data = {'ansible:port_mappings':
                             {'localhost': ['invalid']},
@@ -104,3 +124,70 @@ class TestConfig(base.BaseTestCase):
         self.assertEqual({'manage_vlans': True}, hosts['h2'])
         self.assertEqual({'manage_vlans': False}, hosts['h3'])
         self.assertEqual({}, self.ansconfig.Config().mac_map)
+
+    @mock.patch('networking_ansible.config.cfg.ConfigParser',
+                MockedConfigParser)
+    def test_config_physnets(self):
+        self.test_config_files = ['physnets']
+        self.setup_config()
+
+        conf = self.ansconfig.Config()
+        self.assertEqual({'physnet1': ['h1'], 'physnet2': ['h1', 'h2']},
+                         conf.physnet_map)
+        self.assertEqual(['h3'], conf.any_physnet_hosts)
+        # physnets is not passed to ansible
+        self.assertEqual({}, conf.inventory['h1'])
+        self.assertEqual(['h1', 'h3'], conf.get_physnet_hosts('physnet1'))
+        self.assertEqual(['h1', 'h2', 'h3'],
+                         conf.get_physnet_hosts('physnet2'))
+        self.assertEqual(['h3'], conf.get_physnet_hosts('physnet3'))
+
+    @mock.patch('networking_ansible.config.cfg.ConfigParser',
+                MockedConfigParser)
+    def test_config_limits(self):
+        self.test_config_files = ['limits']
+        self.setup_config()
+
+        conf = self.ansconfig.Config()
+        self.assertEqual({'h1': 2, 'h2': 3}, conf.session_limits)
+        self.assertEqual({'h1': 0.5}, conf.rate_limits)
+        # the limits are not passed to ansible
+        self.assertEqual({}, conf.inventory['h1'])
+
+    @mock.patch('networking_ansible.config.cfg.ConfigParser',
+                MockedConfigParser)
+    def test_config_multi_port_mapping(self):
+        self.test_config_files = ['multi_port_mapping']
+        self.setup_config()
+
+        conf = self.ansconfig.Config()
+        self.assertEqual([('sw1', 'port1'), ('sw2', 'port2')],
+                         conf.port_mappings['host1'])
+        self.assertEqual((('sw1', 'port1'), ('sw2', 'port2')),
+                         conf.get_port_mappings('host1'))
+
+    @mock.patch('networking_ansible.config.cfg.ConfigParser',
+                MockedConfigParser)
+    def test_get_port_mappings_pci(self):
+        self.test_config_files = ['multi_port_mapping']
+        self.setup_config()
+
+        conf = self.ansconfig.Config()
+        for pci_slot in ('0000:37:0b.1', '0000:37:0B.5', '37:0b'):
+            self.assertEqual((('sw1', 'port3'),),
+                             conf.get_port_mappings('host1', pci_slot))
+        # the domain isn't dropped and host names can have dashes
+        self.assertEqual((('sw2', 'Ethernet1:2'),),
+                         conf.get_port_mappings('host-2', '0001:03:00.0'))
+        self.assertEqual((), conf.get_port_mappings('host-2', '03:00.0'))
+        self.assertEqual((), conf.get_port_mappings('host1', '0000:37:0c.1'))
+        self.assertEqual((), conf.get_port_mappings('host1', ''))
+        self.assertEqual((), conf.get_port_mappings('host2'))
+
+    def test_parse_pci_address(self):
+        parse = self.ansconfig.parse_pci_address
+        self.assertEqual((0, 0x37, 0x0b), parse('0000:37:0b.1'))
+        self.assertEqual((0, 0x37, 0x0b), parse('37:0B'))
+        self.assertEqual((0xa, 0x3, 0x1f), parse('000a:03:1f'))
+        for address in ('', None, 'host', '37:0b.8', '1:37:0b', '37-0b'):
+            self.assertIsNone(parse(address))